@@ -1,4 +1,3 @@
-import os
 import collections
 
 
@@ -12,17 +11,18 @@ class LinuxCPU(object):
     cpu_stat = collections.namedtuple('cpu_stat', FIELDS)
 
     @classmethod
-    def verify(cls):
-        if not os.path.isfile(cls.PROC_STAT):
-            raise Exception('no such file: {0}'.format(cls.PROC_STAT))
+    def verify(cls, procfs):
+        if not procfs.isfile(cls.PROC_STAT):
+            raise Exception('no such file: {0}'.format(
+                procfs.path(cls.PROC_STAT)))
 
-        return cls.read_cpu()
+        return cls.read_cpu(procfs)
 
     @classmethod
-    def read_cpu(cls):
+    def read_cpu(cls, procfs):
         first = None
 
-        with open(cls.PROC_STAT, 'r') as f:
+        with procfs.open(cls.PROC_STAT) as f:
             first = f.readline().strip()
 
         parts = first.split()
@@ -37,7 +37,8 @@ class LinuxCPU(object):
 
         return cls.cpu_stat(*(int(p) for p in rest))
 
-    def __init__(self, registry, last):
+    def __init__(self, registry, procfs, last):
+        self.procfs = procfs
         self.cpu_usages = dict()
 
         for field in self.FIELDS:
@@ -53,8 +54,14 @@ class LinuxCPU(object):
     def stop(self):
         print('Stopping CPU collector')
 
+    def checkpoint(self):
+        return tuple(self.last)
+
+    def resume(self, state):
+        self.last = self.cpu_stat(*state)
+
     def __call__(self):
-        s = self.read_cpu()
+        s = self.read_cpu(self.procfs)
         diff = sum(s) - sum(self.last)
 
         if diff <= 0:
@@ -76,7 +83,8 @@ def setup(scope):
 
     if platform.is_linux():
         registry = scope.require('registry')
-        last = LinuxCPU.verify()
-        return LinuxCPU(registry, last)
+        procfs = scope.require('procfs')
+        last = LinuxCPU.verify(procfs)
+        return LinuxCPU(registry, procfs, last)
 
     raise Exception('unsupported platform')
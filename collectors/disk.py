@@ -1,9 +1,10 @@
-import os
 import collections
 
 
 class LinuxDisk(object):
     PROC_MOUNTS = '/proc/mounts'
+    # signals changes to the mount table through poll.
+    PROC_MOUNTINFO = '/proc/self/mountinfo'
 
     MOUNT_FIELDS = [
         'fs_spec', 'fs_file', 'fs_vfstype',
@@ -20,26 +21,36 @@ class LinuxDisk(object):
     disk = collections.namedtuple('disk', DISK_FIELDS)
 
     @classmethod
-    def verify(cls):
-        if not os.path.isfile(cls.PROC_MOUNTS):
-            raise Exception('no such file: {0}'.format(cls.PROC_MOUNTS))
+    def verify(cls, procfs, fanout):
+        if not procfs.isfile(cls.PROC_MOUNTS):
+            raise Exception('no such file: {0}'.format(
+                procfs.path(cls.PROC_MOUNTS)))
 
-        return cls.read_disks()
+        mounts = cls.read_mounts(procfs)
+        return mounts, cls.read_disks(procfs, fanout, mounts)
 
     @classmethod
-    def read_disks(cls):
-        disks = list()
+    def read_disks(cls, procfs, fanout, mounts=None):
+        """
+        Read all mounted disks, where the disk is None if it could not be read
+        in time.
 
-        for m in cls.read_mounts():
-            disks.append((m.fs_spec, m.fs_file, cls.read_disk(m.fs_file)))
+        Reads the mounts unless they are given.
+        """
+        if mounts is None:
+            mounts = cls.read_mounts(procfs)
 
-        return disks
+        read = dict(fanout.map(
+            lambda m: cls.read_disk(procfs, m.fs_file), mounts,
+            key=lambda m: m.fs_file))
+
+        return [(m.fs_spec, m.fs_file, read.get(m)) for m in mounts]
 
     @classmethod
-    def read_mounts(cls):
+    def read_mounts(cls, procfs):
         mounts = list()
 
-        with open(cls.PROC_MOUNTS, 'r') as f:
+        with procfs.open(cls.PROC_MOUNTS) as f:
             for line in f:
                 m = line.strip().split()
 
@@ -59,15 +70,21 @@ class LinuxDisk(object):
         return mounts
 
     @classmethod
-    def read_disk(cls, file):
-        s = os.statvfs(file)
+    def read_disk(cls, procfs, file):
+        s = procfs.statvfs(file)
         total = s.f_frsize * s.f_blocks
         free = s.f_frsize * s.f_bfree
         avail = s.f_frsize * s.f_bavail
         rest = free - avail
         return cls.disk(total, free, avail, rest)
 
-    def __init__(self, registry, disks, reload_latch):
+    def __init__(self, registry, procfs, fanout, mounts, disks, reload_latch,
+                 watch):
+        self.procfs = procfs
+        self.fanout = fanout
+        self.watch = watch
+        # mounts as of the last change to the mount table.
+        self.mounts = mounts
         self.last = disks
         self.reload_latch = reload_latch
         self.disks = dict()
@@ -75,7 +92,7 @@ class LinuxDisk(object):
         self.last_seen = set(f for (_, f, _) in disks)
 
         for (device, f, d) in disks:
-            if d.total <= 0:
+            if d is not None and d.total <= 0:
                 continue
 
             disk = self.disks[f] = dict()
@@ -102,14 +119,21 @@ class LinuxDisk(object):
 
     def update(self, disks):
         for (device, f, d) in disks:
-            if d.total <= 0:
-                continue
-
             disk = self.disks.get(f, None)
 
             if disk is None:
                 continue
 
+            # could not be read in time.
+            if d is None:
+                for m in disk.values():
+                    m.unset()
+
+                continue
+
+            if d.total <= 0:
+                continue
+
             total = float(d.total)
             free = float(d.free)
             avail = float(d.avail)
@@ -123,9 +147,9 @@ class LinuxDisk(object):
             disk['avail-perc'].update(round(avail / total, 2))
             disk['rest-perc'].update(round(rest / total, 2))
 
-    def check_reload(self, disks):
+    def check_reload(self, mounts):
         # disk layout has change, ask to be reloaded.
-        seen = set(f for (_, f, _) in disks)
+        seen = set(m.fs_file for m in mounts)
 
         if seen != self.last_seen:
             self.reload_latch()
@@ -133,8 +157,11 @@ class LinuxDisk(object):
         self.last_seen = seen
 
     def __call__(self):
-        disks = self.read_disks()
-        self.check_reload(disks)
+        if self.watch.changed():
+            self.mounts = self.read_mounts(self.procfs)
+            self.check_reload(self.mounts)
+
+        disks = self.read_disks(self.procfs, self.fanout, self.mounts)
         self.update(disks)
 
 
@@ -145,7 +172,13 @@ def setup(scope):
 
     if platform.is_linux():
         registry = scope.require('registry')
-        disks = LinuxDisk.verify()
-        return LinuxDisk(registry, disks, reload_latch)
+        procfs = scope.require('procfs')
+        fanout = scope.require('fanout')
+        watch = procfs.watch(LinuxDisk.PROC_MOUNTINFO)
+        # the mounts are read right after, so the first change is not news.
+        watch.changed()
+        mounts, disks = LinuxDisk.verify(procfs, fanout)
+        return LinuxDisk(registry, procfs, fanout, mounts, disks,
+                         reload_latch, watch)
 
     raise Exception('unsupported platform')
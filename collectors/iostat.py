@@ -1,6 +1,4 @@
-import os
 import collections
-import time
 
 
 class LinuxIOStat(object):
@@ -12,23 +10,40 @@ class LinuxIOStat(object):
         'ios_pgr', 'tot_tics', 'rq_tics'
     ]
 
+    # tags of every metric of a device, in the order they are updated.
+    METRICS = [
+        dict(what='io-read-operations', unit='operation/s'),
+        dict(what='io-read-merges', unit='merge/s'),
+        dict(what='io-read-bytes', unit='B/s'),
+        dict(what='io-read-sectors', unit='sector/s'),
+        dict(what='io-read-await', unit='ms'),
+        dict(what='io-write-operations', unit='operation/s'),
+        dict(what='io-write-merges', unit='merge/s'),
+        dict(what='io-write-bytes', unit='B/s'),
+        dict(what='io-write-sectors', unit='sector/s'),
+        dict(what='io-write-await', unit='ms'),
+        dict(what='io-average-queue-size', unit='operation/s'),
+        dict(what='io-utilization', unit='%'),
+    ]
+
     # skip ram=1, and loop=7
     SKIP_MAJOR = set([1, 7])
 
     disk = collections.namedtuple('disk', DISK_STAT_FIELDS)
 
     @classmethod
-    def verify(cls):
-        if not os.path.isfile(cls.PROC_DISKSTATS):
-            raise Exception('no such file: {0}'.format(cls.PROC_DISKSTATS))
+    def verify(cls, procfs):
+        if not procfs.isfile(cls.PROC_DISKSTATS):
+            raise Exception('no such file: {0}'.format(
+                procfs.path(cls.PROC_DISKSTATS)))
 
-        return cls.read_disks()
+        return cls.read_disks(procfs)
 
     @classmethod
-    def read_disks(cls):
+    def read_disks(cls, procfs):
         disks = dict()
 
-        with open(cls.PROC_DISKSTATS, 'r') as f:
+        with procfs.open(cls.PROC_DISKSTATS) as f:
             for line in f:
                 line = line.strip()
                 parts = line.split()
@@ -47,44 +62,15 @@ class LinuxIOStat(object):
 
         return disks
 
-    def __init__(self, registry, last, reload_latch):
-        self.iostats = dict()
+    def __init__(self, registry, procfs, last, reload_latch):
+        self.procfs = procfs
         self.reload_latch = reload_latch
-
-        for device in last.keys():
-            io = self.iostats[device] = dict()
-
-            reg = registry.scoped(device=device)
-
-            io['rd-op'] = reg.metric(
-                what='io-read-operations', unit='operation/s')
-            io['rd-merges'] = reg.metric(
-                what='io-read-merges', unit='merge/s')
-            io['rd-bytes'] = reg.metric(
-                what='io-read-bytes', unit='B/s')
-            io['rd-sectors'] = reg.metric(
-                what='io-read-sectors', unit='sector/s')
-            io['rd-await'] = reg.metric(
-                what='io-read-await', unit='ms')
-
-            io['wr-op'] = reg.metric(
-                what='io-write-operations', unit='operation/s')
-            io['wr-merges'] = reg.metric(
-                what='io-write-merges', unit='merge/s')
-            io['wr-bytes'] = reg.metric(
-                what='io-write-bytes', unit='B/s')
-            io['wr-sectors'] = reg.metric(
-                what='io-write-sectors', unit='sector/s')
-            io['wr-await'] = reg.metric(
-                what='io-write-await', unit='ms')
-
-            io['avqz'] = reg.metric(
-                what='io-average-queue-size', unit='operation/s')
-            io['util'] = reg.metric(
-                what='io-utilization', unit='%')
+        self.devices = sorted(last.keys())
+        self.iostats = registry.vector(
+            dict(device=self.devices, what=self.METRICS))
 
         self.last_seen = set(last.keys())
-        self.last_time = time.time()
+        self.last_time = procfs.time()
         self.last = last
 
     def check_reload(self, disks):
@@ -96,44 +82,48 @@ class LinuxIOStat(object):
         self.last_seen = seen
 
     def update(self, disks):
-        now = time.time()
+        now = self.procfs.time()
         diff = now - self.last_time
         self.last_time = now
 
         # not valid values can be set
         if diff <= 0:
-            for io in self.iostats.values():
-                for m in io.values():
-                    m.unset()
-
+            self.iostats.unset()
             return
 
-        for device, a in disks.items():
-            io = self.iostats.get(device, None)
+        values = list()
+
+        for device in self.devices:
+            a = disks.get(device)
             b = self.last.get(device)
 
-            if io is None or b is None:
+            if a is None or b is None:
+                values.extend([float('NaN')] * len(self.METRICS))
                 continue
 
             d = self.disk(*[(av - bv) / diff for av, bv in zip(a, b)])
 
-            io['rd-op'].update(d.rd_ios)
-            io['rd-merges'].update(d.rd_merges)
-            io['rd-bytes'].update(d.rd_sectors * 512)
-            io['rd-sectors'].update(d.rd_sectors)
-            io['rd-await'].update(d.rd_ios)
+            values.extend([
+                d.rd_ios, d.rd_merges, d.rd_sectors * 512, d.rd_sectors,
+                d.rd_ios,
+                d.wr_ios, d.wr_merges, d.wr_sectors * 512, d.wr_sectors,
+                d.wr_ios,
+                d.rq_tics, round(d.tot_tics / 1000, 2),
+            ])
+
+        self.iostats.update(values)
 
-            io['wr-op'].update(d.wr_ios)
-            io['wr-merges'].update(d.wr_merges)
-            io['wr-bytes'].update(d.wr_sectors * 512)
-            io['wr-sectors'].update(d.wr_sectors)
-            io['wr-await'].update(d.wr_ios)
+    def checkpoint(self):
+        last = dict((device, tuple(d)) for device, d in self.last.items())
+        return dict(last=last, last_time=self.last_time)
 
-            io['avqz'].update(d.rq_tics)
-            io['util'].update(round(d.tot_tics / 1000, 2))
+    def resume(self, state):
+        self.last = dict((device, self.disk(*d))
+                         for device, d in state['last'].items())
+        self.last_time = state['last_time']
 
     def __call__(self):
-        disks = self.read_disks()
+        disks = self.read_disks(self.procfs)
         self.check_reload(disks)
         self.update(disks)
         self.last = disks
@@ -146,7 +136,8 @@ def setup(scope):
 
     if platform.is_linux():
         registry = scope.require('registry')
-        last = LinuxIOStat.verify()
-        return LinuxIOStat(registry, last, reload_latch)
+        procfs = scope.require('procfs')
+        last = LinuxIOStat.verify(procfs)
+        return LinuxIOStat(registry, procfs, last, reload_latch)
 
     raise Exception('unsupported platform')
@@ -1,4 +1,3 @@
-import os
 import collections
 
 
@@ -10,17 +9,18 @@ class LinuxLoadAvg(object):
     loadavg = collections.namedtuple('loadavg', FIELDS)
 
     @classmethod
-    def verify(cls):
-        if not os.path.isfile(cls.PROC_LOADAVG):
-            raise Exception('no such file: {0}'.format(cls.PROC_LOADAVG))
+    def verify(cls, procfs):
+        if not procfs.isfile(cls.PROC_LOADAVG):
+            raise Exception('no such file: {0}'.format(
+                procfs.path(cls.PROC_LOADAVG)))
 
-        return cls.read_loadavg()
+        return cls.read_loadavg(procfs)
 
     @classmethod
-    def read_loadavg(cls):
+    def read_loadavg(cls, procfs):
         first = None
 
-        with open(cls.PROC_LOADAVG, 'r') as f:
+        with procfs.open(cls.PROC_LOADAVG) as f:
             first = f.readline().strip()
 
         p = first.split()
@@ -30,13 +30,14 @@ class LinuxLoadAvg(object):
 
         return cls.loadavg(float(p[0]), float(p[1]), float(p[2]), p[3], p[4])
 
-    def __init__(self, registry):
+    def __init__(self, registry, procfs):
+        self.procfs = procfs
         self.load1 = registry.metric(what='loadavg-1m')
         self.load5 = registry.metric(what='loadavg-5m')
         self.load10 = registry.metric(what='loadavg-10m')
 
     def __call__(self):
-        l = self.read_loadavg()
+        l = self.read_loadavg(self.procfs)
         self.load1.update(l.load1)
         self.load5.update(l.load5)
         self.load10.update(l.load10)
@@ -47,7 +48,8 @@ def setup(scope):
 
     if platform.is_linux():
         registry = scope.require('registry')
-        LinuxLoadAvg.verify()
-        return LinuxLoadAvg(registry)
+        procfs = scope.require('procfs')
+        LinuxLoadAvg.verify(procfs)
+        return LinuxLoadAvg(registry, procfs)
 
     raise Exception('unsupported platform')
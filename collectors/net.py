@@ -0,0 +1,299 @@
+"""
+Socket and interface statistics, read from the kernel over netlink.
+
+Socket states are counted through NETLINK_SOCK_DIAG, and interface counters are
+read as rtnl_link_stats64 through RTM_GETLINK. Replies are decoded straight
+from the receive buffer, without building any text to parse.
+"""
+import os
+import time
+import socket
+import struct
+
+NETLINK_ROUTE = 0
+NETLINK_SOCK_DIAG = 4
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+RTM_GETLINK = 18
+SOCK_DIAG_BY_FAMILY = 20
+
+IFLA_IFNAME = 3
+IFLA_STATS64 = 23
+
+NLMSGHDR = struct.Struct('=IHHII')
+NLMSGERR = struct.Struct('=i')
+RTATTR = struct.Struct('=HH')
+# struct ifinfomsg
+IFINFOMSG = struct.Struct('=BxHiII')
+# struct inet_diag_req_v2, with an empty inet_diag_sockid.
+INET_DIAG_REQ_V2 = struct.Struct('=BBBxI48x')
+# source port in struct inet_diag_msg.
+INET_DIAG_SPORT = struct.Struct('!H')
+# the first counters of struct rtnl_link_stats64.
+STATS64 = struct.Struct('=8Q')
+
+# size of the receive buffer, which bounds the size of a single read.
+BUFFER_SIZE = 256 * 1024
+
+
+class NetlinkException(Exception):
+    pass
+
+
+class Netlink(object):
+    """
+    A netlink socket used for dump requests.
+
+    The socket is opened on first use, so that it belongs to the process using
+    it.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self._sock = None
+        self._seq = 0
+        self._buffer = bytearray(BUFFER_SIZE)
+
+    def dump(self, t, payload):
+        """
+        Generate (type, payload) for every message in reply to a dump request.
+
+        payload is a memoryview into the receive buffer, which is only valid
+        until the next message is generated.
+        """
+        sock = self._socket()
+        self._seq = (self._seq + 1) % 2 ** 32
+        seq = self._seq
+
+        sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), t,
+                                NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+
+        buf = self._buffer
+        view = memoryview(buf)
+
+        while True:
+            n = sock.recv_into(buf)
+            o = 0
+
+            while o + NLMSGHDR.size <= n:
+                length, mtype, _, mseq, _ = NLMSGHDR.unpack_from(buf, o)
+
+                if length < NLMSGHDR.size or o + length > n:
+                    raise NetlinkException('truncated message')
+
+                # replies to an earlier request which was abandoned.
+                if mseq == seq:
+                    if mtype == NLMSG_DONE:
+                        return
+
+                    if mtype == NLMSG_ERROR:
+                        error, = NLMSGERR.unpack_from(buf, o + NLMSGHDR.size)
+
+                        if error != 0:
+                            raise OSError(-error, os.strerror(-error))
+                    else:
+                        yield mtype, view[o + NLMSGHDR.size:o + length]
+
+                o += (length + 3) & ~3
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _socket(self):
+        if self._sock is None:
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, self.protocol)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, BUFFER_SIZE)
+            sock.bind((0, 0))
+            self._sock = sock
+
+        return self._sock
+
+
+class LinuxNet(object):
+    TCP_STATES = [
+        'established', 'syn-sent', 'syn-recv', 'fin-wait1', 'fin-wait2',
+        'time-wait', 'close', 'close-wait', 'last-ack', 'listen', 'closing',
+        'new-syn-recv',
+    ]
+
+    # tags of every metric of an interface, in the order of STATS64.
+    LINK_METRICS = [
+        dict(what='net-received-packets', unit='packet/s'),
+        dict(what='net-transmitted-packets', unit='packet/s'),
+        dict(what='net-received-bytes', unit='B/s'),
+        dict(what='net-transmitted-bytes', unit='B/s'),
+        dict(what='net-received-errors', unit='error/s'),
+        dict(what='net-transmitted-errors', unit='error/s'),
+        dict(what='net-received-dropped', unit='packet/s'),
+        dict(what='net-transmitted-dropped', unit='packet/s'),
+    ]
+
+    @classmethod
+    def read_links(cls, route):
+        """
+        Read the counters of every interface, by name.
+        """
+        links = dict()
+        request = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+
+        for _, m in route.dump(RTM_GETLINK, request):
+            name = None
+            stats = None
+            o = IFINFOMSG.size
+
+            while o + RTATTR.size <= len(m):
+                length, t = RTATTR.unpack_from(m, o)
+
+                if length < RTATTR.size:
+                    break
+
+                if t == IFLA_IFNAME:
+                    name = bytes(m[o + RTATTR.size:o + length]).rstrip(
+                        b'\0').decode('utf-8')
+                elif t == IFLA_STATS64:
+                    stats = STATS64.unpack_from(m, o + RTATTR.size)
+
+                o += (length + 3) & ~3
+
+            if name is not None and stats is not None:
+                links[name] = stats
+
+        return links
+
+    @classmethod
+    def count_sockets(cls, diag, ports):
+        """
+        Count TCP sockets by state, and by state for every local port in
+        ports, which maps ports to their position.
+
+        Returns a flat list of counts with one row of states in total, and one
+        row for every port.
+        """
+        width = len(cls.TCP_STATES)
+        counts = [0] * (width * (1 + len(ports)))
+
+        for family in (socket.AF_INET, socket.AF_INET6):
+            request = INET_DIAG_REQ_V2.pack(
+                family, socket.IPPROTO_TCP, 0, 0xffffffff)
+
+            for _, m in diag.dump(SOCK_DIAG_BY_FAMILY, request):
+                state = m[1] - 1
+
+                if state < 0 or state >= width:
+                    continue
+
+                counts[state] += 1
+
+                if ports:
+                    p = ports.get(INET_DIAG_SPORT.unpack_from(m, 4)[0])
+
+                    if p is not None:
+                        counts[width * (1 + p) + state] += 1
+
+        return counts
+
+    def __init__(self, registry, links, ports, reload_latch):
+        self.route = Netlink(NETLINK_ROUTE)
+        self.diag = Netlink(NETLINK_SOCK_DIAG)
+        self.reload_latch = reload_latch
+        self.ports = dict((port, i) for i, port in enumerate(ports))
+
+        self.sockets = registry.vector(
+            dict(state=self.TCP_STATES), what='tcp-sockets', unit='socket')
+        self.port_sockets = None
+
+        if ports:
+            self.port_sockets = registry.vector(
+                dict(port=[str(p) for p in ports], state=self.TCP_STATES),
+                what='tcp-sockets', unit='socket')
+
+        self.names = sorted(links.keys())
+        self.links = registry.vector(
+            dict(interface=self.names, what=self.LINK_METRICS))
+
+        self.last_seen = set(self.names)
+        self.last_time = time.time()
+        self.last = links
+
+    def stop(self):
+        self.route.close()
+        self.diag.close()
+
+    def check_reload(self, links):
+        seen = set(links.keys())
+
+        if seen != self.last_seen:
+            self.reload_latch()
+
+        self.last_seen = seen
+
+    def update_links(self, links):
+        now = time.time()
+        diff = now - self.last_time
+        self.last_time = now
+
+        if diff <= 0:
+            self.links.unset()
+            return
+
+        values = list()
+
+        for name in self.names:
+            a = links.get(name)
+            b = self.last.get(name)
+
+            if a is None or b is None:
+                values.extend([float('NaN')] * len(self.LINK_METRICS))
+                continue
+
+            values.extend((av - bv) / diff for av, bv in zip(a, b))
+
+        self.links.update(values)
+
+    def checkpoint(self):
+        return dict(last=self.last, last_time=self.last_time)
+
+    def resume(self, state):
+        self.last = state['last']
+        self.last_time = state['last_time']
+
+    def __call__(self):
+        counts = self.count_sockets(self.diag, self.ports)
+        width = len(self.TCP_STATES)
+        self.sockets.update(counts[:width])
+
+        if self.port_sockets is not None:
+            self.port_sockets.update(counts[width:])
+
+        links = self.read_links(self.route)
+        self.check_reload(links)
+        self.update_links(links)
+        self.last = links
+
+
+def setup(scope):
+    config = scope.require('config')
+    platform = scope.require('platform')
+    reload_latch = scope.require('reload')
+
+    if platform.is_linux():
+        registry = scope.require('registry')
+        ports = [int(p) for p in config.get('ports', [])]
+
+        route = Netlink(NETLINK_ROUTE)
+
+        try:
+            links = LinuxNet.read_links(route)
+        finally:
+            route.close()
+
+        return LinuxNet(registry, links, ports, reload_latch)
+
+    raise Exception('unsupported platform')
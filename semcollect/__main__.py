@@ -67,6 +67,13 @@ def setup_parser(root):
         default=10.0,
         type=float)
 
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        help="Run the main loop on asyncio",
+        default=False,
+        action='store_true')
+
     parser.add_argument(
         "--debug",
         dest="level",
@@ -97,6 +104,15 @@ def main(args):
 
     log.info("pid=%d", os.getpid())
 
+    if ns.use_async:
+        from semcollect.aio import AsyncCore
+
+        core = AsyncCore(timeout=ns.timeout, interval=ns.interval,
+                         backoff=ns.backoff, config=ns.config,
+                         collectors=ns.collectors)
+        core.setup()
+        return core.run()
+
     core = Core(timeout=ns.timeout, interval=ns.interval, backoff=ns.backoff,
                 config=ns.config, collectors=ns.collectors)
     core.setup()
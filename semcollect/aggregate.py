@@ -0,0 +1,271 @@
+"""
+Aggregation stage, which rolls up and downsamples series before they are
+handed to outputs.
+
+Every rule matches a set of metrics by tags, optionally transforms each series
+into a rate or a delta, and pools the values of every group (as determined by
+the 'by' tags) over a window of collections.
+When the window is complete, every configured function is applied to the pool
+and emitted as a new series, tagged with the tags common to all series in the
+group and 'aggregate' set to the name of the function.
+
+Which series belong to which group only depends on the layout of the batch,
+so it is computed once per layout; every collection is then only a matter of
+picking values by position. State kept for groups and series which are no
+longer in the batch is dropped whenever the layout changes, so that series
+coming and going does not grow it without bound.
+"""
+import math
+import itertools
+
+from .registry import Registry, next_layout, match_tags
+from .pipeline import Batch
+
+NaN = float('NaN')
+
+# ids of aggregated series are allocated from here, to keep them apart from
+# the ids of the registry.
+AGGREGATE_ID_BASE = 2 ** 31
+
+
+def _sum(values):
+    if len(values) == 0:
+        return NaN
+
+    return float(sum(values))
+
+
+def _avg(values):
+    if len(values) == 0:
+        return NaN
+
+    return sum(values) / float(len(values))
+
+
+def _min(values):
+    if len(values) == 0:
+        return NaN
+
+    return float(min(values))
+
+
+def _max(values):
+    if len(values) == 0:
+        return NaN
+
+    return float(max(values))
+
+
+def _count(values):
+    return float(len(values))
+
+
+def percentile(q):
+    """
+    Build a function calculating the q:th percentile, with linear
+    interpolation between the closest ranks.
+    """
+    def _p(values):
+        if len(values) == 0:
+            return NaN
+
+        values = sorted(values)
+        rank = (len(values) - 1) * q / 100.0
+        lo = int(math.floor(rank))
+        hi = min(lo + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (rank - lo)
+
+    return _p
+
+
+FUNCTIONS = dict(sum=_sum, avg=_avg, min=_min, max=_max, count=_count)
+
+
+def function(name):
+    f = FUNCTIONS.get(name)
+
+    if f is not None:
+        return f
+
+    return percentile(float(name[1:]))
+
+
+class Aggregator(object):
+    class Rule(object):
+        def __init__(self, config):
+            self.match = dict(
+                (k, str(v)) for k, v in config.match.items())
+            self.by = config.by
+            self.functions = [(str(f), function(str(f)))
+                              for f in config.functions]
+            self.window = config.window
+            self.transform = config.transform
+            self.keep = config.keep
+            # list of (key, tags, positions), computed per layout.
+            self.groups = list()
+            # pool of values per group key for the current window.
+            self.pools = dict()
+            # last (time, value) for every series id, used by transforms.
+            self.last = dict()
+            self.ticks = 0
+
+        def matches(self, kind, tags):
+            return kind == Registry.METRIC and match_tags(self.match, tags)
+
+        def key(self, n, tags):
+            if self.by is None:
+                return (n,)
+
+            return tuple(tags.get(k) for k in self.by)
+
+        def regroup(self, series):
+            groups = dict()
+
+            for i, (n, kind, tags, _) in enumerate(series):
+                if not self.matches(kind, tags):
+                    continue
+
+                key = self.key(n, tags)
+                group = groups.get(key)
+
+                if group is None:
+                    groups[key] = (dict(tags), [i])
+                    continue
+
+                common, positions = group
+                positions.append(i)
+
+                for k, v in list(common.items()):
+                    if tags.get(k) != v:
+                        del common[k]
+
+            self.groups = [(key, common, positions)
+                           for key, (common, positions) in groups.items()]
+
+            # forget groups and series which are gone.
+            ids = set(series[i][0] for _, _, positions in self.groups
+                      for i in positions)
+            self.last = dict((n, v) for n, v in self.last.items()
+                             if n in ids)
+            self.pools = dict((k, p) for k, p in self.pools.items()
+                              if k in groups)
+
+        def feed(self, series, stale, now):
+            for key, _, positions in self.groups:
+                # stale values are left out, since they were already pooled.
+                if len(stale) > 0:
+                    positions = [i for i in positions
+                                 if series[i][0] not in stale]
+
+                if self.transform is None:
+                    values = [series[i][3] for i in positions]
+                else:
+                    values = self._transform(series, positions, now)
+
+                pool = self.pools.setdefault(key, [])
+                pool.extend(v for v in values if not math.isnan(v))
+
+            self.ticks += 1
+
+        def ready(self):
+            return self.ticks % self.window == 0
+
+        def emit(self, ids):
+            for key, tags, _ in self.groups:
+                pool = self.pools.get(key, [])
+
+                for name, f in self.functions:
+                    t = dict(tags)
+                    t['aggregate'] = name
+                    yield ids(self, key, name), Registry.METRIC, t, f(pool)
+
+            self.pools = dict()
+
+        def _transform(self, series, positions, now):
+            values = list()
+
+            for i in positions:
+                n = series[i][0]
+                v = series[i][3]
+                last = self.last.get(n)
+                self.last[n] = (now, v)
+
+                if last is None:
+                    continue
+
+                then, before = last
+
+                if self.transform == 'delta':
+                    values.append(v - before)
+                    continue
+
+                if now <= then:
+                    continue
+
+                values.append((v - before) / (now - then))
+
+            return values
+
+    def __init__(self, configs):
+        self._rules = [Aggregator.Rule(c) for c in configs]
+        self._ids = dict()
+        self._next_id = itertools.count(AGGREGATE_ID_BASE)
+        self._layout = None
+        self._passthrough = None
+        # layouts of the emitted batches, by input layout and emitting rules.
+        self._layouts = dict()
+
+    def __call__(self, batch):
+        series = batch.series
+
+        if batch.layout != self._layout:
+            self._regroup(series)
+            self._layout = batch.layout
+
+        out = [series[i] for i in self._passthrough]
+        emitting = list()
+
+        for i, rule in enumerate(self._rules):
+            rule.feed(series, batch.stale, batch.time)
+
+            if rule.ready():
+                out.extend(rule.emit(self._id))
+                emitting.append(i)
+
+        key = (batch.layout, tuple(emitting))
+        layout = self._layouts.get(key)
+
+        if layout is None:
+            layout = self._layouts[key] = next_layout()
+
+        return Batch(batch.time, layout, out, batch.full, batch.stale)
+
+    def _regroup(self, series):
+        dropped = set()
+
+        for rule in self._rules:
+            rule.regroup(series)
+
+            if rule.keep:
+                continue
+
+            for _, _, positions in rule.groups:
+                dropped.update(positions)
+
+        self._passthrough = [i for i in range(len(series))
+                             if i not in dropped]
+        self._layouts = dict()
+
+        live = set((id(rule), key) for rule in self._rules
+                   for key, _, _ in rule.groups)
+        self._ids = dict((k, n) for k, n in self._ids.items()
+                         if k[:2] in live)
+
+    def _id(self, rule, key, name):
+        k = (id(rule), key, name)
+        n = self._ids.get(k)
+
+        if n is None:
+            n = self._ids[k] = next(self._next_id)
+
+        return n
@@ -0,0 +1,436 @@
+"""
+A Core driven by asyncio.
+
+Collection results arrive over a pipe which is registered as a reader on the
+event loop, signals are handled through the loop, and the scheduler, the
+collector health checks and the query endpoint all run as tasks on the same
+loop.
+
+The pipeline runs on a thread of its own, so that slow stages or outputs never
+hold up the loop. A batch is dropped if the last one is still being emitted.
+Outputs with sockets of their own are serviced on the same thread.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import logging
+import multiprocessing as mp
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .core import Core, TASK_MOD, STARTING_POLL, poll
+from .query import QueryException, MAX_REQUEST
+from .relay import RelayException, parse_address
+
+log = logging.getLogger(__name__)
+
+
+class ResultPipe(object):
+    """
+    Carries collection results from collector processes to the main process.
+
+    Has the same #put method as a queue, so it can be handed to collectors in
+    place of one. Results are small enough that every write is atomic, so the
+    writing end can be shared by all collector processes.
+    """
+    def __init__(self):
+        self._reader, self._writer = mp.Pipe(False)
+
+    def put(self, item):
+        self._writer.send(item)
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def drain(self):
+        while self._reader.poll():
+            yield self._reader.recv()
+
+
+class AsyncCore(Core):
+    def __init__(self, **kw):
+        super(AsyncCore, self).__init__(**kw)
+        self._out = ResultPipe()
+        # task id to (collector, future) for the current collection.
+        self._pending = dict()
+        self._loop = None
+        self._stopped = None
+        self._wakeup = None
+        # held while collecting, so that collections never overlap.
+        self._collecting = None
+        # writers of connected downstream agents.
+        self._relay_clients = set()
+        self._reload_requested = False
+        # runs the pipeline, one batch at a time.
+        self._emitter = None
+        # future of the batch being emitted.
+        self._emitting = None
+        # future of the outputs being serviced.
+        self._servicing = None
+
+    def run(self):
+        asyncio.run(self.main())
+        return 0
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self._stopped = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._collecting = asyncio.Lock()
+        self._emitter = ThreadPoolExecutor(1)
+
+        loop.add_signal_handler(signal.SIGHUP, self._request_reload)
+        loop.add_signal_handler(signal.SIGTERM, self._stopped.set)
+        loop.add_reader(self._out.fileno(), self._on_results)
+
+        server = None
+
+        if self._query is not None:
+            if os.path.exists(self._query.path):
+                os.unlink(self._query.path)
+
+            server = await asyncio.start_unix_server(
+                self._on_query, path=self._query.path, limit=MAX_REQUEST)
+            log.info('query: listening on %s', self._query.path)
+
+        relay = None
+
+        if self._relay_server is not None:
+            relay = await self._serve_relay()
+
+        tasks = [loop.create_task(self._schedule()),
+                 loop.create_task(self._check())]
+
+        await self._stopped.wait()
+
+        for t in tasks:
+            t.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._flush()
+        self._emitter.shutdown()
+
+        loop.remove_reader(self._out.fileno())
+        loop.remove_signal_handler(signal.SIGHUP)
+        loop.remove_signal_handler(signal.SIGTERM)
+
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+            if os.path.exists(self._query.path):
+                os.unlink(self._query.path)
+
+        if relay is not None:
+            relay.close()
+
+            # lets the connection handlers see end of stream and return.
+            for writer in list(self._relay_clients):
+                writer.close()
+
+            await relay.wait_closed()
+            await asyncio.sleep(0)
+
+            family, addr = parse_address(self._relay_server.address)
+
+            if family == socket.AF_UNIX and os.path.exists(addr):
+                os.unlink(addr)
+
+        self.stop()
+
+    async def collect_all_async(self, collectors=None):
+        full = collectors is None
+        now = time.time()
+
+        if full:
+            self.poll_starting()
+            collectors = self._collectors
+            self._procfs.tick()
+            self._registry.advance()
+
+        waiting = dict()
+        timeout = 0
+
+        for c in collectors:
+            if self.starting(c):
+                continue
+
+            if full and not self.due(c, now, self._interval / 2):
+                continue
+
+            if self.is_shed(c):
+                log.debug('%s: shed', c)
+                continue
+
+            if c.busy() and c.skip():
+                continue
+
+            if c.throttled():
+                log.debug('%s: throttled', c)
+                continue
+
+            i = self._taskid
+            self._taskid = (self._taskid + 1) % TASK_MOD
+
+            try:
+                c.collect(i)
+            except Exception:
+                log.error('%s: failed to collect', c, exc_info=sys.exc_info())
+                continue
+
+            f = self._loop.create_future()
+            self._pending[i] = (c, f)
+            waiting[f] = (i, c)
+            timeout = max(timeout, c.timeout_after(self._timeout))
+
+        if len(waiting) == 0:
+            return
+
+        done, _ = await asyncio.wait(list(waiting), timeout=timeout)
+
+        for f, (i, c) in waiting.items():
+            self._pending.pop(i, None)
+
+            if f not in done:
+                log.warn('%s: timeout (task %d)', c, i)
+                c.timeout(i)
+                continue
+
+            c.done(*f.result())
+
+        self._update_first_samples()
+        self._update_usage()
+
+    async def collect_started_async(self):
+        started = self.poll_starting()
+
+        if len(started) == 0:
+            return
+
+        # see Core#collect_started.
+        await self.collect_all_async(started)
+
+    def _emit(self):
+        # stages keep state between batches, so they must see them in order.
+        if self._emitting is not None and not self._emitting.done():
+            log.warn('pipeline: still busy, dropping batch')
+            return
+
+        pipeline = self._pipeline
+        batch = pipeline.batch(self._registry, time.time())
+
+        if batch is None:
+            return
+
+        self._emitting = self._loop.run_in_executor(
+            self._emitter, pipeline.emit, batch)
+        self._emitting.add_done_callback(self._on_emitted)
+
+    def _on_emitted(self, f):
+        if not f.cancelled() and f.exception() is not None:
+            log.error('pipeline: failed', exc_info=f.exception())
+
+    def _service_outputs(self):
+        """
+        Service the sockets of outputs, on the thread which emits batches so
+        that outputs are never used from two threads at once.
+        """
+        if self._servicing is not None and not self._servicing.done():
+            return
+
+        servers = self._pipeline.servers()
+
+        if len(servers) == 0:
+            return
+
+        self._servicing = self._loop.run_in_executor(
+            self._emitter, poll, servers, 0)
+        self._servicing.add_done_callback(self._on_emitted)
+
+    async def _flush(self):
+        """
+        Wait for the batch being emitted, if any.
+        """
+        pending = [f for f in (self._emitting, self._servicing)
+                   if f is not None]
+
+        if len(pending) > 0:
+            await asyncio.wait(pending)
+
+    def _start_query(self):
+        # served by the event loop instead, see #main.
+        pass
+
+    def _start_relay(self):
+        # served by the event loop instead, see #main.
+        pass
+
+    async def _serve_relay(self):
+        address = self._relay_server.address
+        family, addr = parse_address(address)
+
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)
+
+            server = await asyncio.start_unix_server(self._on_relay, path=addr)
+        else:
+            host, port = addr
+            server = await asyncio.start_server(
+                self._on_relay, host, port, reuse_address=True)
+
+        log.info('relay: listening on %s', address)
+        return server
+
+    async def _on_relay(self, reader, writer):
+        stream = self._relay.stream()
+        self._relay_clients.add(writer)
+
+        try:
+            while True:
+                data = await reader.read(65536)
+
+                if len(data) == 0:
+                    break
+
+                stream.feed(data)
+        except RelayException as e:
+            log.warn('relay: dropping connection: %s', e)
+        except ConnectionError:
+            pass
+        finally:
+            self._relay_clients.discard(writer)
+            writer.close()
+
+    def _request_reload(self):
+        self._reload_requested = True
+        self._wakeup.set()
+
+    def _on_results(self):
+        for i, ok, cpu in self._out.drain():
+            pending = self._pending.get(i)
+
+            if pending is None:
+                if self._scheduler.pipelined:
+                    self._finished(i, ok, cpu)
+                else:
+                    self._late(i, ok, cpu)
+
+                continue
+
+            _, f = pending
+
+            if not f.done():
+                f.set_result((ok, cpu))
+
+    async def _schedule(self):
+        while True:
+            if self._reload_requested:
+                self._reload_requested = False
+                # the pipeline is stopped on reload.
+                await self._flush()
+                self.reload()
+
+            if self._scheduler.pipelined:
+                await self._round()
+                continue
+
+            started = self._loop.time()
+            next_run = started + self._interval
+
+            async with self._collecting:
+                await self.collect_all_async()
+                self._registry.harvest()
+                self._registry.sync()
+                self._emit()
+
+            delay = next_run - self._loop.time()
+
+            if delay > 0:
+                self.restore(self._loop.time() - started)
+            elif self.shed_more():
+                log.warn("Run took %0.2fs too long :(", -delay)
+                delay = 0
+            else:
+                log.warn("Run took %0.2fs too long :(, sleeping %ds",
+                         -delay, self._backoff)
+                delay = self._backoff
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+
+    async def _round(self):
+        """
+        Run a single round in pipelined mode, see Core#run_round.
+        """
+        next_round = time.time() + self._interval
+
+        self.begin_round()
+
+        while not self._reload_requested:
+            now = time.time()
+            self.dispatch(now)
+            self.expire(now)
+
+            if now >= next_round:
+                break
+
+            # results are taken by #_on_results as they arrive.
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), self.wake_after(now, next_round))
+            except asyncio.TimeoutError:
+                pass
+
+            self._wakeup.clear()
+
+        if self._reload_requested:
+            return
+
+        self.end_round()
+
+    async def _check(self):
+        while True:
+            await asyncio.sleep(
+                STARTING_POLL if len(self._starting) > 0 else 1.0)
+
+            self._service_outputs()
+
+            if self._scheduler.pipelined:
+                self.check_collectors()
+                continue
+
+            async with self._collecting:
+                await self.collect_started_async()
+
+            # collectors are not touched while a collection is in progress.
+            if len(self._pending) == 0:
+                self.check_collectors()
+
+    async def _on_query(self, reader, writer):
+        try:
+            line = await reader.readline()
+
+            try:
+                response = self._query.handle(line.decode('utf-8'))
+            except QueryException as e:
+                response = 'error: {0}\n'.format(e).encode('utf-8')
+            except:
+                log.error('query: failed to handle request',
+                          exc_info=sys.exc_info())
+                response = b'error: internal error\n'
+
+            writer.write(response)
+            await writer.drain()
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,200 @@
+"""
+A file-mapped arena for the columns of the registry.
+
+With a registry file configured (preferably on a tmpfs like /dev/shm or /run),
+every column of the registry is kept in a shared mapping of that file instead
+of anonymous shared memory. When the agent starts, or is reloaded, it reads
+the last known value of every series from the existing file and starts over
+with a fresh file which replaces it, so that a series which is registered
+again starts out with its last known value instead of nothing.
+
+The file is laid out as follows, all in native byte order:
+
+    header:    magic (4s), version (I), sequence (Q), generation (Q),
+               data offset (Q), data size (Q), directory offset (Q),
+               directory size (Q), directory length (Q)
+    data:      chunks of series, see below.
+    directory: JSON of {"chunks": [[offset, size], ...],
+                        "series": [[id, chunk, slot, kind, tags], ...]}
+
+Every chunk of size series has the columns ids (q), values (d) and
+generations (Q), followed by kinds (b) and states (b), each column being
+contiguous. A slot with a kind of -1 is free.
+
+The directory is rewritten whenever the set of series has changed. The
+sequence is odd while it is being written, and a reader should read it again
+if the sequence was odd or changed while reading it.
+"""
+import os
+import json
+import mmap
+import ctypes
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SCRA'
+VERSION = 1
+
+HEADER = struct.Struct('=4sIQQQQQQQ')
+HEADER_SIZE = 128
+SEQUENCE_OFFSET = 8
+GENERATION_OFFSET = 16
+
+# bytes of every series in the data section.
+SERIES_SIZE = 8 + 8 + 8 + 1 + 1
+# bytes of directory reserved for every series of capacity.
+DIRECTORY_SERIES_SIZE = 256
+
+
+def align(n):
+    return (n + 7) & ~7
+
+
+def series_key(kind, tags):
+    """
+    Key identifying a series across restarts.
+    """
+    return json.dumps([kind, sorted(tags.items())], default=str)
+
+
+def read_arena(path):
+    """
+    Read the last known values of every series in the arena at path, as a
+    dict of series_key to value, and the generation it was at.
+
+    Returns an empty dict if there is no usable arena.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return dict(), 0
+
+    if len(data) < HEADER.size:
+        return dict(), 0
+
+    (magic, version, sequence, generation, _, _, directory_offset, _,
+     directory_length) = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC or version != VERSION:
+        log.warn('%s: not a registry file, ignoring it', path)
+        return dict(), 0
+
+    # crashed while the directory was being written.
+    if sequence % 2 == 1 or directory_length == 0:
+        return dict(), generation
+
+    try:
+        directory = json.loads(data[directory_offset:
+                                    directory_offset + directory_length])
+    except ValueError:
+        return dict(), generation
+
+    chunks = directory['chunks']
+    values = dict()
+
+    for _, c, slot, kind, tags in directory['series']:
+        offset, size = chunks[c]
+
+        if kind == 0:
+            value, = struct.unpack_from(
+                '=d', data, offset + 8 * size + 8 * slot)
+        else:
+            value = data[offset + 24 * size + size + slot] == 1
+
+        values[series_key(kind, tags)] = value
+
+    return values, generation
+
+
+class Arena(object):
+    def __init__(self, path, capacity):
+        self.path = path
+        self.previous, generation = read_arena(path)
+
+        # every chunk is aligned, which wastes at most 7 bytes.
+        data_size = capacity * (SERIES_SIZE + 8)
+        directory_size = capacity * DIRECTORY_SERIES_SIZE
+        size = HEADER_SIZE + data_size + directory_size
+
+        tmp = '{0}.{1}'.format(path, os.getpid())
+
+        with open(tmp, 'wb+') as f:
+            f.truncate(size)
+            self._mmap = mmap.mmap(f.fileno(), size)
+
+        self._data_offset = HEADER_SIZE
+        self._data_end = HEADER_SIZE + data_size
+        self._directory_offset = self._data_end
+        self._directory_size = directory_size
+        self._next = self._data_offset
+        self._capacity = capacity
+        self._used = 0
+        # (offset, size) of every chunk, in order of allocation.
+        self.chunks = list()
+
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, 0, generation,
+                         self._data_offset, data_size, self._directory_offset,
+                         directory_size, 0)
+
+        self._sequence = ctypes.c_uint64.from_buffer(
+            self._mmap, SEQUENCE_OFFSET)
+        self.generation = ctypes.c_uint64.from_buffer(
+            self._mmap, GENERATION_OFFSET)
+
+        os.replace(tmp, path)
+
+        log.info('registry: mapped %s, %d series from the last run', path,
+                 len(self.previous))
+
+    @property
+    def available(self):
+        """
+        Number of series which can still be allocated.
+        """
+        return self._capacity - self._used
+
+    def allocate(self, size):
+        """
+        Allocate the columns of a chunk with the given number of series, as
+        (index, ids, kinds, values, states, generations), where index is the
+        position of the chunk in the directory.
+        """
+        if self._used + size > self._capacity:
+            raise Exception('{0}: registry file is full'.format(self.path))
+
+        offset = self._next
+        self._next = offset + align(size * SERIES_SIZE)
+        self._used += size
+        index = len(self.chunks)
+        self.chunks.append((offset, size))
+
+        m = self._mmap
+        ids = (ctypes.c_int64 * size).from_buffer(m, offset)
+        values = (ctypes.c_double * size).from_buffer(m, offset + 8 * size)
+        generations = (ctypes.c_uint64 * size).from_buffer(
+            m, offset + 16 * size)
+        kinds = (ctypes.c_int8 * size).from_buffer(m, offset + 24 * size)
+        states = (ctypes.c_int8 * size).from_buffer(
+            m, offset + 24 * size + size)
+        return index, ids, kinds, values, states, generations
+
+    def write_directory(self, series):
+        """
+        Write the directory, where series is a list of
+        (id, chunk, slot, kind, tags).
+        """
+        data = json.dumps(dict(chunks=self.chunks, series=series),
+                          default=str).encode('utf-8')
+
+        if len(data) > self._directory_size:
+            log.warn('%s: directory does not fit, not writing it', self.path)
+            return
+
+        o = self._directory_offset
+        self._sequence.value += 1
+        self._mmap[o:o + len(data)] = data
+        struct.pack_into('=Q', self._mmap, HEADER.size - 8, len(data))
+        self._sequence.value += 1
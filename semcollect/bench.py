@@ -0,0 +1,146 @@
+"""
+Benchmark collectors against recorded or synthesized proc fixtures.
+
+    python -m semcollect.bench synthesize /tmp/big --cpus 256 --disks 5000
+    python -m semcollect.bench record /tmp/host -n 10 -i 1
+    python -m semcollect.bench run /tmp/big cpu disk iostat -n 100
+
+Collectors are set up and called in-process, so that the measurement only
+includes parsing and rate computation, not the process round-trip.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+
+from .registry import Registry
+from .injector import Injector
+from .platform import Platform
+from .procfs import Fixture, record, synthesize
+from .fanout import FanOut
+from .collector import Collector, Runner, compile_source, collect_method
+from .core import load_collectors
+
+log = logging.getLogger(__name__)
+
+
+def setup_parser():
+    parser = argparse.ArgumentParser(prog='semcollect.bench')
+
+    resource_root = os.path.abspath(os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'collectors'))
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('record', help='Record a fixture from /proc')
+    p.add_argument('target', metavar='<dir>')
+    p.add_argument('-n', '--frames', dest='frames', default=10, type=int)
+    p.add_argument('-i', '--interval', dest='interval', default=1.0,
+                   type=float)
+
+    p = subparsers.add_parser('synthesize', help='Synthesize a fixture')
+    p.add_argument('target', metavar='<dir>')
+    p.add_argument('-n', '--frames', dest='frames', default=10, type=int)
+    p.add_argument('-i', '--interval', dest='interval', default=1.0,
+                   type=float)
+    p.add_argument('--cpus', dest='cpus', default=4, type=int)
+    p.add_argument('--disks', dest='disks', default=4, type=int)
+
+    p = subparsers.add_parser('run', help='Run collectors against a fixture')
+    p.add_argument('fixture', metavar='<dir>')
+    p.add_argument('collectors', metavar='<collector>', nargs='+')
+    p.add_argument('-n', '--iterations', dest='iterations', default=100,
+                   type=int)
+    p.add_argument('-p', '--path', dest='paths', metavar='<path>',
+                   action='append', default=[resource_root])
+
+    return parser
+
+
+def bench(path, fixture, iterations):
+    """
+    Set up the collector at path against the given fixture and call it the
+    given number of times, returning setup time, number of series and a
+    sorted list of call durations.
+    """
+    registry = Registry()
+    injector = Injector(dict(
+        platform=Platform(), registry=registry, procfs=fixture,
+        fanout=FanOut()))
+    scope = injector.child(dict(config={})).child(
+        dict(reload=Collector.Latch()))
+
+    setup = compile_source(path)['setup']
+
+    before = time.time()
+    collect = collect_method(setup(scope))
+    setup_time = time.time() - before
+
+    series = sum(1 for _ in registry.values) + \
+        sum(1 for _ in registry.states)
+
+    durations = list()
+    run = Runner()
+
+    for _ in range(iterations):
+        fixture.tick()
+        before = time.time()
+        run(collect)
+        durations.append(time.time() - before)
+
+    run.close()
+    injector.free()
+    return setup_time, series, sorted(durations)
+
+
+def run(ns):
+    known = load_collectors(ns.paths)
+    fixture = Fixture(ns.fixture)
+
+    print('{0}: {1} frame(s)'.format(ns.fixture, len(fixture)))
+
+    for name in ns.collectors:
+        path = known.get(name)
+
+        if path is None:
+            print('{0}: not a known collector'.format(name))
+            return 1
+
+        setup_time, series, d = bench(path, fixture, ns.iterations)
+
+        mean = sum(d) / len(d)
+        p50 = d[len(d) // 2]
+        p99 = d[min(len(d) - 1, int(len(d) * 0.99))]
+
+        print(('{0}: setup={1:.3f}s series={2} mean={3:.6f}s p50={4:.6f}s '
+               'p99={5:.6f}s calls/s={6:.1f}').format(
+                   name, setup_time, series, mean, p50, p99, 1.0 / mean))
+
+    return 0
+
+
+def main(args):
+    parser = setup_parser()
+    ns = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARN)
+
+    if ns.command == 'record':
+        record(ns.target, ns.frames, ns.interval)
+        return 0
+
+    if ns.command == 'synthesize':
+        synthesize(ns.target, ns.frames, ns.interval,
+                   cpus=ns.cpus, disks=ns.disks)
+        return 0
+
+    if ns.command == 'run':
+        return run(ns)
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
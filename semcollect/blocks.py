@@ -0,0 +1,503 @@
+"""
+Compressed blocks of samples, in the style of Gorilla.
+
+A block holds the samples of a single series in a window of time, and is
+appended to one sample at a time. Timestamps are kept in milliseconds and
+encoded as the difference between consecutive deltas, values of metrics as
+the XOR with the previous value, and states as a single bit each. Samples
+which arrive at a steady interval with slowly changing values take a couple
+of bits each.
+
+A block is a header followed by the bits of its timestamps and then the bits
+of its values, each padded to a whole byte, all fields in network byte order:
+
+    header: kind (B), count (I), first time (q), last time (q),
+            size of timestamps (I), size of values (I)
+
+Keeping the two apart lets a decoder extend runs of unchanged deltas and
+values all at once, and unpack the values of states a byte at a time.
+
+The first timestamp is in the header, and every timestamp after it is the
+delta-of-delta (starting with a delta of 0), as:
+
+    '0'                   if 0
+    '10'   + 7 bits       if in [-63, 64]
+    '110'  + 9 bits       if in [-255, 256]
+    '1110' + 12 bits      if in [-2047, 2048]
+    '1111' + 64 bits      otherwise, two's complement
+
+The first value of a metric is 64 bits, and every value after it is the XOR
+with the previous value, as:
+
+    '0'                   if the XOR is 0
+    '10' + meaningful bits, using the same leading and trailing zeros as the
+          last value which was written with them
+    '11' + 5 bits of leading zeros + 6 bits of meaningful bits (minus one)
+         + meaningful bits
+
+The blocks format of the query endpoint is a header followed by one entry per
+block, so that it can be decoded straight from a memory mapping:
+
+    header: magic (4s), version (B), count (I)
+    entry:  id (I), number of tags (H), every tag as in the binary format
+            (see semcollect.encoding), followed by the block.
+"""
+import array
+import bisect
+import struct
+import weakref
+import itertools
+
+from .registry import Registry
+from .encoding import EncodingException, encode_tags, decode_tags
+
+MAGIC = b'SCGB'
+VERSION = 2
+
+HEADER = struct.Struct('!4sBI')
+ENTRY = struct.Struct('!IH')
+BLOCK = struct.Struct('!BIqqII')
+
+# seconds of samples in every block of the blocks format.
+WINDOW = 3600
+
+MASK64 = (1 << 64) - 1
+
+# (control bits, control width, value width, bias) of every bucket of
+# delta-of-deltas, in order.
+DOD_BUCKETS = [
+    (0b10, 2, 7, 63),
+    (0b110, 3, 9, 255),
+    (0b1110, 4, 12, 2047),
+]
+
+# the states in every byte of the values of a state block, in order.
+STATE_BITS = [tuple(bool(b >> (7 - i) & 1) for i in range(8))
+              for b in range(256)]
+
+
+def float_bits(value):
+    return struct.unpack('!Q', struct.pack('!d', value))[0]
+
+
+class BitWriter(object):
+    """
+    Appends bits most significant first, flushing whole bytes as it goes.
+    """
+    def __init__(self):
+        self._data = bytearray()
+        self._acc = 0
+        self._n = 0
+
+    def write(self, value, bits):
+        self._acc = (self._acc << bits) | (value & ((1 << bits) - 1))
+        self._n += bits
+
+        if self._n >= 64:
+            extra = self._n % 8
+            self._data += (self._acc >> extra).to_bytes(self._n // 8, 'big')
+            self._acc &= (1 << extra) - 1
+            self._n = extra
+
+    def getvalue(self):
+        pad = -self._n % 8
+        tail = (self._acc << pad).to_bytes((self._n + pad) // 8, 'big')
+        return bytes(self._data) + tail
+
+    def __len__(self):
+        return len(self._data) * 8 + self._n
+
+
+class BitReader(object):
+    """
+    Reads bits from a buffer, without converting more of it than it needs.
+    """
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def peek(self, bits):
+        """
+        Return the next bits (at most 64) without consuming them, with zeros
+        past the end of the buffer.
+        """
+        b = self._pos >> 3
+        chunk = bytes(self._data[b:b + 9])
+        value = int.from_bytes(chunk, 'big') << (8 * (9 - len(chunk)))
+        shift = 72 - (self._pos & 7) - bits
+        return (value >> shift) & ((1 << bits) - 1)
+
+    def skip(self, bits):
+        if (self._pos + bits + 7) >> 3 > len(self._data):
+            raise EncodingException('truncated block')
+
+        self._pos += bits
+
+    def read(self, bits):
+        value = self.peek(bits)
+        self.skip(bits)
+        return value
+
+    def ones(self, limit):
+        """
+        Count the ones before the next zero, reading at most limit bits.
+        """
+        mask = (1 << limit) - 1
+        n = limit - (self.peek(limit) ^ mask).bit_length()
+        self.skip(min(n + 1, limit))
+        return n
+
+    def zeros(self, limit):
+        """
+        Count and consume the zeros before the next one, reading at most
+        limit (at most 64) bits, but leaving the one in place.
+        """
+        n = limit - self.peek(limit).bit_length()
+        self.skip(n)
+        return n
+
+
+class Block(object):
+    """
+    A block being appended to.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.count = 0
+        self.first = None
+        self.last = None
+        self._times = BitWriter()
+        self._values = BitWriter()
+        self._delta = 0
+        self._value = 0
+        # leading and trailing zeros of the last XOR written with them.
+        self._leading = None
+        self._trailing = None
+
+    def append(self, t, value):
+        """
+        Append a sample, where t is in seconds and must not be earlier than
+        the last sample.
+        """
+        ms = int(round(t * 1000))
+
+        if self.first is None:
+            self.first = ms
+        else:
+            delta = ms - self.last
+            self._write_dod(delta - self._delta)
+            self._delta = delta
+
+        self.last = ms
+
+        if self.kind == Registry.STATE:
+            self._values.write(1 if value else 0, 1)
+        else:
+            self._write_value(float_bits(value))
+
+        self.count += 1
+
+    def _write_dod(self, dod):
+        w = self._times
+
+        if dod == 0:
+            w.write(0, 1)
+            return
+
+        for control, width, bits, bias in DOD_BUCKETS:
+            if -bias <= dod <= bias + 1:
+                w.write(control, width)
+                w.write(dod + bias, bits)
+                return
+
+        w.write(0b1111, 4)
+        w.write(dod & MASK64, 64)
+
+    def _write_value(self, bits):
+        w = self._values
+
+        if self.count == 0:
+            w.write(bits, 64)
+            self._value = bits
+            return
+
+        x = bits ^ self._value
+        self._value = bits
+
+        if x == 0:
+            w.write(0, 1)
+            return
+
+        leading = min(31, 64 - x.bit_length())
+        trailing = (x & -x).bit_length() - 1
+
+        if (self._leading is not None and leading >= self._leading and
+                trailing >= self._trailing):
+            w.write(0b10, 2)
+            w.write(x >> self._trailing,
+                    64 - self._leading - self._trailing)
+            return
+
+        meaningful = 64 - leading - trailing
+        w.write(0b11, 2)
+        w.write(leading, 5)
+        w.write(meaningful - 1, 6)
+        w.write(x >> trailing, meaningful)
+        self._leading = leading
+        self._trailing = trailing
+
+    def __len__(self):
+        return self.count
+
+    def encode(self):
+        """
+        Encode the block with its header.
+        """
+        times = self._times.getvalue()
+        values = self._values.getvalue()
+        first = self.first if self.first is not None else 0
+        last = self.last if self.last is not None else 0
+        return BLOCK.pack(self.kind, self.count, first, last,
+                          len(times), len(values)) + times + values
+
+
+def decode_block(data, o=0):
+    """
+    Decode the block at offset o in data, returning its kind, a list of its
+    (time, value) samples with time in seconds, and the offset after it.
+    """
+    data = memoryview(data)
+
+    if o + BLOCK.size > len(data):
+        raise EncodingException('truncated block header')
+
+    kind, count, first, _, tsize, vsize = BLOCK.unpack_from(data, o)
+    o += BLOCK.size
+
+    if o + tsize + vsize > len(data):
+        raise EncodingException('truncated block')
+
+    if count == 0:
+        return kind, [], o + tsize + vsize
+
+    times = _decode_times(BitReader(data[o:o + tsize]), first, count)
+    o += tsize
+
+    if kind == Registry.STATE:
+        if vsize * 8 < count:
+            raise EncodingException('truncated block')
+
+        samples = itertools.islice(itertools.chain.from_iterable(
+            map(STATE_BITS.__getitem__, data[o:o + vsize])), count)
+    else:
+        samples = _decode_values(BitReader(data[o:o + vsize]), count)
+
+    return kind, [(ms / 1000.0, v) for ms, v in zip(times, samples)], o + vsize
+
+
+def _decode_times(r, first, count):
+    times = array.array('q', [first])
+    t = first
+    delta = 0
+    left = count - 1
+
+    while left > 0:
+        # runs of samples at a steady interval are extended all at once.
+        n = r.zeros(min(left, 64))
+
+        if n > 0:
+            if delta == 0:
+                times.extend(array.array('q', [t]) * n)
+            else:
+                times.extend(range(t + delta, t + delta * (n + 1), delta))
+
+            t += delta * n
+            left -= n
+            continue
+
+        delta += _read_dod(r)
+        t += delta
+        times.append(t)
+        left -= 1
+
+    return times
+
+
+def _decode_values(r, count):
+    values = array.array('Q', [r.read(64)])
+    # leading and trailing zeros of the last XOR read with them.
+    window = None
+    left = count - 1
+
+    while left > 0:
+        # as are runs of unchanged values.
+        n = r.zeros(min(left, 64))
+
+        if n > 0:
+            values.extend(array.array('Q', [values[-1]]) * n)
+            left -= n
+            continue
+
+        x, window = _read_xor(r, window)
+        values.append(values[-1] ^ x)
+        left -= 1
+
+    samples = array.array('d')
+    samples.frombytes(values.tobytes())
+    return samples
+
+
+def _read_dod(r):
+    n = r.ones(4)
+
+    if n == 0:
+        return 0
+
+    if n == 4:
+        dod = r.read(64)
+        return dod - (1 << 64) if dod >> 63 else dod
+
+    _, _, bits, bias = DOD_BUCKETS[n - 1]
+    return r.read(bits) - bias
+
+
+def _read_xor(r, window):
+    if r.read(1) == 0:
+        return 0, window
+
+    if r.read(1) == 0:
+        if window is None:
+            raise EncodingException('invalid block')
+
+        leading, trailing = window
+        meaningful = 64 - leading - trailing
+    else:
+        leading = r.read(5)
+        meaningful = r.read(6) + 1
+        trailing = 64 - leading - meaningful
+        window = (leading, trailing)
+
+    return r.read(meaningful) << trailing, window
+
+
+class BlockCache(object):
+    """
+    Encoded entries of the blocks format, kept between encodings so that a
+    history which has not changed is not encoded again, and a history which
+    has only encodes the blocks which were added to or dropped samples.
+
+    Entries are kept for as long as their history is around.
+    """
+    def __init__(self):
+        # history -> ((generation, window), entries,
+        #             {(first time, count): entry}).
+        self._histories = weakref.WeakKeyDictionary()
+
+    def __len__(self):
+        return len(self._histories)
+
+
+def encode_blocks(series, history, window=WINDOW, cache=None):
+    """
+    Encode the history of an iterable of (id, kind, tags, value) into the
+    blocks format, with one block for every window of seconds in the
+    history of every series. history is a function returning the history of
+    a series, or None.
+
+    If cache is a BlockCache, blocks encoded before are taken from it.
+    """
+    parts = [None]
+    count = 0
+
+    for n, kind, tags, _ in series:
+        h = history(n)
+
+        if h is None:
+            continue
+
+        entries = _encode_history(n, kind, tags, h, window, cache)
+        parts.extend(entries)
+        count += len(entries)
+
+    parts[0] = HEADER.pack(MAGIC, VERSION, count)
+    return b''.join(parts)
+
+
+def _encode_history(n, kind, tags, h, window, cache):
+    # read before the samples, so that a sample appended in between only
+    # makes the next encoding look at the history again.
+    generation = (h.generation, window)
+    cached = cache._histories.get(h) if cache is not None else None
+
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    if cached is not None and cached[0][1] == window:
+        blocks = cached[2]
+    else:
+        blocks = dict()
+    samples = h.samples()
+    times = [t for t, _ in samples]
+    entries = list()
+    used = dict()
+    i = 0
+
+    while i < len(samples):
+        t = times[i]
+        j = bisect.bisect_left(times, t - t % window + window, i + 1)
+        key = (t, j - i)
+        entry = blocks.get(key)
+
+        if entry is None:
+            block = Block(kind)
+
+            for t, v in samples[i:j]:
+                block.append(t, v)
+
+            entry = _encode_entry(n, tags, block)
+
+        used[key] = entry
+        entries.append(entry)
+        i = j
+
+    if cache is not None:
+        cache._histories[h] = (generation, entries, used)
+
+    return entries
+
+
+def _encode_entry(n, tags, block):
+    parts = [ENTRY.pack(n, len(tags))]
+    encode_tags(parts, tags)
+    parts.append(block.encode())
+    return b''.join(parts)
+
+
+def decode_blocks(data):
+    """
+    Generate (id, tags, kind, samples) for every block in the blocks format.
+
+    data can be anything supporting the buffer protocol, like an mmap, and is
+    decoded as it is iterated over.
+    """
+    data = memoryview(data)
+
+    if len(data) < HEADER.size:
+        raise EncodingException('truncated header')
+
+    magic, version, count = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC or version != VERSION:
+        raise EncodingException('unsupported format')
+
+    o = HEADER.size
+
+    for _ in range(count):
+        try:
+            n, ntags = ENTRY.unpack_from(data, o)
+            tags, o = decode_tags(data, o + ENTRY.size, ntags)
+        except struct.error:
+            raise EncodingException('truncated entry')
+
+        kind, samples, o = decode_block(data, o)
+        yield n, tags, kind, samples
@@ -0,0 +1,112 @@
+"""
+Change-only emission.
+
+Only series which have changed since they were last emitted are passed on,
+with every series being emitted as a full heartbeat every N collections.
+
+Metrics can be given a deadband, in which case a change is only emitted when
+it is larger than both the absolute and the relative deadband, compared to the
+last emitted value.
+Since the comparison is against the last emitted value, slow drift is still
+emitted once it adds up to more than the deadband.
+"""
+import math
+
+from .registry import Registry, next_layout, match_tags
+from .pipeline import Batch
+
+# most distinct sets of changed series to keep a layout for, per input layout.
+MAX_LAYOUTS = 1024
+
+
+class Changes(object):
+    def __init__(self, config):
+        self._heartbeat = config.heartbeat
+        self._deadband = [
+            (dict((k, str(v)) for k, v in d.match.items()),
+             d.absolute, d.relative)
+            for d in config.deadband]
+        self._ticks = 0
+        # last emitted value, by series id.
+        self._last = dict()
+        self._layout = None
+        # deadband for every position in the batch, by layout.
+        self._bands = None
+        # layout of every set of emitted ids seen with the input layout, so
+        # that stages after this one can keep caching by layout.
+        self._layouts = dict()
+
+    def __call__(self, batch):
+        series = batch.series
+
+        if batch.layout != self._layout:
+            self._bands = [self._band(kind, tags)
+                           for (_, kind, tags, _) in series]
+            self._layout = batch.layout
+            self._layouts = dict()
+
+        heartbeat = self._ticks % self._heartbeat == 0
+        self._ticks += 1
+
+        if heartbeat:
+            self._last = dict((s[0], s[3]) for s in series)
+            return batch
+
+        last = self._last
+        out = list()
+
+        for s, band in zip(series, self._bands):
+            n = s[0]
+            v = s[3]
+
+            if n in last and not changed(last[n], v, band):
+                continue
+
+            last[n] = v
+            out.append(s)
+
+        return Batch(batch.time, self._layout_of(out), out, False,
+                     batch.stale)
+
+    def _layout_of(self, out):
+        """
+        Get a layout which is stable for the same set of emitted series.
+        """
+        key = tuple(s[0] for s in out)
+        layout = self._layouts.get(key)
+
+        if layout is None:
+            if len(self._layouts) >= MAX_LAYOUTS:
+                self._layouts = dict()
+
+            layout = self._layouts[key] = next_layout()
+
+        return layout
+
+    def _band(self, kind, tags):
+        if kind != Registry.METRIC:
+            return None
+
+        for match, absolute, relative in self._deadband:
+            if match_tags(match, tags):
+                return (absolute, relative)
+
+        return None
+
+
+def changed(before, after, band):
+    if before == after:
+        return False
+
+    before_nan = isinstance(before, float) and math.isnan(before)
+    after_nan = isinstance(after, float) and math.isnan(after)
+
+    if before_nan or after_nan:
+        return before_nan != after_nan
+
+    if band is None:
+        return True
+
+    absolute, relative = band
+    diff = abs(after - before)
+    return diff > absolute and diff > relative * abs(before)
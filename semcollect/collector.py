@@ -1,12 +1,67 @@
 import logging
 import signal
 import sys
+import time
+import pickle
+import random
 import os.path
+import inspect
+import resource
+import threading
+import contextlib
+import collections
 import multiprocessing as mp
 
+from .sched import apply_priority_class
+
 log = logging.getLogger(__name__)
 
 
+class ForkGuard(object):
+    """
+    Keeps collector processes from being forked while collectors are being
+    set up, since a forked process inherits every lock that is held by
+    another thread at the time, like the lock of the registry.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._setups = 0
+
+    def idle(self):
+        """
+        Check if no collector is being set up.
+        """
+        with self._cond:
+            return self._setups == 0
+
+    @contextlib.contextmanager
+    def setup(self):
+        with self._cond:
+            self._setups += 1
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._setups -= 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def fork(self):
+        """
+        Wait for every setup to finish, and keep new ones from starting until
+        the process has been forked.
+        """
+        with self._cond:
+            while self._setups > 0:
+                self._cond.wait()
+
+            yield
+
+
+fork_guard = ForkGuard()
+
+
 class Collector(object):
     class Latch(object):
         def __init__(self):
@@ -18,6 +73,66 @@ class Collector(object):
         def is_set(self):
             return self._b.value != 0
 
+    class Checkpoint(object):
+        """
+        Shared memory through which an instance hands over the state of its
+        collector to the instance replacing it.
+        """
+        def __init__(self, size):
+            self._data = mp.RawArray('c', size)
+            # length of the stored state, zero if there is none. Written last,
+            # so that a partially written state is never read.
+            self._length = mp.RawValue('L', 0)
+
+        def write(self, data):
+            if len(data) > len(self._data):
+                raise Exception(
+                    'checkpoint too large ({0} > {1} bytes)'.format(
+                        len(data), len(self._data)))
+
+            self._length.value = 0
+            self._data[:len(data)] = data
+            self._length.value = len(data)
+
+        def read(self):
+            """
+            Take the stored state, or None if there is none.
+            """
+            length = self._length.value
+
+            if length == 0:
+                return None
+
+            self._length.value = 0
+            return self._data[:length]
+
+        def clear(self):
+            self._length.value = 0
+
+    class Latency(object):
+        """
+        Rolling window of observed collection latencies.
+        """
+        # samples needed before a percentile is trusted.
+        MIN_SAMPLES = 10
+
+        def __init__(self, size):
+            self._samples = collections.deque(maxlen=size)
+
+        def observe(self, duration):
+            self._samples.append(duration)
+
+        def percentile(self, q):
+            """
+            Get the qth percentile of the observed latencies, or None if too
+            few have been observed.
+            """
+            if len(self._samples) < self.MIN_SAMPLES:
+                return None
+
+            s = sorted(self._samples)
+            return s[min(len(s) - 1, int(len(s) * q / 100.0))]
+
     class Instance(object):
         def __init__(self, path, name, process, pipe,
                      injector, reload_latch, config):
@@ -102,60 +217,287 @@ class Collector(object):
         def __str__(self):
             return "{0}:{1}".format(self._name, self._process.pid)
 
-    def __init__(self, path, name, out, injector, instance_config):
+    # weight of the latest collection in the smoothed CPU usage.
+    CPU_SMOOTHING = 0.3
+
+    def __init__(self, path, name, out, injector, instance_config,
+                 priority=0, priority_class=None, cpu_budget=None,
+                 interval=None):
         self._path = path
         self._name = name
         self._out = out
         self._injector = injector
         self._instance_config = instance_config
+        self.priority = priority
+        self._priority_class = priority_class
+        self._cpu_budget = cpu_budget
+        # smoothed CPU seconds used per collection, where a collection which
+        # was sat out used none, and if the last collection went over budget.
+        self._cpu = None
+        self._over_budget = False
         self._instance = None
-        self._failed_restart_timer = 0
+        # number of restarts which failed in a row, and the earliest time at
+        # which a restart is attempted again.
+        self._failed_restarts = 0
+        self._restart_after = 0
+        self._latency = Collector.Latency(instance_config.latency_samples)
+        # time at which the first collection finished successfully.
+        self.first_sample = None
+        # seconds that the last finished task took.
+        self.last_duration = None
+        # allocated once an instance has a collector with a #checkpoint hook.
+        self._checkpoint = None
+        # time at which the current task was sent.
+        self._started = None
+        # if not None, the task which the collector is still busy with.
+        self._busy = None
+        self._skipped = 0
+        # seconds between collections, None to use the interval of the agent.
+        self.interval = interval
+        # earliest time of the next collection.
+        self.next_run = 0
+        # time by which the tracked task has to finish, see #track.
+        self.deadline = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def registry(self):
+        """
+        The group of the registry that every instance registers series in.
+        """
+        return self._injector.require('registry')
 
     def errored(self, count=1):
         self._instance.errored(count)
 
+    def busy(self):
+        return self._busy is not None
+
+    def timeout_after(self, default):
+        """
+        Get the number of seconds the current task may take.
+
+        With adaptive timeouts, this is derived from the observed latency of
+        the collector, bounded by min_timeout and max_timeout, where the upper
+        bound is the given default unless max_timeout is set.
+        """
+        c = self._instance_config
+
+        if not c.adaptive_timeout:
+            return default
+
+        p = self._latency.percentile(c.timeout_percentile)
+
+        if p is None:
+            return default
+
+        upper = default if c.max_timeout is None else c.max_timeout
+        return min(upper, max(c.min_timeout, p * c.timeout_factor))
+
+    def done(self, ok, cpu=0.0):
+        """
+        The current task finished in time, using cpu seconds of CPU time.
+        """
+        self._observe()
+        self._account(cpu)
+
+        if not ok:
+            self.errored()
+        elif self.first_sample is None:
+            self.first_sample = time.time()
+
+    def throttled(self):
+        """
+        Check if the collector should sit out the current collection to stay
+        within its CPU budget.
+        """
+        if self._cpu_budget is None or self._cpu is None:
+            return False
+
+        throttled = self._cpu > self._cpu_budget
+
+        # sitting out counts as a collection which used no CPU, so that the
+        # collector is collected again once it is back within its budget.
+        if throttled:
+            self._smooth(0.0)
+
+        return throttled
+
+    def _account(self, cpu):
+        if self._cpu_budget is None:
+            return
+
+        if self._cpu is None:
+            self._cpu = cpu
+        else:
+            self._smooth(cpu)
+
+        over = self._cpu > self._cpu_budget
+
+        if over != self._over_budget:
+            if over:
+                log.warn('%s: using %0.3fs CPU of %0.3fs budget, throttling',
+                         self, self._cpu, self._cpu_budget)
+            else:
+                log.info('%s: within CPU budget again', self)
+
+            self._over_budget = over
+
+    def _smooth(self, cpu):
+        a = self.CPU_SMOOTHING
+        self._cpu = a * cpu + (1 - a) * self._cpu
+
+    def timeout(self, i):
+        """
+        Handle the task i not being finished in time.
+
+        Depending on the timeout policy, the collector is either restarted or
+        marked as busy until the task is finished.
+        Returns True if the collector was marked as busy.
+        """
+        # the task took at least this long, which lets the timeout grow on a
+        # host where everything is slow, up to max_timeout.
+        self._observe()
+
+        if self._instance_config.timeout_policy == 'skip':
+            self._busy = i
+            return True
+
+        self.restart()
+        return False
+
+    def track(self, i, deadline):
+        """
+        Track task i as running, which keeps the collector busy until it has
+        finished, so that rounds can overlap.
+        """
+        self._busy = i
+        self.deadline = deadline
+
+    def expire(self, now):
+        """
+        Apply the timeout policy if the tracked task is past its deadline.
+        """
+        if self.deadline is None or now < self.deadline:
+            return
+
+        self.deadline = None
+        log.warn('%s: timeout (task %d)', self, self._busy)
+        self.timeout(self._busy)
+
+    def skip(self):
+        """
+        Called instead of collecting when the collector is busy.
+
+        Returns True if the collector should be skipped, or False if it has
+        been busy for too long and has been restarted.
+        """
+        self._skipped += 1
+
+        if self._skipped <= self._instance_config.max_skipped:
+            log.warn('%s: still busy with task %d, skipping (%d of %d)',
+                     self, self._busy, self._skipped,
+                     self._instance_config.max_skipped)
+            return True
+
+        log.warn('%s: busy for too long, restarting', self)
+        self.restart()
+        return False
+
+    def finished(self, i, ok, cpu=0.0):
+        """
+        A task finished late. Returns True if it was the task the collector was
+        busy with.
+        """
+        if self._busy != i:
+            return False
+
+        self._busy = None
+        self.deadline = None
+        self._skipped = 0
+        self._observe()
+        self._account(cpu)
+
+        if not ok:
+            self.errored()
+        elif self.first_sample is None:
+            self.first_sample = time.time()
+
+        return True
+
+    def _observe(self):
+        if self._started is not None:
+            self.last_duration = time.time() - self._started
+            self._latency.observe(self.last_duration)
+
     def check(self):
         self._check_instance()
 
     def collect(self, i):
         self._check_instance()
         self._instance.collect(i)
+        self._started = time.time()
 
     def soft_restart(self, graceful=False):
         """
         A restart implementation that tries to keep the old instance alive
         until a new one has come up.
 
-        It also implements back-off using a timer to avoid trying to restart a
-        broken collector too often.
+        It also implements exponential back-off with jitter to avoid trying to
+        restart a broken collector too often.
         """
 
-        # do not restart while timer is active
-        if self._failed_restart_timer > 0:
-            self._failed_restart_timer -= 1
+        # do not restart while backing off
+        if time.time() < self._restart_after:
             return
 
         try:
             new_instance = self._new_instance()
         except:
-            self._failed_restart_timer = 10
-            log.error('%s: failed to restart', self, exc_info=sys.exc_info())
+            self._failed_restarts += 1
+            delay = self._restart_backoff()
+            self._restart_after = time.time() + delay
+            log.error('%s: failed to restart, retrying in %0.1fs', self,
+                      delay, exc_info=sys.exc_info())
             return
 
+        self._failed_restarts = 0
         self._instance.terminate(graceful)
         self._instance = new_instance
 
+    def _restart_backoff(self):
+        c = self._instance_config
+        delay = min(c.max_restart_backoff,
+                    c.restart_backoff * 2 ** (self._failed_restarts - 1))
+        return random.uniform(delay / 2, delay)
+
     def restart(self, graceful=False):
+        self._busy = None
+        self.deadline = None
+        self._skipped = 0
+
         if self._instance is not None:
             self._instance.terminate(graceful)
             self._instance = None
 
+        # without a graceful terminate, the state might be from an older
+        # instance.
+        if not graceful and self._checkpoint is not None:
+            self._checkpoint.clear()
+
         self._instance = self._new_instance()
 
     def stop(self, graceful=True):
         """
         Stop the collector.
         """
+        self._busy = None
+        self.deadline = None
+        self._skipped = 0
+
         if self._instance is None:
             return
 
@@ -171,22 +513,20 @@ class Collector(object):
                       self._instance)
             self.restart(False)
 
-        if self._instance.needs_recycling():
+        # a busy collector is recycled once it has finished.
+        if self._busy is None and self._instance.needs_recycling():
             log.info('%s: recycling (%s)', self._instance,
                      ', '.join(self._instance.reasons()))
             self.soft_restart(True)
 
-    def _compile(self):
-        scope = dict()
-
-        with open(self._path) as f:
-            code = compile(f.read(), self._path, 'exec')
-            exec(code, scope)
-
-        return scope
+    def prepare(self):
+        """
+        Set up a new instance without starting it, see #start.
 
-    def _new_instance(self):
-        scope = self._compile()
+        This is the slow part of starting a collector, and may be called from
+        another thread.
+        """
+        scope = compile_source(self._path)
 
         setup = scope.get('setup', None)
 
@@ -198,24 +538,58 @@ class Collector(object):
         injector = self._injector.child(dict(reload=reload_latch))
 
         try:
-            collect = setup(injector)
+            with fork_guard.setup():
+                collect = setup(injector)
         except:
             injector.free()
             raise
 
         if collect is None:
+            injector.free()
             raise Exception(
                 '{0}: #setup must not return None'.format(self._path))
 
+        return injector, reload_latch, collect
+
+    def start(self, prepared):
+        """
+        Start the instance set up by #prepare.
+        """
+        self._instance = self._spawn(prepared)
+
+    def discard(self, prepared):
+        """
+        Discard an instance set up by #prepare which will not be started.
+        """
+        injector, _, _ = prepared
+        injector.free()
+
+    def _new_instance(self):
+        return self._spawn(self.prepare())
+
+    def _spawn(self, prepared):
+        injector, reload_latch, collect = prepared
+
         start = getattr(collect, 'start', None)
         stop = getattr(collect, 'stop', None)
+        checkpoint = getattr(collect, 'checkpoint', None)
+        resume = getattr(collect, 'resume', None)
+        collect = collect_method(collect)
+
+        if checkpoint is not None and self._checkpoint is None:
+            self._checkpoint = Collector.Checkpoint(
+                self._instance_config.checkpoint_size)
 
         inp, out = mp.Pipe(False)
 
         p = mp.Process(target=instance_loop,
-                       args=(self._name, inp, self._out, start, stop, collect),
+                       args=(self._name, inp, self._out, start, stop, collect,
+                             self._priority_class, self._checkpoint,
+                             checkpoint, resume),
                        name=self._name)
-        p.start()
+
+        with fork_guard.fork():
+            p.start()
 
         return Collector.Instance(
             self._path, self._name, p, out, injector, reload_latch,
@@ -228,9 +602,78 @@ class Collector(object):
         return '{0}:<no instance>'.format(self._name)
 
 
-def instance_loop(name, inp, out, start, stop, collect):
+def compile_source(path):
+    """
+    Compile and execute the collector source at the given path, returning its
+    global scope.
+    """
+    scope = dict()
+
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+        exec(code, scope)
+
+    return scope
+
+
+def collect_method(collect):
+    """
+    Get the method to call for every collection.
+
+    This is the collector itself, unless it has a #collect coroutine method.
+    """
+    method = getattr(collect, 'collect', None)
+
+    if method is not None and inspect.iscoroutinefunction(method):
+        return method
+
+    return collect
+
+
+class Runner(object):
+    """
+    Calls collector hooks, running them to completion on an event loop owned
+    by the instance if they return something awaitable.
+
+    The loop is created on first use, so synchronous collectors never have one.
+    """
+    def __init__(self):
+        self._loop = None
+
+    def __call__(self, f):
+        result = f()
+
+        if not inspect.isawaitable(result):
+            return result
+
+        if self._loop is None:
+            # only collectors which need it pay for importing asyncio.
+            import asyncio
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+
+        return self._loop.run_until_complete(result)
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        self._loop.close()
+        self._loop = None
+
+
+def instance_loop(name, inp, out, start, stop, collect,
+                  priority_class=None, store=None, checkpoint=None,
+                  resume=None):
     """
     Process loop for a single instance.
+
+    Results are put on out as (task, ok, cpu), where cpu is the CPU time in
+    seconds used by the collection.
+
+    When stopped gracefully, the state returned by the checkpoint hook is
+    written to store. The instance replacing this one passes it to its resume
+    hook before its first collection.
     """
     name = "{0}:{1}".format(name, os.getpid())
 
@@ -238,16 +681,27 @@ def instance_loop(name, inp, out, start, stop, collect):
         log.warn("%s: terminating (by signal)", name)
         sys.exit(1)
 
+    # Do not deliver signals to the wakeup fd inherited from the manager
+    # process, if it has one it would be notified of our signals.
+    signal.set_wakeup_fd(-1)
+
     # Handle SIGTERM because it signals a forced terminate by manager process.
     signal.signal(signal.SIGTERM, _handle_term)
 
+    if priority_class is not None:
+        apply_priority_class(name, priority_class)
+
+    run = Runner()
+
     if start is not None:
         try:
-            start()
+            run(start)
         except:
             log.error('%s: failed to start', name, exc_info=sys.exc_info())
             sys.exit(1)
 
+    resumed = False
+
     while True:
         try:
             i = inp.recv()
@@ -259,18 +713,60 @@ def instance_loop(name, inp, out, start, stop, collect):
         if i is None:
             break
 
+        # the previous instance has been terminated once the first task
+        # arrives, so its state is available by now.
+        if not resumed:
+            resumed = True
+
+            if store is not None and resume is not None:
+                _resume(name, run, store, resume)
+
+        before = cpu_time()
+
         try:
-            collect()
+            run(collect)
         except Exception as e:
             log.error('%s: collector failed: %s', name, e)
-            out.put((i, False))
+            out.put((i, False, cpu_time() - before))
         else:
-            out.put((i, True))
+            out.put((i, True, cpu_time() - before))
+
+    if store is not None and checkpoint is not None:
+        try:
+            store.write(pickle.dumps(run(checkpoint)))
+        except:
+            log.error('%s: failed to checkpoint', name,
+                      exc_info=sys.exc_info())
 
     if stop is not None:
         try:
-            stop()
+            run(stop)
         except:
             log.error('%s: failed to stop', name, exc_info=sys.exc_info())
 
+    run.close()
     sys.exit(0)
+
+
+def _resume(name, run, store, resume):
+    data = store.read()
+
+    if data is None:
+        return
+
+    try:
+        state = pickle.loads(data)
+        run(lambda: resume(state))
+    except:
+        log.error('%s: failed to resume', name, exc_info=sys.exc_info())
+        return
+
+    log.info('%s: resumed from checkpoint', name)
+
+
+def cpu_time():
+    """
+    CPU time used by the calling process, in seconds.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
@@ -1,6 +1,8 @@
 """
 Contains all the types and helpers necessary to validate a configuration.
 """
+import re
+
 
 class ConfigException(Exception):
     pass
@@ -65,6 +67,9 @@ def as_type(tp, key, typename=None, default=None, allow_none=False,
         try:
             v = access(data, key)
         except KeyError:
+            v = None
+
+        if v is None:
             v = default
 
         if v is None:
@@ -92,6 +97,12 @@ def as_type(tp, key, typename=None, default=None, allow_none=False,
     return _p
 
 
+def as_bool(key, **kw):
+    kw['typename'] = 'boolean'
+    kw['convert'] = False
+    return as_type(bool, key, **kw)
+
+
 def as_dict(key):
     def _p(data, p):
         p = p + [key]
@@ -107,7 +118,7 @@ def as_dict(key):
 
 
 def as_list(key, default=None, allow_none=False, sub=None):
-    core = as_type(list, key, default=default, allow_none=False,
+    core = as_type(list, key, default=default, allow_none=allow_none,
                    convert=False)
 
     def _p(data, p):
@@ -148,7 +159,11 @@ def as_load(key, t):
     def _p(data, p):
         p = p + [key]
 
-        v = data.get(key, {})
+        v = data.get(key)
+
+        # a section with everything commented out is empty.
+        if v is None:
+            v = {}
 
         if not isinstance(v, dict):
             raise ConfigException('{0}: expected dict'.format(path(p)))
@@ -170,14 +185,53 @@ class InstanceConfig(object):
     forceful_timeout = as_float('forceful_timeout', default=2.0)
     # maximum number of forceful attempts allowed.
     max_forceful_attempts = as_int('max_forceful_attempts', default=5)
+    # what to do with a collector that does not finish in time, either
+    # 'restart' it, or 'skip' it until it has finished.
+    timeout_policy = as_string('timeout_policy', default='restart')
+    # number of collections a collector may be skipped before it is restarted.
+    max_skipped = as_int('max_skipped', default=5)
+    # derive the timeout of every collector from its observed latency.
+    adaptive_timeout = as_bool('adaptive_timeout', default=False)
+    # percentile of the observed latency, and the factor it is multiplied
+    # with to get the adaptive timeout.
+    timeout_percentile = as_float('timeout_percentile', default=99.0)
+    timeout_factor = as_float('timeout_factor', default=2.0)
+    # lower and upper bound of the adaptive timeout, where the upper bound
+    # defaults to the timeout of the agent.
+    min_timeout = as_float('min_timeout', default=1.0)
+    max_timeout = as_float('max_timeout', allow_none=True)
+    # number of latency samples kept for every collector.
+    latency_samples = as_int('latency_samples', default=100)
+    # initial and maximum delay between failed restarts.
+    restart_backoff = as_float('restart_backoff', default=2.0)
+    max_restart_backoff = as_float('max_restart_backoff', default=300.0)
+    # bytes of shared memory for handing over collector state to the
+    # instance which replaces it.
+    checkpoint_size = as_int('checkpoint_size', default=65536)
+
+    TIMEOUT_POLICIES = set(['restart', 'skip'])
 
     def __init__(self, max_runs, max_errors, graceful_timeout,
-                 forceful_timeout, max_forceful_attempts):
+                 forceful_timeout, max_forceful_attempts, timeout_policy,
+                 max_skipped, adaptive_timeout, timeout_percentile,
+                 timeout_factor, min_timeout, max_timeout, latency_samples,
+                 restart_backoff, max_restart_backoff, checkpoint_size):
         self.max_runs = max_runs
         self.max_errors = max_errors
         self.graceful_timeout = graceful_timeout
         self.forceful_timeout = forceful_timeout
         self.max_forceful_attempts = max_forceful_attempts
+        self.timeout_policy = timeout_policy
+        self.max_skipped = max_skipped
+        self.adaptive_timeout = adaptive_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.latency_samples = latency_samples
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.checkpoint_size = checkpoint_size
 
     @classmethod
     @load_entry
@@ -187,12 +241,335 @@ class InstanceConfig(object):
         graceful_timeout = cls.graceful_timeout(data, p)
         forceful_timeout = cls.forceful_timeout(data, p)
         max_forceful_attempts = cls.max_forceful_attempts(data, p)
+        timeout_policy = cls.timeout_policy(data, p)
+        max_skipped = cls.max_skipped(data, p)
+        adaptive_timeout = cls.adaptive_timeout(data, p)
+        timeout_percentile = cls.timeout_percentile(data, p)
+        timeout_factor = cls.timeout_factor(data, p)
+        min_timeout = cls.min_timeout(data, p)
+        max_timeout = cls.max_timeout(data, p)
+        latency_samples = cls.latency_samples(data, p)
+        restart_backoff = cls.restart_backoff(data, p)
+        max_restart_backoff = cls.max_restart_backoff(data, p)
+        checkpoint_size = cls.checkpoint_size(data, p)
+
+        if timeout_policy not in cls.TIMEOUT_POLICIES:
+            raise ConfigException(
+                '{0}: not a valid policy: {1}'.format(
+                    path(p + ['timeout_policy']), repr(timeout_policy)))
+
+        if not 0 <= timeout_percentile <= 100:
+            raise ConfigException(
+                '{0}: must be between 0 and 100'.format(
+                    path(p + ['timeout_percentile'])))
+
+        if max_timeout is not None and max_timeout < min_timeout:
+            raise ConfigException(
+                '{0}: must be at least min_timeout'.format(
+                    path(p + ['max_timeout'])))
+
         return InstanceConfig(
             max_runs, max_errors, graceful_timeout, forceful_timeout,
-            max_forceful_attempts)
+            max_forceful_attempts, timeout_policy, max_skipped,
+            adaptive_timeout, timeout_percentile, timeout_factor, min_timeout,
+            max_timeout, latency_samples, restart_backoff, max_restart_backoff,
+            checkpoint_size)
 
 
-class CollectorConfig(object):
+class ProcFSConfig(object):
+    # root under which the proc and sys filesystems are found.
+    root = as_string('root', default='/')
+    # if set, replay the recorded fixture in the given directory instead.
+    fixture = as_string('fixture', allow_none=True)
+
+    def __init__(self, root, fixture):
+        self.root = root
+        self.fixture = fixture
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        root = cls.root(data, p)
+        fixture = cls.fixture(data, p)
+        return ProcFSConfig(root, fixture)
+
+
+class FanOutConfig(object):
+    # maximum number of items worked on concurrently.
+    workers = as_int('workers', default=8)
+    # time an item may run before it is considered hung.
+    timeout = as_float('timeout', default=2.0)
+    # time a whole round of items may take.
+    budget = as_float('budget', default=10.0)
+    # number of rounds a hung item is skipped after it has returned.
+    quarantine = as_int('quarantine', default=10)
+
+    def __init__(self, workers, timeout, budget, quarantine):
+        self.workers = workers
+        self.timeout = timeout
+        self.budget = budget
+        self.quarantine = quarantine
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        workers = cls.workers(data, p)
+        timeout = cls.timeout(data, p)
+        budget = cls.budget(data, p)
+        quarantine = cls.quarantine(data, p)
+
+        if workers < 1:
+            raise ConfigException(
+                '{0}: must be at least 1'.format(path(p + ['workers'])))
+
+        return FanOutConfig(workers, timeout, budget, quarantine)
+
+
+class PriorityClassConfig(object):
+    name = as_string('name')
+    # nice value added to collector processes in this class.
+    nice = as_int('nice', allow_none=True)
+    # I/O scheduling class, one of 'realtime', 'best-effort' or 'idle', and
+    # the level within it.
+    ioprio_class = as_string('ioprio_class', allow_none=True)
+    ioprio_level = as_int('ioprio_level', default=0)
+    # CPUs that collector processes in this class may run on.
+    cpus = as_list('cpus', allow_none=True)
+
+    IOPRIO_CLASSES = set(['realtime', 'best-effort', 'idle'])
+
+    def __init__(self, name, nice, ioprio_class, ioprio_level, cpus):
+        self.name = name
+        self.nice = nice
+        self.ioprio_class = ioprio_class
+        self.ioprio_level = ioprio_level
+        self.cpus = cpus
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        name = cls.name(data, p)
+        nice = cls.nice(data, p)
+        ioprio_class = cls.ioprio_class(data, p)
+        ioprio_level = cls.ioprio_level(data, p)
+        cpus = cls.cpus(data, p)
+
+        if ioprio_class is not None and \
+           ioprio_class not in cls.IOPRIO_CLASSES:
+            raise ConfigException(
+                '{0}: not a valid I/O class: {1}'.format(
+                    path(p + ['ioprio_class']), repr(ioprio_class)))
+
+        if not 0 <= ioprio_level <= 7:
+            raise ConfigException(
+                '{0}: must be between 0 and 7'.format(
+                    path(p + ['ioprio_level'])))
+
+        if cpus is not None:
+            for i, cpu in enumerate(cpus):
+                if not isinstance(cpu, int) or cpu < 0:
+                    raise ConfigException(
+                        '{0}: expected a CPU number, but got {1}'.format(
+                            path(p + ['cpus', i]), repr(cpu)))
+
+        return PriorityClassConfig(name, nice, ioprio_class, ioprio_level,
+                                   cpus)
+
+
+class RelayConfig(object):
+    # address to accept series from downstream agents on, either the path to
+    # a unix domain socket or host:port, disabled if unset.
+    listen = as_string('listen', allow_none=True)
+    # seconds after which a series which is no longer relayed is dropped.
+    expire = as_float('expire', default=30.0)
+
+    def __init__(self, listen, expire):
+        self.listen = listen
+        self.expire = expire
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        listen = cls.listen(data, p)
+        expire = cls.expire(data, p)
+        return RelayConfig(listen, expire)
+
+
+class QueryConfig(object):
+    # path to the unix domain socket to serve queries on, disabled if unset.
+    path = as_string('path', allow_none=True)
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        path = cls.path(data, p)
+        return QueryConfig(path)
+
+
+class AggregateConfig(object):
+    FUNCTIONS = set(['sum', 'avg', 'min', 'max', 'count'])
+    TRANSFORMS = set(['rate', 'delta'])
+
+    # tags (with glob patterns as values) that a series must have.
+    match = as_dict('match')
+    # tags to group by, or every series by itself if unset.
+    by = as_list('by', allow_none=True)
+    # functions to aggregate with, pNN for percentiles.
+    functions = as_list('functions', default=['avg'])
+    # number of collections to aggregate over before emitting.
+    window = as_int('window', default=1)
+    # transform applied to each series before aggregating.
+    transform = as_string('transform', allow_none=True)
+    # keep emitting the matched series as-is.
+    keep = as_bool('keep', default=False)
+
+    def __init__(self, match, by, functions, window, transform, keep):
+        self.match = match
+        self.by = by
+        self.functions = functions
+        self.window = window
+        self.transform = transform
+        self.keep = keep
+
+    @classmethod
+    def is_function(cls, f):
+        if f in cls.FUNCTIONS:
+            return True
+
+        if not f.startswith('p'):
+            return False
+
+        try:
+            return 0 <= float(f[1:]) <= 100
+        except ValueError:
+            return False
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        match = cls.match(data, p)
+        by = cls.by(data, p)
+        functions = cls.functions(data, p)
+        window = cls.window(data, p)
+        transform = cls.transform(data, p)
+        keep = cls.keep(data, p)
+
+        for i, f in enumerate(functions):
+            if not cls.is_function(str(f)):
+                raise ConfigException(
+                    '{0}: not a valid function: {1}'.format(
+                        path(p + ['functions', i]), repr(f)))
+
+        if window < 1:
+            raise ConfigException(
+                '{0}: must be at least 1'.format(path(p + ['window'])))
+
+        if transform is not None and transform not in cls.TRANSFORMS:
+            raise ConfigException(
+                '{0}: not a valid transform: {1}'.format(
+                    path(p + ['transform']), repr(transform)))
+
+        return AggregateConfig(match, by, functions, window, transform, keep)
+
+
+class DeadbandConfig(object):
+    # tags (with glob patterns as values) that a series must have.
+    match = as_dict('match')
+    # changes smaller than or equal to this are not emitted.
+    absolute = as_float('absolute', default=0.0)
+    # changes smaller than or equal to this fraction of the last emitted
+    # value are not emitted.
+    relative = as_float('relative', default=0.0)
+
+    def __init__(self, match, absolute, relative):
+        self.match = match
+        self.absolute = absolute
+        self.relative = relative
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        match = cls.match(data, p)
+        absolute = cls.absolute(data, p)
+        relative = cls.relative(data, p)
+        return DeadbandConfig(match, absolute, relative)
+
+
+class ChangesConfig(object):
+    # only emit series which have changed since they were last emitted.
+    enabled = as_bool('enabled', default=False)
+    # number of collections between emitting every series.
+    heartbeat = as_int('heartbeat', default=10)
+    # deadbands for matching series, the first matching one is used.
+    deadband = as_list('deadband', default=[], sub=DeadbandConfig.load)
+
+    def __init__(self, enabled, heartbeat, deadband):
+        self.enabled = enabled
+        self.heartbeat = heartbeat
+        self.deadband = deadband
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        enabled = cls.enabled(data, p)
+        heartbeat = cls.heartbeat(data, p)
+        deadband = cls.deadband(data, p)
+
+        if heartbeat < 1:
+            raise ConfigException(
+                '{0}: must be at least 1'.format(path(p + ['heartbeat'])))
+
+        return ChangesConfig(enabled, heartbeat, deadband)
+
+
+class SchedulerConfig(object):
+    # skip collectors with the lowest priority when a collection overruns its
+    # interval, instead of backing off.
+    shed = as_bool('shed', default=False)
+    # fraction of the interval a collection must stay under before shed
+    # collectors are brought back.
+    restore = as_float('restore', default=0.5)
+    # let collection rounds overlap, every collector is collected on its own
+    # cadence and results are taken whenever they arrive.
+    pipelined = as_bool('pipelined', default=False)
+
+    def __init__(self, shed, restore, pipelined):
+        self.shed = shed
+        self.restore = restore
+        self.pipelined = pipelined
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        shed = cls.shed(data, p)
+        restore = cls.restore(data, p)
+        pipelined = cls.pipelined(data, p)
+        return SchedulerConfig(shed, restore, pipelined)
+
+
+class StartupConfig(object):
+    # number of collectors set up concurrently.
+    workers = as_int('workers', default=4)
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        workers = cls.workers(data, p)
+
+        if workers < 1:
+            raise ConfigException(
+                '{0}: must be at least 1'.format(path(p + ['workers'])))
+
+        return StartupConfig(workers)
+
+
+class OutputConfig(object):
     type = as_string('type', access=dict_pop)
 
     def __init__(self, type, config):
@@ -204,7 +581,193 @@ class CollectorConfig(object):
     def load(cls, data, p=[]):
         data = dict(data)
         type = cls.type(data, p)
-        return CollectorConfig(type, data)
+        return OutputConfig(type, data)
+
+    def __repr__(self):
+        return "<output type={0} config={1}>".format(self.type, self.config)
+
+
+class HistoryConfig(object):
+    # tags (with glob patterns as values) that a series must have.
+    match = as_dict('match')
+    # number of samples to keep.
+    size = as_int('size', default=60)
+
+    def __init__(self, match, size):
+        self.match = match
+        self.size = size
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        match = cls.match(data, p)
+        size = cls.size(data, p)
+        return HistoryConfig(match, size)
+
+
+class RelabelConfig(object):
+    ACTIONS = set(['keep', 'drop', 'rename', 'set'])
+
+    # tags (with regular expressions as values) that a series must have.
+    match = as_dict('match')
+    # one of keep, drop, rename or set.
+    action = as_string('action')
+    # tag to rename or set.
+    tag = as_string('tag', allow_none=True)
+    # new name of the renamed tag.
+    to = as_string('to', allow_none=True)
+    # value of the set tag.
+    value = as_string('value', allow_none=True)
+
+    def __init__(self, match, action, tag, to, value):
+        self.match = match
+        self.action = action
+        self.tag = tag
+        self.to = to
+        self.value = value
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        match = cls.match(data, p)
+        action = cls.action(data, p)
+        tag = cls.tag(data, p)
+        to = cls.to(data, p)
+        value = cls.value(data, p)
+
+        if action not in cls.ACTIONS:
+            raise ConfigException(
+                '{0}: not a valid action: {1}'.format(
+                    path(p + ['action']), repr(action)))
+
+        for k, pattern in match.items():
+            try:
+                re.compile(str(pattern))
+            except re.error as e:
+                raise ConfigException(
+                    '{0}: not a valid regular expression: {1}'.format(
+                        path(p + ['match', k]), e))
+
+        if action in ('rename', 'set') and tag is None:
+            raise ConfigException(
+                '{0}: required by {1}'.format(path(p + ['tag']), action))
+
+        if action == 'rename' and to is None:
+            raise ConfigException(
+                '{0}: required by rename'.format(path(p + ['to'])))
+
+        if action == 'set' and value is None:
+            raise ConfigException(
+                '{0}: required by set'.format(path(p + ['value'])))
+
+        return RelabelConfig(match, action, tag, to, value)
+
+
+class RegistryConfig(object):
+    # history to keep for matching metrics, the first match is used.
+    history = as_list('history', default=[], sub=HistoryConfig.load)
+    # file to map the registry from, which keeps the last known values of
+    # every series across restarts.
+    file = as_string('file', allow_none=True)
+    # number of series that fit in the file.
+    file_capacity = as_int('file_capacity', default=65536)
+    # most series that collectors may register in total.
+    max_series = as_int('max_series', allow_none=True)
+    # what to do with series that do not fit a budget, reject or fold.
+    overflow = as_string('overflow', default='reject')
+    # rules which rewrite or drop series as they are registered, in order.
+    relabel = as_list('relabel', default=[], sub=RelabelConfig.load)
+
+    OVERFLOW_POLICIES = set(['reject', 'fold'])
+
+    def __init__(self, history, file, file_capacity, max_series, overflow,
+                 relabel):
+        self.history = history
+        self.file = file
+        self.file_capacity = file_capacity
+        self.max_series = max_series
+        self.overflow = overflow
+        self.relabel = relabel
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        history = cls.history(data, p)
+        file = cls.file(data, p)
+        file_capacity = cls.file_capacity(data, p)
+        max_series = cls.max_series(data, p)
+        overflow = cls.overflow(data, p)
+        relabel = cls.relabel(data, p)
+
+        if file_capacity <= 0:
+            raise ConfigException(
+                '{0}: must be positive'.format(path(p + ['file_capacity'])))
+
+        if max_series is not None and max_series <= 0:
+            raise ConfigException(
+                '{0}: must be positive'.format(path(p + ['max_series'])))
+
+        if overflow not in cls.OVERFLOW_POLICIES:
+            raise ConfigException(
+                '{0}: not a valid policy: {1}'.format(
+                    path(p + ['overflow']), repr(overflow)))
+
+        return RegistryConfig(history, file, file_capacity, max_series,
+                              overflow, relabel)
+
+
+class CollectorConfig(object):
+    type = as_string('type', access=dict_pop)
+    # collectors with a lower priority are shed first when the agent overruns
+    # its interval.
+    priority = as_int('priority', default=0, access=dict_pop)
+    # name of the priority class that collector processes run in.
+    priority_class = as_string('priority_class', allow_none=True,
+                               access=dict_pop)
+    # CPU seconds that a single collection may use, the collector is
+    # collected less often if it uses more.
+    cpu_budget = as_float('cpu_budget', allow_none=True, access=dict_pop)
+    # seconds between collections of this collector, defaults to the interval
+    # of the agent.
+    interval = as_float('interval', allow_none=True, access=dict_pop)
+    # most series that a single instance of the collector may register.
+    max_series = as_int('max_series', allow_none=True, access=dict_pop)
+
+    def __init__(self, type, priority, priority_class, cpu_budget, interval,
+                 max_series, config):
+        self.type = type
+        self.priority = priority
+        self.priority_class = priority_class
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.max_series = max_series
+        self.config = config
+
+    @classmethod
+    @load_entry
+    def load(cls, data, p=[]):
+        data = dict(data)
+        type = cls.type(data, p)
+        priority = cls.priority(data, p)
+        priority_class = cls.priority_class(data, p)
+        cpu_budget = cls.cpu_budget(data, p)
+        interval = cls.interval(data, p)
+        max_series = cls.max_series(data, p)
+
+        if cpu_budget is not None and cpu_budget <= 0:
+            raise ConfigException(
+                '{0}: must be positive'.format(path(p + ['cpu_budget'])))
+
+        if interval is not None and interval <= 0:
+            raise ConfigException(
+                '{0}: must be positive'.format(path(p + ['interval'])))
+
+        if max_series is not None and max_series <= 0:
+            raise ConfigException(
+                '{0}: must be positive'.format(path(p + ['max_series'])))
+
+        return CollectorConfig(type, priority, priority_class, cpu_budget,
+                               interval, max_series, data)
 
     def __repr__(self):
         return "<collector type={0} config={1}>".format(self.type, self.config)
@@ -214,11 +777,37 @@ class Root(object):
     collectors = as_list('collectors', sub=CollectorConfig.load)
     tags = as_dict('tags')
     instance_config = as_load('instance_config', InstanceConfig)
-
-    def __init__(self, tags, collectors, instance_config):
+    registry = as_load('registry', RegistryConfig)
+    procfs = as_load('procfs', ProcFSConfig)
+    fanout = as_load('fanout', FanOutConfig)
+    query = as_load('query', QueryConfig)
+    aggregate = as_list('aggregate', default=[], sub=AggregateConfig.load)
+    changes = as_load('changes', ChangesConfig)
+    outputs = as_list('outputs', default=[], sub=OutputConfig.load)
+    scheduler = as_load('scheduler', SchedulerConfig)
+    priority_classes = as_list('priority_classes', default=[],
+                               sub=PriorityClassConfig.load)
+    startup = as_load('startup', StartupConfig)
+    relay = as_load('relay', RelayConfig)
+
+    def __init__(self, tags, collectors, instance_config, registry, procfs,
+                 fanout, query, aggregate, changes, outputs, scheduler,
+                 priority_classes, startup, relay):
         self.tags = tags
         self.collectors = collectors
         self.instance_config = instance_config
+        self.registry = registry
+        self.procfs = procfs
+        self.fanout = fanout
+        self.query = query
+        self.aggregate = aggregate
+        self.changes = changes
+        self.outputs = outputs
+        self.scheduler = scheduler
+        # priority classes by name.
+        self.priority_classes = priority_classes
+        self.startup = startup
+        self.relay = relay
 
     @classmethod
     @load_entry
@@ -226,4 +815,34 @@ class Root(object):
         tags = cls.tags(data, p)
         collectors = cls.collectors(data, p)
         instance_config = cls.instance_config(data, p)
-        return Root(tags, collectors, instance_config)
+        registry = cls.registry(data, p)
+        procfs = cls.procfs(data, p)
+        fanout = cls.fanout(data, p)
+        query = cls.query(data, p)
+        aggregate = cls.aggregate(data, p)
+        changes = cls.changes(data, p)
+        outputs = cls.outputs(data, p)
+        scheduler = cls.scheduler(data, p)
+        startup = cls.startup(data, p)
+        relay = cls.relay(data, p)
+        priority_classes = dict()
+
+        for i, pc in enumerate(cls.priority_classes(data, p)):
+            if pc.name in priority_classes:
+                raise ConfigException(
+                    '{0}: duplicate priority class: {1}'.format(
+                        path(p + ['priority_classes', i]), pc.name))
+
+            priority_classes[pc.name] = pc
+
+        for i, c in enumerate(collectors):
+            if c.priority_class is not None and \
+               c.priority_class not in priority_classes:
+                raise ConfigException(
+                    '{0}: not a known priority class: {1}'.format(
+                        path(p + ['collectors', i, 'priority_class']),
+                        c.priority_class))
+
+        return Root(tags, collectors, instance_config, registry, procfs,
+                    fanout, query, aggregate, changes, outputs, scheduler,
+                    priority_classes, startup, relay)
@@ -1,23 +1,49 @@
 import multiprocessing as mp
 import logging
-import yaml
 import os.path
 import sys
 import time
 import queue
+import select
+
+from concurrent.futures import ThreadPoolExecutor
 
 from .registry import Registry
+from .arena import Arena
+from .relabel import Rule
 from .injector import Injector
 from .platform import Platform
-from .collector import Collector
+from .procfs import ProcFS, Fixture
+from .fanout import FanOut
+from .query import QueryServer
+from .relay import Relay, RelayServer
+from .pipeline import Pipeline
+from .aggregate import Aggregator
+from .changes import Changes
+from .output import build_outputs
+from .collector import Collector, fork_guard
 from .config import Root, ConfigException
 
 log = logging.getLogger(__name__)
 
 TASK_MOD = 2 ** 20
+# seconds between checking for collectors which have been set up.
+STARTING_POLL = 0.1
+# longest wait for results in pipelined mode, before serving queries.
+PIPELINE_POLL = 0.1
+# seconds to wait before polling again after polling failed.
+POLL_RETRY = 0.1
 
 
 class Core(object):
+    # tags of the metrics of the series used by every collector, see
+    # #_update_usage.
+    USAGE_METRICS = [
+        dict(what='series', unit='series'),
+        dict(what='series-rejected', unit='series'),
+        dict(what='series-memory', unit='B'),
+    ]
+
     def __init__(self, **kw):
         self._timeout = kw.get('timeout', 10)
         self._interval = kw.get('interval', 30)
@@ -27,45 +53,269 @@ class Core(object):
         self._out = mp.Queue()
         self._collectors = None
         self._registry = None
+        self._procfs = None
+        self._query = None
+        self._relay = None
+        self._relay_server = None
+        self._pipeline = None
+        self._scheduler = None
+        # number of priority levels currently shed, see #shed_more.
+        self._shed = 0
+        # collectors which are being set up, by their future, and the set of
+        # them.
+        self._starting = dict()
+        self._starting_collectors = set()
+        self._executor = None
+        # time at which the collectors were set up, and the
+        # time-to-first-sample metric of every collector.
+        self._setup_time = None
+        self._first_samples = dict()
+        # metrics of the series used by every collector, as
+        # (series, rejected, bytes), and by the whole registry.
+        self._usage = dict()
+        self._registry_usage = None
         self._signalled = False
         self._taskid = 0
+        # in pipelined mode, the number of times a collector was due while
+        # still busy, and the largest fraction of its cadence that a task
+        # took, in the current round.
+        self._behind = 0
+        self._load = 0.0
 
     def signalled(self):
         self._signalled = True
 
     def setup(self):
-        self._collectors, self._registry = self._setup()
+        root, self._collectors, self._registry, self._procfs = self._setup()
+
+        if root.relay.listen is not None:
+            self._relay = Relay(root.relay.expire)
+            self._relay_server = RelayServer(root.relay.listen, self._relay)
+            self._start_relay()
+
+        self._pipeline = self._build_pipeline(root)
+        self._scheduler = root.scheduler
+        self._start_collectors(root)
+
+        if root.query.path is not None:
+            self._query = QueryServer(root.query.path, self._registry)
+            self._start_query()
+
+    def _start_query(self):
+        self._query.start()
+
+    def _start_relay(self):
+        self._relay_server.start()
 
     def stop(self):
+        self._abandon_starting()
+
+        if self._executor is not None:
+            self._executor.shutdown(False)
+            self._executor = None
+
         for c in self._collectors:
             c.stop()
 
+        if self._query is not None:
+            self._query.stop()
+
+        if self._relay_server is not None:
+            self._relay_server.stop()
+
+        self._pipeline.stop()
+
     def reload(self):
         log.info('reloading collectors')
 
         try:
-            collectors, registry = self._setup()
+            root, collectors, registry, procfs = self._setup()
+            pipeline = self._build_pipeline(root)
         except:
             log.error('reload failed', exc_info=sys.exc_info())
         else:
+            self._abandon_starting()
+
             for c in self._collectors:
                 log.debug('%s: deallocating', c)
                 c.stop()
 
             self._collectors = collectors
             self._registry = registry
+            self._procfs = procfs
+
+            self._pipeline.stop()
+            self._pipeline = pipeline
+            self._scheduler = root.scheduler
+            self._shed = 0
+            self._start_collectors(root)
+
+            if self._query is not None:
+                self._query.set_registry(registry)
+
+    def _start_collectors(self, root):
+        """
+        Set up all collectors concurrently in the background.
+
+        Collectors are started as soon as they have been set up and no other
+        collector is being set up, see #poll_starting.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(False)
+
+        self._executor = ThreadPoolExecutor(root.startup.workers)
+        self._setup_time = time.time()
+        self._first_samples = dict()
+        self._usage = dict()
+
+        for c in self._collectors:
+            self._starting[self._executor.submit(c.prepare)] = c
+            self._starting_collectors.add(c)
+            _, m = self._registry.metric(
+                what='time-to-first-sample', unit='s', collector=c.name)
+            self._first_samples[c] = m
+            self._usage[c] = tuple(
+                self._registry.metric(collector=c.name, **t)[1]
+                for t in self.USAGE_METRICS)
+
+        self._registry_usage = (
+            self._registry.metric(what='registry-series', unit='series')[1],
+            self._registry.metric(what='registry-memory', unit='B')[1])
+
+    def _abandon_starting(self):
+        """
+        Discard collectors which are still being set up.
+        """
+        for f, c in self._starting.items():
+            if f.cancel():
+                continue
+
+            f.add_done_callback(lambda f, c=c: self._discard(f, c))
+
+        self._starting = dict()
+        self._starting_collectors = set()
+
+    def _discard(self, f, c):
+        if f.exception() is None:
+            c.discard(f.result())
+
+    def poll_starting(self):
+        """
+        Start every collector which has been set up, returning a list of the
+        collectors which were started.
+
+        Collectors are only started once no collector is being set up, since
+        starting one forks a process, see ForkGuard. The executor is shut down
+        once every collector has been started.
+        """
+        started = list()
+
+        if not fork_guard.idle():
+            return started
+
+        for f, c in list(self._starting.items()):
+            if not f.done():
+                continue
+
+            del self._starting[f]
+            self._starting_collectors.discard(c)
+
+            try:
+                prepared = f.result()
+            except:
+                # collect will retry setting up the collector.
+                log.error('%s: failed to set up', c, exc_info=sys.exc_info())
+                continue
+
+            try:
+                c.start(prepared)
+            except:
+                c.discard(prepared)
+                log.error('%s: failed to start', c, exc_info=sys.exc_info())
+                continue
+
+            log.info('%s: started in %0.2fs', c,
+                     time.time() - self._setup_time)
+            started.append(c)
+
+        if len(self._starting) == 0 and self._executor is not None:
+            self._executor.shutdown(False)
+            self._executor = None
+
+        return started
+
+    def starting(self, c):
+        """
+        Check if the given collector is still being set up.
+        """
+        return c in self._starting_collectors
+
+    def _update_first_samples(self):
+        for c, m in self._first_samples.items():
+            if c.first_sample is not None:
+                m.update(c.first_sample - self._setup_time)
+
+    def _update_usage(self):
+        for c, (series, rejected, nbytes) in self._usage.items():
+            group = c.registry
+            s, b = group.usage()
+            series.update(s)
+            rejected.update(group.rejected)
+            nbytes.update(b)
+
+        series, nbytes = self._registry_usage
+        s, b = self._registry.usage()
+        series.update(s)
+        nbytes.update(b)
 
     def check_collectors(self):
         for c in self._collectors:
+            if self.starting(c):
+                continue
+
             try:
                 c.check()
             except:
                 log.error('%s: failed to check', c, exc_info=sys.exc_info())
 
-    def collect_all(self):
+    def collect_all(self, collectors=None):
+        """
+        Collect from all collectors, or only from the given ones.
+
+        Collecting from only some collectors does not start a new generation,
+        so the series of the others are not considered stale.
+        """
         collects = dict()
+        # task id to the time at which it times out.
+        deadlines = dict()
+        full = collectors is None
+        now = time.time()
+
+        if full:
+            self.poll_starting()
+            collectors = self._collectors
+            self._procfs.tick()
+            self._registry.advance()
+
+        for c in collectors:
+            if self.starting(c):
+                continue
+
+            # rounds are only ever late, so half a round is close enough.
+            if full and not self.due(c, now, self._interval / 2):
+                continue
+
+            if self.is_shed(c):
+                log.debug('%s: shed', c)
+                continue
+
+            if c.busy() and c.skip():
+                continue
+
+            if c.throttled():
+                log.debug('%s: throttled', c)
+                continue
 
-        for c in self._collectors:
             i = self._taskid
             self._taskid = (self._taskid + 1) % TASK_MOD
 
@@ -76,58 +326,279 @@ class Core(object):
                 continue
 
             collects[i] = c
-
-        time_left = self._timeout
-        then = time.time()
+            deadlines[i] = time.time() + c.timeout_after(self._timeout)
 
         while len(collects) > 0:
+            # wait until every pending collector is past its own timeout.
+            time_left = max(deadlines[i] for i in collects) - time.time()
+
             if time_left <= 0:
                 break
 
             try:
-                i, ok = self._out.get(True, time_left)
+                i, ok, cpu = self._out.get(True, time_left)
             except queue.Empty:
                 # timeout
                 break
 
-            now = time.time()
-            time_left -= (now - then)
-            then = now
-
             c = collects.pop(i, None)
 
             if c is None:
-                log.error('no collector associated with id %d', i)
+                self._late(i, ok, cpu)
                 continue
 
-            # mark collector as errored.
-            if not ok:
-                c.errored()
+            c.done(ok, cpu)
 
-        # restart collectors that did not finish in time
+        # apply the timeout policy to collectors that did not finish in time
         for i, c in collects.items():
             log.warn('%s: timeout (task %d)', c, i)
-            c.restart()
+            c.timeout(i)
 
         # empty output queue for straggling processes.
         # at this point, all processes which were not part of the current
-        # collection must be dead.
+        # collection must either be dead or busy.
         while True:
             try:
-                self._out.get_nowait()
+                i, ok, cpu = self._out.get_nowait()
             except queue.Empty:
                 break
 
+            self._late(i, ok, cpu)
+
+        self._update_first_samples()
+        self._update_usage()
+
+    def _late(self, i, ok, cpu):
+        """
+        Handle a result that arrived after its collection was over.
+        """
+        c = self._finished(i, ok, cpu)
+
+        if c is not None:
+            log.info('%s: finished late (task %d)', c, i)
+
+    def _finished(self, i, ok, cpu):
+        """
+        Hand the result of task i to the collector which is busy with it,
+        returning that collector.
+        """
+        for c in self._collectors:
+            if c.finished(i, ok, cpu):
+                if c.last_duration is not None:
+                    self._load = max(self._load, c.last_duration / (
+                        c.interval or self._interval))
+
+                return c
+
+        log.error('no collector associated with id %d', i)
+        return None
+
+    def due(self, c, now, slack=0.0):
+        """
+        Check if the collector is due on its own cadence, scheduling its next
+        collection if it is.
+        """
+        if now < c.next_run - slack:
+            return False
+
+        c.next_run = now + (c.interval or self._interval)
+        return True
+
+    def dispatch(self, now):
+        """
+        Start a task for every collector which is due, in pipelined mode.
+
+        A collector which is still busy with an earlier task skips being due,
+        and is only counted as skipped once its task is past its timeout.
+        """
+        if len(self._starting) > 0:
+            self.poll_starting()
+
+        for c in self._collectors:
+            if self.starting(c) or not self.due(c, now):
+                continue
+
+            if self.is_shed(c):
+                continue
+
+            if c.busy():
+                self._behind += 1
+
+                if c.deadline is not None or c.skip():
+                    log.debug('%s: busy, skipping', c)
+                    continue
+
+            if c.throttled():
+                log.debug('%s: throttled', c)
+                continue
+
+            i = self._taskid
+            self._taskid = (self._taskid + 1) % TASK_MOD
+
+            try:
+                c.collect(i)
+            except Exception:
+                log.error('%s: failed to collect', c, exc_info=sys.exc_info())
+                continue
+
+            c.track(i, now + c.timeout_after(self._timeout))
+
+    def expire(self, now):
+        for c in self._collectors:
+            c.expire(now)
+
+    def wake_after(self, now, next_round):
+        """
+        Seconds until the next round, the next collector is due or the next
+        task times out, whichever comes first.
+        """
+        wake = next_round
+
+        for c in self._collectors:
+            if not self.starting(c):
+                wake = min(wake, c.next_run)
+
+            if c.deadline is not None:
+                wake = min(wake, c.deadline)
+
+        return max(0, wake - now)
+
+    def begin_round(self):
+        self._procfs.tick()
+        self._registry.advance()
+        self._behind = 0
+        self._load = 0.0
+
+    def end_round(self):
+        self._update_first_samples()
+        self._update_usage()
+        self._registry.harvest()
+        self._registry.sync()
+        self._emit()
+        self.balance()
+
+    def balance(self):
+        """
+        Shed or restore collectors after a pipelined round.
+
+        A round falls behind if any collector was still busy when it was due
+        again, in which case one more priority level is shed. Otherwise the
+        last shed level is restored if no task took more than the restore
+        fraction of its cadence.
+        """
+        if self._behind > 0:
+            if self.shed_more():
+                log.warn('%d collection(s) fell behind', self._behind)
+
+            return
+
+        self.restore(self._load * self._interval)
+
+    def is_shed(self, c):
+        """
+        Check if the given collector is currently shed.
+        """
+        if self._shed == 0:
+            return False
+
+        return c.priority < self._priorities()[self._shed]
+
+    def shed_more(self):
+        """
+        Shed the lowest priority level of collectors which is still collected.
+
+        The highest priority level is never shed. Returns False if nothing more
+        could be shed.
+        """
+        if not self._scheduler.shed:
+            return False
+
+        priorities = self._priorities()
+
+        if self._shed >= len(priorities) - 1:
+            return False
+
+        self._shed += 1
+        log.warn('shedding collectors with priority below %d',
+                 priorities[self._shed])
+        return True
+
+    def restore(self, elapsed):
+        """
+        Restore the last shed level of collectors if the last collection took
+        comfortably less than the interval.
+        """
+        if self._shed == 0:
+            return
+
+        if elapsed >= self._interval * self._scheduler.restore:
+            return
+
+        self._shed -= 1
+        log.info('restoring collectors with priority %d',
+                 self._priorities()[self._shed])
+
+    def _priorities(self):
+        return sorted(set(c.priority for c in self._collectors))
+
+    def run_round(self):
+        """
+        Run a single round in pipelined mode.
+
+        Collectors are started whenever they are due, and their results are
+        taken whenever they arrive, no matter which round started them. The
+        round ends after the interval, with the results that have arrived by
+        then.
+        """
+        self._signalled = False
+        next_round = time.time() + self._interval
+
+        self.begin_round()
+
+        while not self._signalled:
+            now = time.time()
+            self.dispatch(now)
+            self.expire(now)
+
+            if now >= next_round:
+                break
+
+            timeout = min(PIPELINE_POLL, self.wake_after(now, next_round))
+
+            try:
+                i, ok, cpu = self._out.get(True, timeout)
+            except queue.Empty:
+                pass
+            else:
+                self._finished(i, ok, cpu)
+
+            self.serve()
+
+        if self._signalled:
+            return
+
+        self.end_round()
+        self.check_collectors()
+
     def run_once(self):
+        if self._scheduler.pipelined:
+            self.run_round()
+            return
+
         self._signalled = False
 
-        next_run = (time.time() + self._interval)
+        started = time.time()
+        next_run = started + self._interval
 
         self.collect_all()
 
         if self._signalled:
             return
 
+        self._registry.harvest()
+        self._registry.sync()
+        self._emit()
+
         if log.isEnabledFor(logging.DEBUG):
             log.debug("%d value(s)", sum(1 for i in self._registry.values))
             log.debug("%d state(s)", sum(1 for i in self._registry.states))
@@ -135,29 +606,104 @@ class Core(object):
         diff = next_run - time.time()
 
         if diff > 0:
+            self.restore(time.time() - started)
             log.debug('sleep: %0.2fs', diff)
 
             while diff > 0:
-                time.sleep(1.0)
+                step = STARTING_POLL if len(self._starting) > 0 else 1.0
+                self.idle(step)
 
                 if self._signalled:
                     return
 
+                self.collect_started()
                 self.check_collectors()
-                diff = min(next_run - time.time(), diff - 1.0)
+                diff = min(next_run - time.time(), diff - step)
 
             # sleep the rest of the time if necessary
             tail = next_run - time.time()
 
             if tail > 0:
                 log.debug('tail=%0.2fs', tail)
-                time.sleep(tail)
+                self.idle(tail)
 
             return
 
+        if self.shed_more():
+            log.warn("Run took %0.2fs too long :(", -diff)
+            return
+
         log.warn("Run took %0.2fs too long :(, sleeping %ds",
                  -diff, self._backoff)
-        time.sleep(self._backoff)
+        self.idle(self._backoff)
+
+    def collect_started(self):
+        """
+        Collect right away from collectors which have been started since the
+        last collection, instead of waiting for the next one.
+
+        The results are available to queries right away, but are only handed
+        to the pipeline with the next collection, since stages count every
+        batch as a whole collection.
+        """
+        started = self.poll_starting()
+
+        if len(started) == 0:
+            return
+
+        self.collect_all(started)
+
+    def _emit(self):
+        """
+        Run the pipeline on the current state of the registry.
+        """
+        self._pipeline(self._registry, time.time())
+
+    def _servers(self):
+        servers = [s for s in (self._query, self._relay_server)
+                   if s is not None]
+        return servers + self._pipeline.servers()
+
+    def serve(self):
+        """
+        Serve pending queries without waiting, in pipelined mode.
+        """
+        servers = self._servers()
+
+        if len(servers) == 0:
+            return
+
+        try:
+            poll(servers, 0)
+        except:
+            log.error('poll failed', exc_info=sys.exc_info())
+
+    def idle(self, duration):
+        """
+        Sleep for the given duration, serving queries in the meantime.
+
+        Queries and relayed series are only ever served while idle, so that
+        they never delay a collection.
+        """
+        servers = self._servers()
+
+        if len(servers) == 0:
+            time.sleep(duration)
+            return
+
+        deadline = time.time() + duration
+
+        while not self._signalled:
+            left = deadline - time.time()
+
+            if left <= 0:
+                break
+
+            try:
+                poll(servers, left)
+            except:
+                log.error('poll failed', exc_info=sys.exc_info())
+                time.sleep(min(left, POLL_RETRY))
 
     def _setup(self):
         config = load_config(self._config_path)
@@ -173,16 +719,55 @@ class Core(object):
             raise Exception('{0}: could not load configuration'.format(
                 self._config_path))
 
-        registry = Registry(**config.get('tags', {}))
+        history = [(dict((k, str(v)) for k, v in h.match.items()), h.size)
+                   for h in root.registry.history]
+        arena = None
+
+        if root.registry.file is not None:
+            arena = Arena(root.registry.file, root.registry.file_capacity)
 
-        components = dict(platform=Platform(), registry=registry)
+        relabel = [Rule(r.action, r.match, r.tag, r.to, r.value)
+                   for r in root.registry.relabel]
+
+        registry = Registry(root.tags, history=history, arena=arena,
+                            max_series=root.registry.max_series,
+                            overflow=root.registry.overflow, relabel=relabel)
+
+        if root.procfs.fixture is not None:
+            procfs = Fixture(root.procfs.fixture)
+        else:
+            procfs = ProcFS(root.procfs.root)
+
+        log.info('procfs: %s', procfs)
+
+        fanout = FanOut(root.fanout.workers, root.fanout.timeout,
+                        root.fanout.budget, root.fanout.quarantine)
+
+        components = dict(platform=Platform(), registry=registry,
+                          procfs=procfs, fanout=fanout)
         injector = Injector(components)
 
-        known = self._load_collectors()
+        known = load_collectors(self._collector_paths)
 
         collectors = self._build_collectors(known, root, injector)
 
-        return collectors, registry
+        return root, collectors, registry, procfs
+
+    def _build_pipeline(self, root):
+        stages = list()
+
+        if len(root.aggregate) > 0:
+            stages.append(Aggregator(root.aggregate))
+
+        if root.changes.enabled:
+            stages.append(Changes(root.changes))
+
+        sources = list()
+
+        if self._relay is not None:
+            sources.append(self._relay)
+
+        return Pipeline(stages, build_outputs(root.outputs), sources)
 
     def _build_collectors(self, known, root, injector):
         collectors = []
@@ -195,34 +780,68 @@ class Core(object):
                     "'{0}' is not a known collector type".format(c.type))
 
             child = injector.child(dict(config=c.config))
+            child.require('registry').budget(c.type, c.max_series)
+            priority_class = None
+
+            if c.priority_class is not None:
+                priority_class = root.priority_classes[c.priority_class]
+
             collector = Collector(
-                path, c.type, self._out, child, root.instance_config)
+                path, c.type, self._out, child, root.instance_config,
+                priority=c.priority, priority_class=priority_class,
+                cpu_budget=c.cpu_budget, interval=c.interval)
             collectors.append(collector)
 
         return collectors
 
-    def _load_collectors(self):
-        collectors = dict()
 
-        for p in self._collector_paths:
-            if not os.path.isdir(p):
-                continue
+def poll(servers, timeout):
+    """
+    Wait at most timeout seconds for activity on any of the given servers,
+    and service it.
+    """
+    lists = [(s, s.rlist(), s.wlist()) for s in servers]
+    rlist = [x for _, r, _ in lists for x in r]
+    wlist = [x for _, _, w in lists for x in w]
 
-            for n in os.listdir(p):
-                if n.startswith('.') or not n.endswith('.py'):
-                    continue
+    r, w, _ = select.select(rlist, wlist, [], timeout)
+
+    # a server which fails must not keep the others from being serviced.
+    for s, rl, wl in lists:
+        try:
+            s.service([x for x in r if x in rl], [x for x in w if x in wl])
+        except:
+            log.error('%s: failed to service', s, exc_info=sys.exc_info())
 
-                path = os.path.join(p, n)
-                name, _ = os.path.splitext(n)
 
-                collectors[name] = path
+def load_collectors(paths):
+    """
+    Scan the given paths for collectors, returning a dict of name to path.
+    """
+    collectors = dict()
 
-        return collectors
+    for p in paths:
+        if not os.path.isdir(p):
+            continue
+
+        for n in os.listdir(p):
+            if n.startswith('.') or not n.endswith('.py'):
+                continue
+
+            path = os.path.join(p, n)
+            name, _ = os.path.splitext(n)
+
+            collectors[name] = path
+
+    return collectors
 
 
 def load_config(path):
     if path is None or not os.path.isfile(path):
         return {}
 
+    # yaml is slow to import, and not needed without a configuration.
+    import yaml
+
     with open(path) as f:
-        return yaml.load(f)
+        return yaml.safe_load(f)
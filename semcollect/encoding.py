@@ -0,0 +1,169 @@
+"""
+Encodings for snapshots of the registry.
+
+The binary format is a header followed by one entry per series, all fields in
+network byte order.
+
+    header: magic (4s), version (B), count (I), time (d)
+    entry:  id (I), kind (B), value (d), number of tags (H),
+            followed by every tag as length (H) prefixed utf-8 key and value.
+
+The text format has one line per series, in the form of:
+
+    <what>{<tag>="<value>",...} <value>
+
+The history format is the text format with one line per sample, and the
+timestamp of the sample in milliseconds at the end of the line.
+"""
+import re
+import struct
+
+from .registry import Registry
+
+MAGIC = b'SEMC'
+VERSION = 1
+
+HEADER = struct.Struct('!4sBId')
+ENTRY = struct.Struct('!IBdH')
+LENGTH = struct.Struct('!H')
+
+INVALID_NAME = re.compile('[^a-zA-Z0-9_:]')
+
+
+class EncodingException(Exception):
+    pass
+
+
+def encode_binary(series, now):
+    """
+    Encode an iterable of (id, kind, tags, value) into the binary format.
+    """
+    parts = [None]
+    count = 0
+
+    for n, kind, tags, value in series:
+        parts.append(ENTRY.pack(n, kind, float(value), len(tags)))
+        encode_tags(parts, tags)
+        count += 1
+
+    parts[0] = HEADER.pack(MAGIC, VERSION, count, now)
+    return b''.join(parts)
+
+
+def decode_binary(data):
+    """
+    Decode the binary format, returning the time of the snapshot and a list
+    of (id, kind, tags, value).
+    """
+    data = memoryview(data)
+
+    if len(data) < HEADER.size:
+        raise EncodingException('truncated header')
+
+    magic, version, count, now = HEADER.unpack_from(data, 0)
+
+    if magic != MAGIC or version != VERSION:
+        raise EncodingException('unsupported format')
+
+    o = HEADER.size
+    series = list()
+
+    try:
+        for _ in range(count):
+            n, kind, value, ntags = ENTRY.unpack_from(data, o)
+            o += ENTRY.size
+
+            tags, o = decode_tags(data, o, ntags)
+
+            if kind == Registry.STATE:
+                value = value == 1.0
+
+            series.append((n, kind, tags, value))
+    except struct.error:
+        raise EncodingException('truncated entry')
+
+    return now, series
+
+
+def encode_tags(parts, tags):
+    """
+    Append every tag as length prefixed utf-8 key and value to parts.
+    """
+    for k, v in sorted(tags.items()):
+        k = str(k).encode('utf-8')
+        v = str(v).encode('utf-8')
+        parts.append(LENGTH.pack(len(k)))
+        parts.append(k)
+        parts.append(LENGTH.pack(len(v)))
+        parts.append(v)
+
+
+def decode_tags(data, o, count):
+    """
+    Decode count tags from data at offset o, returning the tags and the
+    offset after them.
+    """
+    tags = dict()
+
+    for _ in range(count):
+        k, o = _decode_string(data, o)
+        v, o = _decode_string(data, o)
+        tags[k] = v
+
+    return tags, o
+
+
+def encode_text(series):
+    """
+    Encode an iterable of (id, kind, tags, value) into the text format.
+    """
+    lines = list()
+
+    for n, kind, tags, value in series:
+        lines.append('{0} {1}\n'.format(_text_name(tags), float(value)))
+
+    return ''.join(lines).encode('utf-8')
+
+
+def encode_history(series, history):
+    """
+    Encode the history of an iterable of (id, kind, tags, value), where
+    history is a function returning the history of a series, or None.
+    """
+    lines = list()
+
+    for n, kind, tags, value in series:
+        h = history(n)
+
+        if h is None:
+            continue
+
+        name = _text_name(tags)
+
+        for t, v in h.samples():
+            lines.append('{0} {1} {2}\n'.format(name, v, int(t * 1000)))
+
+    return ''.join(lines).encode('utf-8')
+
+
+def _text_name(tags):
+    tags = dict(tags)
+    what = INVALID_NAME.sub('_', str(tags.pop('what', 'unknown')))
+    labels = ','.join('{0}="{1}"'.format(k, _escape(v))
+                      for k, v in sorted(tags.items()))
+    return '{0}{{{1}}}'.format(what, labels)
+
+
+def _decode_string(data, o):
+    l, = LENGTH.unpack_from(data, o)
+    o += LENGTH.size
+
+    if o + l > len(data):
+        raise EncodingException('truncated string')
+
+    return bytes(data[o:o + l]).decode('utf-8'), o + l
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
@@ -0,0 +1,248 @@
+"""
+Fan-out of per-item work on a bounded number of threads.
+
+Intended for collectors which perform one potentially blocking call per item,
+like a statvfs per mount, where a single item hanging should not cost the
+results of all other items.
+
+Every item has its own deadline, counted from when it starts running, and the
+whole round has a budget. Items which have started but not finished when the
+round is over are quarantined: their threads are abandoned and replaced, and
+the item is not tried again until the call has returned and a number of rounds
+have passed. Items which never started are skipped, and reported as such.
+
+Worker threads are kept between rounds, and exit once they have been idle for
+a while. A process which is forked starts over with no workers.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import collections
+
+log = logging.getLogger(__name__)
+
+# seconds a worker waits for work before it exits.
+IDLE_TIMEOUT = 60.0
+
+
+class FanOut(object):
+    class Job(object):
+        def __init__(self, key, item):
+            self.key = key
+            self.item = item
+            self.started = None
+            self.done = False
+            self.ok = False
+            self.result = None
+            # the worker running the job has been replaced.
+            self.abandoned = False
+
+    class Round(object):
+        def __init__(self, f, jobs):
+            self.f = f
+            self.jobs = list(jobs)
+            self.cond = threading.Condition()
+            self.closed = False
+
+        def run(self, job):
+            """
+            Run job, returning True if its worker was replaced while it ran.
+            """
+            with self.cond:
+                if self.closed:
+                    return False
+
+                job.started = time.time()
+
+            try:
+                job.result = self.f(job.item)
+                job.ok = True
+            except:
+                log.debug('%s: failed', job.key, exc_info=sys.exc_info())
+
+            with self.cond:
+                job.done = True
+                self.cond.notify_all()
+                return job.abandoned
+
+    def __init__(self, workers=8, timeout=2.0, budget=10.0, quarantine=10):
+        self._workers = workers
+        self._timeout = timeout
+        self._budget = budget
+        self._quarantine = quarantine
+        # key to (job, rounds left) for quarantined items.
+        self._quarantined = dict()
+        # keys of items which were not run in the last round.
+        self._skipped = set()
+        self._reset()
+
+    def _reset(self):
+        # process the workers belong to.
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        # (round, job) waiting for a worker.
+        self._queue = collections.deque()
+        # number of workers which are not stuck with an abandoned job.
+        self._live = 0
+
+    def _worker(self):
+        while True:
+            deadline = time.time() + IDLE_TIMEOUT
+
+            with self._cond:
+                while len(self._queue) == 0:
+                    left = deadline - time.time()
+
+                    if left <= 0:
+                        self._live -= 1
+                        return
+
+                    self._cond.wait(left)
+
+                r, job = self._queue.popleft()
+
+            # replaced while running the job.
+            if r.run(job):
+                return
+
+    def _spawn(self, n):
+        """
+        Make sure that there are enough workers for n jobs.
+        """
+        with self._cond:
+            wanted = min(self._workers, n) - self._live
+
+            for _ in range(wanted):
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+                self._live += 1
+
+    def map(self, f, items, key=None):
+        """
+        Call f for every item, returning a list of (item, result) for every
+        item that completed successfully in time, in the order of items.
+
+        key is used to identify items across rounds, and defaults to the item
+        itself. The keys of items which were not run, because they are
+        quarantined or the round ran out of time before they started, are
+        available through skipped afterwards.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+        self._release()
+
+        jobs = list()
+        self._skipped = set()
+
+        for item in items:
+            k = item if key is None else key(item)
+
+            if k in self._quarantined:
+                self._skipped.add(k)
+                continue
+
+            jobs.append(FanOut.Job(k, item))
+
+        if len(jobs) == 0:
+            return []
+
+        r = FanOut.Round(f, jobs)
+
+        with self._cond:
+            self._queue.extend((r, job) for job in jobs)
+            self._cond.notify(len(jobs))
+
+        self._spawn(len(jobs))
+        self._wait(r)
+
+        with self._cond:
+            self._queue = collections.deque(
+                e for e in self._queue if e[0] is not r)
+
+        results = list()
+
+        for job in jobs:
+            with r.cond:
+                done = job.done
+                job.abandoned = not done and job.started is not None
+
+            if done:
+                if job.ok:
+                    results.append((job.item, job.result))
+
+                continue
+
+            if job.started is None:
+                log.debug('%s: not started in time, skipped', job.key)
+                self._skipped.add(job.key)
+                continue
+
+            log.warn('%s: did not finish in time, quarantined', job.key)
+            self._quarantined[job.key] = (job, self._quarantine)
+
+            with self._cond:
+                self._live -= 1
+
+        return results
+
+    @property
+    def quarantined(self):
+        return set(self._quarantined)
+
+    @property
+    def skipped(self):
+        """
+        Keys of the items which were not run in the last round.
+        """
+        return set(self._skipped)
+
+    def _wait(self, r):
+        deadline = time.time() + self._budget
+
+        with r.cond:
+            while True:
+                now = time.time()
+
+                if now >= deadline:
+                    break
+
+                pending = [j for j in r.jobs if not j.done]
+
+                if len(pending) == 0:
+                    break
+
+                # wake up when the next running item is due.
+                due = [j.started + self._timeout for j in pending
+                       if j.started is not None]
+                late = [d for d in due if d <= now]
+
+                # every worker is busy with an item that is late, nothing more
+                # will finish in time.
+                if len(late) >= min(self._workers, len(pending)):
+                    break
+
+                wake = min([d for d in due if d > now] + [deadline])
+                r.cond.wait(wake - now)
+
+            r.closed = True
+
+    def _release(self):
+        """
+        Release items from quarantine which have returned, and have spent
+        enough rounds in it.
+        """
+        for k, (job, left) in list(self._quarantined.items()):
+            if job.done and left <= 0:
+                log.info('%s: released from quarantine', k)
+                del self._quarantined[k]
+                continue
+
+            self._quarantined[k] = (job, left - 1)
+
+    def _injectchild(self):
+        return FanOut(self._workers, self._timeout, self._budget,
+                      self._quarantine)
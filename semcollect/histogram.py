@@ -0,0 +1,173 @@
+"""
+Distributions of values recorded by a collector, summarized every collection.
+
+Counts are kept in shared memory in two banks, of which the collector process
+records into the active one without any locking. The main process swaps the
+banks after every collection, and reads and resets the one which is no longer
+active.
+
+The counters can be stored in a chunk of the registry (see Registry#Chunk),
+where the generations column holds the counts of both banks, their busy
+counters and which bank is active, and the values column holds the sums.
+
+There is only ever one writer, which marks that it is recording by making the
+busy counter of the bank it records into odd, and then checks that the bank is
+still active. After swapping, the reader waits for the old bank to be idle
+before reading it, so that no sample is torn or recorded into a bank that has
+already been read.
+"""
+import time
+import math
+import bisect
+import multiprocessing as mp
+
+# number of times the reader waits for a record in progress, in case the
+# writer died while recording.
+MAX_SPINS = 1000
+
+
+def linear_buckets(start, width, count):
+    """
+    Upper bounds of count buckets of the given width, the first ending at
+    start.
+    """
+    return [start + width * i for i in range(count)]
+
+
+def log_linear_buckets(low, high, steps=9):
+    """
+    Upper bounds of buckets which are linear within every power of ten from
+    low to high, with the given number of steps per power.
+
+    With the default of 9 steps, log_linear_buckets(1, 1000) gives 1, 2, ...,
+    9, 10, 20, ..., 90, 100, 200, ..., 1000.
+    """
+    if low <= 0 or high <= low:
+        raise ValueError('expected 0 < low < high')
+
+    bounds = list()
+    decade = 10 ** math.floor(math.log10(low))
+
+    while True:
+        for i in range(steps):
+            b = decade + decade * 9 * i / steps
+
+            if b < low:
+                continue
+
+            if b > high:
+                return bounds
+
+            bounds.append(b)
+
+        decade *= 10
+
+        if decade > high:
+            bounds.append(decade)
+            return bounds
+
+
+def percentile(bounds, counts, q):
+    """
+    Estimate the qth percentile from the counts of every bucket, by linear
+    interpolation within the bucket it falls into.
+
+    counts has one more entry than bounds, for values above the last bound,
+    which are estimated as the last bound. Returns NaN without any counts.
+    """
+    total = sum(counts)
+
+    if total == 0:
+        return float('NaN')
+
+    rank = q / 100.0 * total
+    seen = 0
+
+    for i, c in enumerate(counts):
+        if c == 0 or seen + c < rank:
+            seen += c
+            continue
+
+        if i >= len(bounds):
+            return bounds[-1]
+
+        upper = bounds[i]
+        lower = bounds[i - 1] if i > 0 else min(0.0, upper)
+        return lower + (upper - lower) * (rank - seen) / c
+
+    return bounds[-1]
+
+
+class Histogram(object):
+    @staticmethod
+    def slots(bounds):
+        """
+        Number of slots of a chunk needed for the given bucket bounds.
+        """
+        return 2 * (len(bounds) + 1) + 3
+
+    def __init__(self, bounds, chunk=None):
+        bounds = list(bounds)
+
+        if len(bounds) == 0 or bounds != sorted(bounds):
+            raise ValueError('expected ascending bucket bounds')
+
+        self.bounds = bounds
+        self._n = len(bounds) + 1
+        # chunk of the registry the counters are stored in, if any.
+        self.chunk = chunk
+
+        if chunk is None:
+            self._counters = mp.RawArray('Q', Histogram.slots(bounds))
+            self._sums = mp.RawArray('d', 2)
+        else:
+            self._counters = chunk.generations
+            self._sums = chunk.values
+
+        # counts of both banks, then their busy counters and the active bank.
+        self._busy = 2 * self._n
+        self._active = self._busy + 2
+
+        # a chunk might have been used before.
+        self._counters[:self._active + 1] = [0] * (self._active + 1)
+        self._sums[:2] = [0.0, 0.0]
+
+    def record(self, value):
+        """
+        Record a single value. Only called by the collector process.
+        """
+        c = self._counters
+        b = c[self._active]
+        c[self._busy + b] += 1
+
+        # swapped after reading which bank was active.
+        if c[self._active] != b:
+            c[self._busy + b] += 1
+            b = 1 - b
+            c[self._busy + b] += 1
+
+        c[b * self._n + bisect.bisect_left(self.bounds, value)] += 1
+        self._sums[b] += value
+        c[self._busy + b] += 1
+
+    def swap(self):
+        """
+        Take the counts of every bucket and the sum of all values recorded
+        since the last swap, and reset them. Only called by the main process.
+        """
+        c = self._counters
+        b = c[self._active]
+        c[self._active] = 1 - b
+
+        spins = 0
+
+        while c[self._busy + b] % 2 == 1 and spins < MAX_SPINS:
+            time.sleep(0)
+            spins += 1
+
+        o = b * self._n
+        counts = c[o:o + self._n]
+        c[o:o + self._n] = [0] * self._n
+        total = self._sums[b]
+        self._sums[b] = 0.0
+        return counts, total
@@ -0,0 +1,104 @@
+"""
+Bounded history of samples for a single series.
+
+Samples are kept in two columns (times and values) of fixed size in shared
+memory, and are written by the collector process when the series is updated.
+There is only ever one writer, so no locking is performed: a sample is written
+before the head is advanced, which means that readers never see a partially
+written sample unless the ring has wrapped around all the way while reading.
+"""
+import math
+import multiprocessing as mp
+
+
+class History(object):
+    def __init__(self, size):
+        self.size = size
+        self._times = mp.RawArray('d', size)
+        self._values = mp.RawArray('d', size)
+        # total number of samples ever written.
+        self._head = mp.RawValue('L', 0)
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of shared memory used by the history.
+        """
+        return 16 * self.size + 8
+
+    @property
+    def generation(self):
+        """
+        Total number of samples ever written, which changes with every
+        sample.
+        """
+        return self._head.value
+
+    def append(self, t, value):
+        head = self._head.value
+        i = head % self.size
+        self._times[i] = t
+        self._values[i] = value
+        self._head.value = head + 1
+
+    def __len__(self):
+        return min(self._head.value, self.size)
+
+    def samples(self, count=None):
+        """
+        Return a list of the last count (time, value) samples, oldest first.
+        """
+        head = self._head.value
+        n = min(head, self.size)
+
+        if count is not None:
+            n = min(n, count)
+
+        start = head - n
+        return [(self._times[i % self.size], self._values[i % self.size])
+                for i in range(start, head)]
+
+    def window(self, seconds, now):
+        """
+        Return all samples which are at most the given number of seconds older
+        than now.
+        """
+        since = now - seconds
+        return [s for s in self.samples() if s[0] >= since]
+
+    def delta(self):
+        """
+        Difference between the two last samples, or NaN if there are not
+        enough samples.
+        """
+        last = self.samples(2)
+
+        if len(last) < 2:
+            return float('NaN')
+
+        return last[1][1] - last[0][1]
+
+    def rate(self):
+        """
+        Change per second between the two last samples, or NaN if there are
+        not enough samples.
+        """
+        last = self.samples(2)
+
+        if len(last) < 2 or last[1][0] <= last[0][0]:
+            return float('NaN')
+
+        (then, before), (now, after) = last
+        return (after - before) / (now - then)
+
+    def average(self, seconds, now):
+        """
+        Average of all set values in the given window.
+        """
+        values = [v for (_, v) in self.window(seconds, now)
+                  if not math.isnan(v)]
+
+        if len(values) == 0:
+            return float('NaN')
+
+        return sum(values) / len(values)
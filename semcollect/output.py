@@ -0,0 +1,53 @@
+"""
+Bundled outputs.
+
+An output is a callable which receives a Batch on the main loop after every
+collection. It may have a #stop method, which is called when the agent stops.
+"""
+import logging
+
+from .relay import RelayOutput
+
+log = logging.getLogger(__name__)
+
+
+class LogOutput(object):
+    """
+    Logs every series in the batch.
+    """
+    def __init__(self, config):
+        pass
+
+    def __call__(self, batch):
+        log.info('%d series at %0.2f', len(batch), batch.time)
+
+        for n, kind, tags, value in batch.series:
+            if n in batch.stale:
+                log.info('%s %s (stale)', format_tags(tags), value)
+            else:
+                log.info('%s %s', format_tags(tags), value)
+
+    def __str__(self):
+        return '<output log>'
+
+
+OUTPUTS = dict(log=LogOutput, relay=RelayOutput)
+
+
+def format_tags(tags):
+    return ','.join('{0}={1}'.format(k, v) for k, v in sorted(tags.items()))
+
+
+def build_outputs(configs):
+    outputs = list()
+
+    for c in configs:
+        output = OUTPUTS.get(c.type)
+
+        if output is None:
+            raise Exception(
+                "'{0}' is not a known output type".format(c.type))
+
+        outputs.append(output(c.config))
+
+    return outputs
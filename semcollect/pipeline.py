@@ -0,0 +1,137 @@
+"""
+The pipeline that takes a snapshot of the registry after every collection,
+passes it through the configured stages and hands the result to all outputs.
+"""
+import sys
+import logging
+
+from .registry import next_layout
+
+log = logging.getLogger(__name__)
+
+
+class Batch(object):
+    """
+    A batch of series, as (id, kind, tags, value).
+
+    layout identifies which series are in the batch and in what order, so that
+    stages can cache anything which only depends on that.
+
+    full is False if the batch only contains some of the series, like when
+    only changed series are emitted.
+
+    stale is the set of ids of series which were not updated by the last
+    collection, and still have the value of an earlier one.
+
+    snapshot is the columnar snapshot of the registry (see
+    Registry#snapshot) that the batch was taken from, for outputs which
+    process series in bulk. It is only taken if an output asks for it by
+    having a true columnar attribute, and is None if a stage has changed the
+    series.
+    """
+    def __init__(self, time, layout, series, full=True, stale=frozenset(),
+                 snapshot=None):
+        self.time = time
+        self.layout = layout
+        self.series = series
+        self.full = full
+        self.stale = stale
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.series)
+
+
+class Pipeline(object):
+    """
+    sources are merged with the series of the registry, every source has a
+    layout and a #snapshot method returning its series and the set of them
+    which are stale, like a relay.
+    """
+    def __init__(self, stages, outputs, sources=[]):
+        self._stages = stages
+        self._outputs = outputs
+        self._sources = sources
+        # the snapshot is an extra copy of the registry, only taken for
+        # outputs which use it.
+        self._columnar = len(sources) == 0 and any(
+            getattr(o, 'columnar', False) for o in outputs)
+        # layouts of the registry and all sources, and the layout of the
+        # merged batch.
+        self._layouts = None
+        self._layout = None
+
+    def __call__(self, registry, now):
+        batch = self.batch(registry, now)
+
+        if batch is not None:
+            self.emit(batch)
+
+    def batch(self, registry, now):
+        """
+        Take a batch of the registry and all sources, or None if there are no
+        outputs.
+
+        The batch is a copy, so it can be emitted while the next collection
+        is updating the registry.
+        """
+        if len(self._outputs) == 0:
+            return None
+
+        snapshot = registry.snapshot() if self._columnar else None
+        series = list(registry.series())
+        stale = registry.stale()
+        layout = registry.layout
+
+        if len(self._sources) > 0:
+            layouts = [layout]
+
+            for source in self._sources:
+                s, st = source.snapshot(now)
+                series.extend(s)
+                stale |= st
+                layouts.append(source.layout)
+
+            if layouts != self._layouts:
+                self._layouts = layouts
+                self._layout = next_layout()
+
+            layout = self._layout
+
+        return Batch(now, layout, series, stale=stale, snapshot=snapshot)
+
+    def emit(self, batch):
+        """
+        Pass a batch through all stages and hand it to all outputs.
+
+        Stages keep state between batches, so batches must be emitted one at
+        a time and in order.
+        """
+        for stage in self._stages:
+            batch = stage(batch)
+
+        for output in self._outputs:
+            try:
+                output(batch)
+            except:
+                log.error('%s: output failed', output,
+                          exc_info=sys.exc_info())
+
+    def servers(self):
+        """
+        Get the outputs which have sockets to be serviced by the poll loop.
+        """
+        return [o for o in self._outputs if hasattr(o, 'service')]
+
+    def stop(self):
+        for output in self._outputs:
+            stop = getattr(output, 'stop', None)
+
+            if stop is None:
+                continue
+
+            try:
+                stop()
+            except:
+                log.error('%s: failed to stop', output,
+                          exc_info=sys.exc_info())
@@ -0,0 +1,346 @@
+"""
+Access to the proc and sys filesystems.
+
+Collectors require the 'procfs' component instead of hard-coding absolute
+paths, which makes it possible to point the agent at an alternative root (like
+a host filesystem mounted into a container), or at a recorded fixture.
+"""
+import os
+import json
+import time
+import select
+import logging
+import collections
+import multiprocessing as mp
+
+log = logging.getLogger(__name__)
+
+statvfs_result = collections.namedtuple(
+    'statvfs_result', ['f_frsize', 'f_blocks', 'f_bfree', 'f_bavail'])
+
+
+class ProcFS(object):
+    """
+    Live proc and sys filesystems, relative to the given root.
+    """
+    class Watch(object):
+        """
+        Detects changes to a proc file which signals them through POLLPRI or
+        POLLERR, like /proc/self/mountinfo does when the mount table changes.
+
+        If the file can not be polled, it is always considered changed.
+        """
+        EVENTS = select.POLLPRI | select.POLLERR
+
+        def __init__(self, path):
+            self._path = path
+            self._file = None
+            self._poll = None
+            # the first check always reports a change.
+            self._first = True
+
+            try:
+                self._file = open(path, 'r')
+                self._poll = select.poll()
+                self._poll.register(self._file, self.EVENTS)
+            except (OSError, AttributeError) as e:
+                log.warn('%s: cannot watch, always re-reading: %s', path, e)
+
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+
+                self._poll = None
+
+        def changed(self):
+            """
+            Check if the file has changed since the last check, without
+            blocking.
+            """
+            if self._first:
+                self._first = False
+                return True
+
+            if self._poll is None:
+                return True
+
+            return any(e & self.EVENTS for _, e in self._poll.poll(0))
+
+        def close(self):
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._poll = None
+
+    class Scope(object):
+        """
+        The procfs of a single collector, which closes the watches of the
+        collector when it is freed.
+        """
+        def __init__(self, procfs):
+            self._procfs = procfs
+            self._watches = list()
+
+        def __getattr__(self, name):
+            return getattr(self._procfs, name)
+
+        def watch(self, path):
+            w = self._procfs.watch(path)
+            self._watches.append(w)
+            return w
+
+        def _injectfree(self):
+            for w in self._watches:
+                w.close()
+
+            self._watches = list()
+
+        def _injectchild(self):
+            return ProcFS.Scope(self._procfs)
+
+        def __str__(self):
+            return str(self._procfs)
+
+    def __init__(self, root='/'):
+        self._root = root
+
+    def _injectchild(self):
+        return ProcFS.Scope(self)
+
+    def path(self, path):
+        return os.path.join(self._root, path.lstrip('/'))
+
+    def isfile(self, path):
+        return os.path.isfile(self.path(path))
+
+    def open(self, path):
+        return open(self.path(path), 'r')
+
+    def statvfs(self, path):
+        return os.statvfs(self.path(path))
+
+    def watch(self, path):
+        """
+        Watch a file for changes, see ProcFS.Watch.
+        """
+        return ProcFS.Watch(self.path(path))
+
+    def time(self):
+        return time.time()
+
+    def tick(self):
+        """
+        Called by the main process once before every collection.
+        """
+        pass
+
+    def __str__(self):
+        return '<procfs root={0}>'.format(self._root)
+
+
+class Fixture(ProcFS):
+    """
+    Replays a recorded time series of proc snapshots.
+
+    A fixture is a directory with one sub-directory per frame, each frame
+    mirroring the parts of the filesystem which were recorded, and a
+    'frame.json' which contains the time of the frame and the result of statvfs
+    for every mountpoint.
+
+    The current frame is shared with the collector processes, and is advanced
+    on every tick, wrapping around when all frames have been replayed.
+    """
+    FRAME = 'frame.json'
+
+    class Watch(object):
+        """
+        Considers a file changed on every new frame.
+        """
+        def __init__(self, current):
+            self._current = current
+            self._frame = None
+
+        def changed(self):
+            frame = self._current.value
+
+            if frame == self._frame:
+                return False
+
+            self._frame = frame
+            return True
+
+        def close(self):
+            pass
+
+    def __init__(self, root):
+        self._fixture = root
+        self._frames = sorted(
+            n for n in os.listdir(root)
+            if os.path.isfile(os.path.join(root, n, self.FRAME)))
+
+        if len(self._frames) == 0:
+            raise Exception('{0}: fixture has no frames'.format(root))
+
+        self._current = mp.Value('L', 0)
+        self._meta = None
+        self._meta_frame = None
+        super(Fixture, self).__init__(root)
+
+    def tick(self):
+        with self._current.get_lock():
+            self._current.value = (self._current.value + 1) % len(self._frames)
+
+    def path(self, path):
+        return os.path.join(
+            self._frame_path(self._current.value), path.lstrip('/'))
+
+    def statvfs(self, path):
+        s = self._frame_meta()['statvfs'].get(path)
+
+        if s is None:
+            raise OSError('{0}: no statvfs recorded for frame'.format(path))
+
+        return statvfs_result(*s)
+
+    def watch(self, path):
+        return Fixture.Watch(self._current)
+
+    def time(self):
+        return self._frame_meta()['time']
+
+    def _frame_path(self, i):
+        return os.path.join(self._fixture, self._frames[i])
+
+    def _frame_meta(self):
+        i = self._current.value
+
+        if self._meta_frame != i:
+            with open(os.path.join(self._frame_path(i), self.FRAME)) as f:
+                self._meta = json.load(f)
+
+            self._meta_frame = i
+
+        return self._meta
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __str__(self):
+        return '<fixture {0} frames={1}>'.format(
+            self._fixture, len(self._frames))
+
+
+RECORD_SOURCES = ['proc/stat', 'proc/diskstats', 'proc/mounts',
+                  'proc/loadavg']
+
+
+def write_frame(target, i, t, sources, statvfs):
+    """
+    Write a single fixture frame.
+
+    sources is a dict of relative path to file content.
+    """
+    frame = os.path.join(target, '{0:06d}'.format(i))
+
+    for path, content in sources.items():
+        path = os.path.join(frame, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'w') as f:
+            f.write(content)
+
+    with open(os.path.join(frame, Fixture.FRAME), 'w') as f:
+        json.dump(dict(time=t, statvfs=statvfs), f)
+
+
+def record(target, frames, interval, procfs=None, sources=RECORD_SOURCES):
+    """
+    Record a fixture from a live filesystem.
+    """
+    if procfs is None:
+        procfs = ProcFS()
+
+    for i in range(frames):
+        if i > 0:
+            time.sleep(interval)
+
+        t = procfs.time()
+        contents = dict()
+
+        for path in sources:
+            if not procfs.isfile(path):
+                continue
+
+            with procfs.open(path) as f:
+                contents[path] = f.read()
+
+        statvfs = dict()
+
+        for line in contents.get('proc/mounts', '').splitlines():
+            parts = line.split()
+
+            if len(parts) != 6:
+                continue
+
+            try:
+                s = procfs.statvfs(parts[1])
+            except OSError:
+                continue
+
+            statvfs[parts[1]] = [s.f_frsize, s.f_blocks, s.f_bfree,
+                                 s.f_bavail]
+
+        write_frame(target, i, t, contents, statvfs)
+
+
+def synthesize(target, frames, interval, cpus=4, disks=4, start=0.0):
+    """
+    Synthesize a fixture with an arbitrary number of cpus and disks.
+
+    Counters grow linearly (with a per-device skew) between frames, which
+    gives stable and predictable rates.
+    """
+    for i in range(frames):
+        t = start + i * interval
+        step = i + 1
+
+        stat = list()
+        total = [0] * 10
+
+        for cpu in range(cpus):
+            fields = [(100 + cpu % 7 + f) * step for f in range(10)]
+            total = [a + b for a, b in zip(total, fields)]
+            stat.append('cpu{0} {1}'.format(
+                cpu, ' '.join(str(v) for v in fields)))
+
+        stat.insert(0, 'cpu  {0}'.format(' '.join(str(v) for v in total)))
+        stat.append('ctxt {0}'.format(1000 * step))
+        stat.append('btime 0')
+
+        diskstats = list()
+        mounts = list()
+        statvfs = dict()
+
+        for d in range(disks):
+            device = 'sd{0}'.format(d)
+            fields = [(d % 13 + f + 1) * 10 * step for f in range(11)]
+            diskstats.append('{0:4d} {1:7d} {2} {3}'.format(
+                8, d, device, ' '.join(str(v) for v in fields)))
+
+            mountpoint = '/mnt/disk{0}'.format(d)
+            mounts.append('/dev/{0} {1} ext4 rw,relatime 0 0'.format(
+                device, mountpoint))
+
+            blocks = 1000000 + d
+            free = blocks - (d * 7 + i * 10) % blocks
+            statvfs[mountpoint] = [4096, blocks, free, int(free * 0.95)]
+
+        sources = {
+            'proc/stat': '\n'.join(stat) + '\n',
+            'proc/diskstats': '\n'.join(diskstats) + '\n',
+            'proc/mounts': '\n'.join(mounts) + '\n',
+            'proc/loadavg': '0.{0:02d} 0.50 0.25 1/100 {1}\n'.format(
+                i % 100, 1000 + i),
+        }
+
+        write_frame(target, i, t, sources, statvfs)
@@ -0,0 +1,216 @@
+"""
+Local query endpoint, serving the latest snapshot of the registry over a unix
+domain socket.
+
+A client connects, sends a single request line and reads the response until
+the connection is closed.
+
+    <format> [<tag>=<value> ...]
+
+Where format is either 'text', 'binary', 'history' (see semcollect.encoding)
+or 'blocks' (see semcollect.blocks), and the optional tags select which series
+to include.
+"""
+import os
+import sys
+import time
+import errno
+import socket
+import select
+import logging
+
+from .encoding import encode_text, encode_binary, encode_history
+from .blocks import BlockCache, encode_blocks
+
+log = logging.getLogger(__name__)
+
+# maximum size of a request line.
+MAX_REQUEST = 4096
+
+
+class QueryException(Exception):
+    pass
+
+
+class QueryServer(object):
+    class Client(object):
+        def __init__(self, sock):
+            self.sock = sock
+            self.request = b''
+            self.response = None
+            self.offset = 0
+
+        def fileno(self):
+            return self.sock.fileno()
+
+    def __init__(self, path, registry):
+        self.path = path
+        self._registry = registry
+        self._sock = None
+        self._clients = dict()
+        # encoded blocks of the blocks format, kept between requests.
+        self._blocks = BlockCache()
+
+    def set_registry(self, registry):
+        self._registry = registry
+        self._blocks = BlockCache()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.bind(self.path)
+        sock.listen(16)
+        self._sock = sock
+
+        log.info('query: listening on %s', self.path)
+
+    def stop(self):
+        for c in list(self._clients.values()):
+            self._close(c)
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def poll(self, timeout):
+        """
+        Wait at most timeout seconds for any activity, and service it without
+        blocking.
+        """
+        r, w, _ = select.select(self.rlist(), self.wlist(), [], timeout)
+        self.service(r, w)
+
+    def rlist(self):
+        return [self._sock] + [c for c in self._clients.values()
+                               if c.response is None]
+
+    def wlist(self):
+        return [c for c in self._clients.values() if c.response is not None]
+
+    def service(self, r, w):
+        """
+        Service the sockets which select found ready.
+        """
+        for s in r:
+            if s is self._sock:
+                self._accept()
+            else:
+                self._read(s)
+
+        for c in w:
+            self._write(c)
+
+    def _accept(self):
+        try:
+            sock, _ = self._sock.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            raise
+
+        sock.setblocking(False)
+        self._clients[sock.fileno()] = QueryServer.Client(sock)
+
+    def _read(self, c):
+        try:
+            data = c.sock.recv(MAX_REQUEST)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            self._close(c)
+            return
+
+        if len(data) == 0:
+            self._close(c)
+            return
+
+        c.request += data
+
+        if b'\n' not in c.request:
+            if len(c.request) > MAX_REQUEST:
+                self._respond(c, b'error: request too long\n')
+
+            return
+
+        line = c.request.split(b'\n', 1)[0]
+
+        try:
+            response = self.handle(line.decode('utf-8'))
+        except QueryException as e:
+            response = 'error: {0}\n'.format(e).encode('utf-8')
+        except:
+            log.error('query: failed to handle request',
+                      exc_info=sys.exc_info())
+            response = b'error: internal error\n'
+
+        self._respond(c, response)
+
+    def _respond(self, c, response):
+        c.response = memoryview(response)
+        c.offset = 0
+        self._write(c)
+
+    def _write(self, c):
+        try:
+            c.offset += c.sock.send(c.response[c.offset:])
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            self._close(c)
+            return
+
+        if c.offset >= len(c.response):
+            self._close(c)
+
+    def _close(self, c):
+        self._clients.pop(c.fileno(), None)
+        c.sock.close()
+
+    def handle(self, line):
+        """
+        Handle a single request line, returning the encoded response.
+        """
+        parts = line.split()
+
+        if len(parts) == 0:
+            raise QueryException('empty request')
+
+        fmt = parts[0]
+        tags = dict()
+
+        for p in parts[1:]:
+            if '=' not in p:
+                raise QueryException('invalid tag: {0}'.format(p))
+
+            k, v = p.split('=', 1)
+            tags[k] = v
+
+        registry = self._registry
+        series = registry.series(registry.select(**tags))
+
+        if fmt == 'text':
+            return encode_text(series)
+
+        if fmt == 'binary':
+            return encode_binary(series, time.time())
+
+        if fmt == 'history':
+            return encode_history(series, registry.history)
+
+        if fmt == 'blocks':
+            return encode_blocks(series, registry.history,
+                                 cache=self._blocks)
+
+        raise QueryException('unsupported format: {0}'.format(fmt))
+
+    def __str__(self):
+        return '<query {0}>'.format(self.path)
@@ -1,31 +1,210 @@
+import time
+import array
+import fnmatch
+import itertools
+import threading
+import logging
 import multiprocessing as mp
 
+from .history import History
+from .histogram import Histogram, percentile
+from .arena import series_key
+from .relabel import relabel
+
+log = logging.getLogger(__name__)
+
+# every change to the set of series in any registry gets a new layout, which
+# makes it possible to cache things that only depend on which series exist.
+_layouts = itertools.count(1)
+
+
+def next_layout():
+    return next(_layouts)
+
+
+def match_tags(patterns, tags):
+    """
+    Check if tags has all the tags in patterns, where the values of patterns
+    are glob patterns.
+    """
+    for k, pattern in patterns.items():
+        v = tags.get(k)
+
+        if v is None or not fnmatch.fnmatchcase(str(v), pattern):
+            return False
+
+    return True
+
 
 class Registry(object):
+    METRIC = 0
+    STATE = 1
+    # kind of a slot which is not in use.
+    FREE = -1
+
+    # number of series in every chunk of shared memory.
+    CHUNK_SIZE = 4096
+    # number of series in every chunk of a file-mapped arena, which is
+    # smaller since the capacity of the arena is shared with vectors.
+    ARENA_CHUNK_SIZE = 256
+
+    # bytes of shared memory used by every series.
+    SERIES_SIZE = 8 + 8 + 8 + 1 + 1
+    # percentiles of a histogram, unless others are given.
+    PERCENTILES = (50, 90, 99)
+    # tags kept by a series which does not fit a budget, when it is folded
+    # into a series shared with every other one having the same tags, and a
+    # series tag of other.
+    FOLD_TAGS = ('what', 'unit')
+
+    class Chunk(object):
+        """
+        Shared memory for a fixed number of series, one slot each.
+
+        Every column is contiguous, so that it can be copied or viewed in one
+        go. ids and kinds are only ever written by the main process.
+
+        The columns are allocated from the arena if one is given, in which
+        case index is the position of the chunk in the arena.
+
+        A chunk of a vector is dedicated to it, and is released when every
+        one of its series has been freed, see Registry#_free. The same goes
+        for the counters of a histogram, see Histogram.
+        """
+        def __init__(self, size, arena=None, vector=False):
+            self.vector = vector
+            # number of series in use, only tracked for vectors.
+            self.used = 0
+            self.index = None
+
+            if arena is None:
+                self.values = mp.RawArray('d', size)
+                self.states = mp.RawArray('b', size)
+                self.generations = mp.RawArray('Q', size)
+                self.ids = array.array('q', [-1]) * size
+                self.kinds = array.array('b', [Registry.FREE]) * size
+                return
+
+            (self.index, self.ids, self.kinds, self.values, self.states,
+             self.generations) = arena.allocate(size)
+
+            for slot in range(size):
+                self.ids[slot] = -1
+                self.kinds[slot] = Registry.FREE
+
+    class Snapshot(object):
+        """
+        Columnar copy of the registry, with one entry per slot in every
+        column.
+
+        Free slots have an id of -1 and a kind of Registry.FREE. values is
+        only meaningful for metrics, and states for states. All columns are
+        arrays, which can be used through memoryview (or numpy.frombuffer)
+        without copying them again.
+        """
+        def __init__(self, time, generation, ids, kinds, values, states,
+                     generations):
+            self.time = time
+            self.generation = generation
+            self.ids = ids
+            self.kinds = kinds
+            self.values = values
+            self.states = states
+            self.generations = generations
+
+        def __len__(self):
+            return len(self.ids)
+
     class Metric(object):
         NaN = float('NaN')
 
-        def __init__(self, value):
-            self._v = value
+        def __init__(self, chunk, slot, current, history=None):
+            self._values = chunk.values
+            self._generations = chunk.generations
+            self._slot = slot
+            self._current = current
+            # if not None, the history of this metric.
+            self.history = history
 
         def update(self, value):
-            self._v.value = value
+            self._values[self._slot] = value
+            self._generations[self._slot] = self._current.value
+
+            if self.history is not None:
+                self.history.append(time.time(), value)
+
+        def unset(self):
+            self.update(self.NaN)
+
+    class Vector(object):
+        """
+        A block of metrics which are updated all at once.
+
+        The metrics are stored in the first size slots of a chunk of their
+        own, in the order of their dimensions, with the last dimension varying
+        fastest.
+        """
+        def __init__(self, chunk, shape, current, size):
+            self._view = memoryview(chunk.values).cast('B').cast('d')[:size]
+            self._generations = memoryview(chunk.generations).cast(
+                'B').cast('Q')[:size]
+            self._current = current
+            self.shape = shape
+
+        def __len__(self):
+            return len(self._view)
+
+        def update(self, values):
+            """
+            Update every metric from a flat sequence of values.
+
+            A contiguous buffer of doubles, like array.array('d') or a numpy
+            array of float64, is copied in one go.
+            """
+            try:
+                view = memoryview(values)
+            except TypeError:
+                view = None
+
+            if view is not None and view.format == 'd' and view.c_contiguous:
+                view = view.cast('B').cast('d')
+            else:
+                view = memoryview(array.array('d', values))
+
+            if len(view) != len(self._view):
+                raise ValueError('expected {0} values, got {1}'.format(
+                    len(self._view), len(view)))
+
+            self._view[:] = view
+
+            self._generations[:] = array.array(
+                'Q', [self._current.value]) * len(self._generations)
 
         def unset(self):
-            self._v.value = self.NaN
+            self.update([Registry.Metric.NaN] * len(self._view))
 
     class State(object):
-        def __init__(self, value):
-            self._v = value
+        def __init__(self, chunk, slot, current, history=None):
+            self._states = chunk.states
+            self._generations = chunk.generations
+            self._slot = slot
+            self._current = current
+            # if not None, the history of this state, as 1.0 for ok and 0.0
+            # for critical.
+            self.history = history
 
         def ok(self):
-            self._v.value = 1
+            self.update(True)
 
         def critical(self):
-            self._v.value = 0
+            self.update(False)
 
         def update(self, state):
-            self._v.value = 1 if state else 0
+            self._states[self._slot] = 1 if state else 0
+            self._generations[self._slot] = self._current.value
+
+            if self.history is not None:
+                self.history.append(time.time(), 1.0 if state else 0.0)
 
     class Scoped(object):
         def __init__(self, parent, **base):
@@ -42,87 +221,844 @@ class Registry(object):
             tags.update(self._base)
             return self._parent.state(**tags)
 
+        def histogram(self, buckets, **tags):
+            tags = dict(tags)
+            tags.update(self._base)
+            return self._parent.histogram(buckets, **tags)
+
+        def vector(self, dims, **tags):
+            tags = dict(tags)
+            tags.update(self._base)
+            return self._parent.vector(dims, **tags)
+
         def scoped(self, **tags):
             return Registry.Scoped(self, **tags)
 
+    class Null(object):
+        """
+        Stands in for a series which was not registered, and discards every
+        update.
+        """
+        history = None
+
+        def update(self, value):
+            pass
+
+        def unset(self):
+            pass
+
+        def ok(self):
+            pass
+
+        def critical(self):
+            pass
+
+        def record(self, value):
+            pass
+
     class Group(object):
-        def __init__(self, registry):
+        """
+        The series registered by a single collector, which are freed together.
+
+        A group can be limited to a number of series, which is inherited by
+        its children. Every child (an instance of the collector) is limited
+        on its own, so that a restarted instance can register all of its
+        series before the one it replaces is freed.
+        """
+        def __init__(self, registry, parent=None):
             self._group = []
             self._registry = registry
+            self._parent = parent
+            self._children = set()
+            # bytes of shared memory used by the series of this group.
+            self._bytes = 0
+            self.name = parent.name if parent is not None else None
+            self.max_series = parent.max_series if parent is not None else None
+            # number of series which were rejected or folded.
+            self.rejected = 0
+
+        def budget(self, name, max_series):
+            """
+            Limit the number of series of the group, None for no limit.
+            """
+            self.name = name
+            self.max_series = max_series
+
+        def usage(self):
+            """
+            Number of series and bytes of shared memory used by this group
+            and all its children, as (series, bytes).
+            """
+            series = len(self._group)
+            nbytes = self._bytes
+
+            for child in list(self._children):
+                s, b = child.usage()
+                series += s
+                nbytes += b
+
+            return series, nbytes
 
         def scoped(self, **tags):
             return Registry.Scoped(self, **tags)
 
         def metric(self, **tags):
-            n, m = self._registry.metric(**tags)
-            self._group.append(n)
+            t = self._registry.relabel(tags)
+
+            if t is None:
+                return Registry.Null()
+
+            if not self._admit(1, t):
+                return self._overflow(Registry.METRIC, t)
+
+            n, m = self._registry._metric(t)
+
+            if n is not None:
+                self._add([n], Registry.footprint(m.history))
+
             return m
 
         def state(self, **tags):
-            n, m = self._registry.state(**tags)
-            self._group.append(n)
+            t = self._registry.relabel(tags)
+
+            if t is None:
+                return Registry.Null()
+
+            if not self._admit(1, t):
+                return self._overflow(Registry.STATE, t)
+
+            n, m = self._registry._state(t)
+
+            if n is not None:
+                self._add([n], Registry.footprint(m.history))
+
             return m
 
+        def histogram(self, buckets, **tags):
+            percentiles = tags.pop('percentiles', Registry.PERCENTILES)
+            cells = self._registry.stats(percentiles, tags)
+            size = sum(1 for t in cells if t is not None)
+
+            if size == 0:
+                return Registry.Null()
+
+            if not self._admit(size, tags):
+                return self._overflow(None, tags)
+
+            ids, h = self._registry._histogram(buckets, percentiles, cells)
+
+            if len(ids) == 0:
+                return h
+
+            slots = len(ids) + len(h.chunk.ids)
+            self._add(ids, slots * Registry.SERIES_SIZE)
+            return h
+
+        def vector(self, dims, **tags):
+            shape, cells = self._registry.cells(dims, tags)
+            size = sum(1 for t in cells if t is not None)
+
+            if size == 0:
+                return Registry.Null()
+
+            if not self._admit(size, tags):
+                return self._overflow(None, tags)
+
+            ids, v = self._registry._vector(shape, cells)
+            self._add(ids, len(ids) * Registry.SERIES_SIZE)
+            return v
+
+        def _add(self, ids, nbytes):
+            self._group.extend(ids)
+            self._bytes += nbytes
+            self._registry.budgeted(len(ids))
+
+        def _admit(self, n, tags):
+            """
+            Check if n more series fit the budget of the group, and the budget
+            of the registry.
+            """
+            if (self.max_series is not None and
+                    len(self._group) + n > self.max_series):
+                return False
+
+            return not self._registry.full(n)
+
+        def _overflow(self, kind, tags):
+            """
+            Handle a series which does not fit, by folding it into the other
+            series if the registry is configured to and it is a single
+            series of the given kind, or by rejecting it.
+            """
+            fold = kind is not None and self._registry.overflow == 'fold'
+
+            if self.rejected == 0:
+                log.warn('%s: series budget exceeded, %s new series like %r',
+                         self.name or 'registry',
+                         'folding' if fold else 'rejecting', tags)
+
+            g = self
+
+            while g is not None:
+                g.rejected += 1
+                g = g._parent
+
+            if fold:
+                return self._registry.other(kind, tags)
+
+            return Registry.Null()
+
         def _injectfree(self):
             for n in self._group:
                 self._registry.free(n)
 
+            self._registry.budgeted(-len(self._group))
             self._group = []
+            self._bytes = 0
+
+            if self._parent is not None:
+                self._parent._children.discard(self)
 
         def _injectchild(self):
-            return Registry.Group(self._registry)
+            child = Registry.Group(self._registry, self)
+            self._children.add(child)
+            return child
 
-    def __init__(self, **tags):
+    def __init__(self, tags=None, history=None, arena=None, max_series=None,
+                 overflow='reject', relabel=None):
         self._p = 0
-        self._vals = dict()
-        self._states = dict()
+        self._chunks = list()
+        # slots which are not in use, as (chunk, slot).
+        self._free_slots = list()
+        # slot of every series as (kind, chunk, slot).
+        self._slots = dict()
         self._tags = dict()
-        self._base = dict(tags)
+        self._base = dict(tags or {})
+        # list of (patterns, size), the first match decides the history size.
+        self._history = history or []
+        # relabel rules, applied to every series as it is registered.
+        self._relabel = relabel or []
+        self._histories = dict()
+        # histograms by the id of their first series, as
+        # (histogram, percentiles, [(id, metric)]).
+        self._histograms = dict()
+        # index of (tag, value) to the set of series having it.
+        self._index = dict()
+        # if not None, the file-mapped arena that columns are allocated from.
+        self._arena = arena
+        # layout as of the last time the directory of the arena was written.
+        self._synced = None
+        # chunks of the arena which are not in use.
+        self._spare = list()
+        self._warned_full = False
+
+        # generation of the current collection.
+        if arena is not None:
+            self._generation = arena.generation
+        else:
+            self._generation = mp.RawValue('L', 0)
+        # collectors are set up concurrently, which registers series from
+        # several threads.
+        self._lock = threading.Lock()
+        self.layout = next_layout()
+        # if not None, the most series that collectors may register, and the
+        # number of series they have registered.
+        self.max_series = max_series
+        self._budgeted = 0
+        # what to do with series that do not fit a budget, reject or fold.
+        self.overflow = overflow
+        # shared series which overflowing series are folded into, by key.
+        self._others = dict()
 
     def _injectchild(self):
         return Registry.Group(self)
 
-    def metric(self, **tags):
-        n = self._p
-        self._p += 1
-
+    def relabel(self, tags):
+        """
+        Get the tags that a series with the given tags is registered with,
+        including the base tags, or None if it is dropped.
+        """
         t = dict(self._base)
         t.update(tags)
+        return relabel(self._relabel, t)
+
+    def metric(self, **tags):
+        """
+        Register a metric, returning its id and the metric.
+
+        If the metric is dropped by a relabel rule, the id is None and the
+        metric discards every update.
+        """
+        t = self.relabel(tags)
+
+        if t is None:
+            return None, Registry.Null()
+
+        return self._metric(t)
 
-        v = mp.Value('d', Registry.Metric.NaN)
+    def _metric(self, t):
+        history = self._new_history(t)
 
-        self._vals[n] = v
-        self._tags[n] = t
+        with self._lock:
+            chunk, slot = self._allocate(self._p, Registry.METRIC)
 
-        return n, Registry.Metric(v)
+            if chunk is None:
+                return None, Registry.Null()
+
+            n = self._p
+            self._p += 1
+            chunk.values[slot] = self._previous(Registry.METRIC, t,
+                                                Registry.Metric.NaN)
+            self._add_tags(n, t)
+
+            if history is not None:
+                self._histories[n] = history
+
+        return n, Registry.Metric(chunk, slot, self._generation, history)
 
     def state(self, **tags):
-        n = self._p
-        self._p += 1
+        """
+        Register a state, see #metric.
+        """
+        t = self.relabel(tags)
 
-        t = dict(self._base)
-        t.update(tags)
+        if t is None:
+            return None, Registry.Null()
+
+        return self._state(t)
+
+    def _state(self, t):
+        history = self._new_history(t)
+
+        with self._lock:
+            chunk, slot = self._allocate(self._p, Registry.STATE)
+
+            if chunk is None:
+                return None, Registry.Null()
+
+            n = self._p
+            self._p += 1
+            chunk.states[slot] = self._previous(Registry.STATE, t, 0)
+            self._add_tags(n, t)
+
+            if history is not None:
+                self._histories[n] = history
+
+        return n, Registry.State(chunk, slot, self._generation, history)
+
+    def vector(self, dims, **tags):
+        """
+        Register a block of metrics, one for every combination of the values
+        of the given dimensions.
 
-        v = mp.Value('b', 0)
+        dims maps the name of every dimension to its values, each being either
+        the value of the tag named by the dimension, or a dict of tags. Which
+        means that the following registers one metric for every device and
+        field:
 
-        self._states[n] = v
-        self._tags[n] = t
+            registry.vector(dict(device=['sda', 'sdb'],
+                                 field=['reads', 'writes']), what='io')
 
-        return n, Registry.State(v)
+        Metrics in a vector have no history. Metrics which are dropped by a
+        relabel rule keep their place in the vector, but are never published.
+        If every metric is dropped, the id list is empty.
+        """
+        shape, cells = self.cells(dims, tags)
+
+        if all(t is None for t in cells):
+            return [], Registry.Null()
+
+        return self._vector(shape, cells)
+
+    def cells(self, dims, tags):
+        """
+        Get the shape of a vector with the given dimensions, and the relabeled
+        tags of every metric in it, None for those which are dropped.
+        """
+        axes = list()
+
+        for name, values in dims.items():
+            axes.append([v if isinstance(v, dict) else {name: v}
+                         for v in values])
+
+        shape = tuple(len(a) for a in axes)
+        cells = list()
+
+        for combination in itertools.product(*axes):
+            t = dict(tags)
+
+            for d in combination:
+                t.update(d)
+
+            cells.append(self.relabel(t))
+
+        return shape, cells
+
+    def _vector(self, shape, cells):
+        # a chunk can not be empty.
+        if len(cells) == 0:
+            return [], Registry.Null()
+
+        with self._lock:
+            chunk = self._vector_chunk(len(cells))
+
+            if chunk is None:
+                return [], Registry.Null()
+
+            self._chunks.append(chunk)
+            ids = list()
+
+            for slot, t in enumerate(cells):
+                if t is None:
+                    continue
+
+                n = self._p
+                self._p += 1
+                self._assign(n, Registry.METRIC, chunk, slot)
+                chunk.used += 1
+                chunk.values[slot] = self._previous(
+                    Registry.METRIC, t, Registry.Metric.NaN)
+                self._add_tags(n, t)
+                ids.append(n)
+
+        return ids, Registry.Vector(chunk, shape, self._generation,
+                                    len(cells))
+
+    def _vector_chunk(self, size):
+        """
+        Get a chunk for a vector of the given size, which might be larger if
+        it is a spare chunk of the arena. Returns None if the arena is full.
+        """
+        if self._arena is None:
+            return Registry.Chunk(size, vector=True)
+
+        spare = [c for c in self._spare if len(c.ids) >= size]
+
+        if len(spare) > 0:
+            chunk = min(spare, key=lambda c: len(c.ids))
+            self._spare.remove(chunk)
+            chunk.vector = True
+            return chunk
+
+        if self._arena.available < size:
+            self._full()
+            return None
+
+        return Registry.Chunk(size, self._arena, vector=True)
+
+    def _full(self):
+        if not self._warned_full:
+            log.warn('%s: registry file is full, new series are dropped',
+                     self._arena.path)
+            self._warned_full = True
+
+    def histogram(self, buckets, percentiles=PERCENTILES, **tags):
+        """
+        Register a histogram with the given bucket upper bounds.
+
+        The histogram is published as one series for each of the count and
+        the sum of the values recorded in every collection, and one for every
+        percentile, distinguished by the stat tag (count, sum, p50, ...).
+        Series which are dropped by a relabel rule are not published, and if
+        every series is dropped, the id list is empty.
+        """
+        cells = self.stats(percentiles, tags)
+
+        if all(t is None for t in cells):
+            return [], Registry.Null()
+
+        return self._histogram(buckets, percentiles, cells)
+
+    def stats(self, percentiles, tags):
+        """
+        Get the relabeled tags of every series of a histogram with the given
+        percentiles, None for those which are dropped.
+        """
+        stats = ['count', 'sum'] + ['p{0}'.format(q) for q in percentiles]
+        cells = list()
+
+        for stat in stats:
+            t = dict(tags)
+            t['stat'] = stat
+            cells.append(self.relabel(t))
+
+        return cells
+
+    def _histogram(self, buckets, percentiles, cells):
+        # the counters are kept in a chunk of their own, which is released
+        # with the histogram.
+        with self._lock:
+            chunk = self._vector_chunk(Histogram.slots(buckets))
+
+            if chunk is None:
+                return [], Registry.Null()
+
+            self._chunks.append(chunk)
+
+        h = Histogram(buckets, chunk)
+        metrics = list()
+
+        for t in cells:
+            if t is None:
+                metrics.append((None, Registry.Null()))
+            else:
+                metrics.append(self._metric(t))
+
+        ids = [n for n, _ in metrics if n is not None]
+
+        # the arena is full.
+        if len(ids) == 0:
+            with self._lock:
+                self._release(chunk)
+
+            return ids, Registry.Null()
+
+        with self._lock:
+            self._histograms[ids[0]] = (h, list(percentiles), metrics)
+
+        return ids, h
+
+    def budgeted(self, n):
+        """
+        Count n series as registered by a collector, or uncount them if n is
+        negative.
+        """
+        with self._lock:
+            self._budgeted += n
+
+    def full(self, n):
+        """
+        Check if n more series registered by collectors would exceed the
+        budget of the registry.
+        """
+        return (self.max_series is not None and
+                self._budgeted + n > self.max_series)
+
+    def other(self, kind, tags):
+        """
+        Get the series of the given kind that series with tags are folded
+        into, registering it if it does not exist.
+
+        Folded series live as long as the registry, and have the value of
+        the last series that was updated through it.
+        """
+        t = dict((k, tags[k]) for k in Registry.FOLD_TAGS if k in tags)
+        t['series'] = 'other'
+        key = series_key(kind, t)
+
+        with self._lock:
+            m = self._others.get(key)
+
+        if m is not None:
+            return m
+
+        if kind == Registry.METRIC:
+            _, m = self.metric(**t)
+        else:
+            _, m = self.state(**t)
+
+        with self._lock:
+            return self._others.setdefault(key, m)
+
+    @staticmethod
+    def footprint(history):
+        """
+        Bytes of shared memory used by a series with the given history.
+        """
+        if history is None:
+            return Registry.SERIES_SIZE
+
+        return Registry.SERIES_SIZE + history.nbytes
+
+    def usage(self):
+        """
+        Number of series and bytes of shared memory allocated for the
+        registry, as (series, bytes).
+        """
+        with self._lock:
+            series = len(self._slots)
+            nbytes = sum(len(c.ids) for c in self._chunks) * self.SERIES_SIZE
+            nbytes += sum(h.nbytes for h in self._histories.values())
+
+        return series, nbytes
+
+    def harvest(self):
+        """
+        Publish what has been recorded into every histogram since the last
+        harvest, called after every collection.
+        """
+        with self._lock:
+            histograms = list(self._histograms.values())
+
+        for h, percentiles, metrics in histograms:
+            counts, total = h.swap()
+            values = [sum(counts), total]
+            values.extend(percentile(h.bounds, counts, q)
+                          for q in percentiles)
+
+            for (n, m), value in zip(metrics, values):
+                # the series might have been freed on its own.
+                if n in self._slots:
+                    m.update(value)
+
+    def _allocate(self, n, kind):
+        """
+        Allocate a slot for series n, returning (None, None) if the arena is
+        full.
+        """
+        if len(self._free_slots) == 0:
+            if self._arena is None:
+                chunk = Registry.Chunk(self.CHUNK_SIZE)
+            elif len(self._spare) > 0:
+                chunk = self._spare.pop()
+                chunk.vector = False
+            elif self._arena.available > 0:
+                chunk = Registry.Chunk(
+                    min(self.ARENA_CHUNK_SIZE, self._arena.available),
+                    self._arena)
+            else:
+                self._full()
+                return None, None
+
+            self._chunks.append(chunk)
+            self._free_slots = [(chunk, slot) for slot in
+                                reversed(range(len(chunk.ids)))]
+
+        chunk, slot = self._free_slots.pop()
+        self._assign(n, kind, chunk, slot)
+        return chunk, slot
+
+    def _assign(self, n, kind, chunk, slot):
+        chunk.ids[slot] = n
+        chunk.kinds[slot] = kind
+        chunk.generations[slot] = 0
+        self._slots[n] = (kind, chunk, slot)
+
+    def _previous(self, kind, tags, default):
+        """
+        Get the last known value of a series from before the agent was
+        restarted.
+        """
+        if self._arena is None:
+            return default
+
+        value = self._arena.previous.get(series_key(kind, tags))
+
+        if value is None:
+            return default
+
+        return value
+
+    def sync(self):
+        """
+        Write the directory of the arena if the set of series has changed
+        since the last time, called after every collection.
+        """
+        if self._arena is None or self._synced == self.layout:
+            return
+
+        with self._lock:
+            series = list()
+
+            for n, (kind, chunk, slot) in sorted(self._slots.items()):
+                series.append((n, chunk.index, slot, kind, self._tags[n]))
+
+            self._synced = self.layout
+
+        self._arena.write_directory(series)
 
     def free(self, n):
-        self._vals.pop(n, None)
-        self._states.pop(n, None)
-        self._tags.pop(n, None)
+        with self._lock:
+            self._free(n)
+
+    def _free(self, n):
+        entry = self._slots.pop(n, None)
+
+        if entry is not None:
+            _, chunk, slot = entry
+            chunk.ids[slot] = -1
+            chunk.kinds[slot] = Registry.FREE
+
+            # the slots of a vector are never reused on their own.
+            if chunk.vector:
+                chunk.used -= 1
+
+                if chunk.used == 0:
+                    self._release(chunk)
+            else:
+                self._free_slots.append((chunk, slot))
+
+        self._histories.pop(n, None)
+        histogram = self._histograms.pop(n, None)
+
+        if histogram is not None:
+            self._release(histogram[0].chunk)
+
+        self.layout = next_layout()
+
+        for item in self._tags.pop(n, {}).items():
+            ids = self._index.get(item)
+
+            if ids is None:
+                continue
+
+            ids.discard(n)
+
+            if len(ids) == 0:
+                del self._index[item]
+
+    def _release(self, chunk):
+        """
+        Release a chunk of a vector which no longer has any series, or of a
+        histogram which has been freed.
+
+        The capacity of an arena is never given back, so its chunks are kept
+        as spares to be used again instead.
+        """
+        self._chunks.remove(chunk)
+
+        if chunk.index is not None:
+            self._spare.append(chunk)
+            self._warned_full = False
+
+    def select(self, **tags):
+        """
+        Select the ids of all series which have all of the given tags, in
+        order of registration.
+        """
+        with self._lock:
+            if len(tags) == 0:
+                return sorted(self._tags)
+
+            ids = None
+
+            for item in tags.items():
+                matches = self._index.get(item)
+
+                if matches is None:
+                    return []
+
+                ids = set(matches) if ids is None else (ids & matches)
+
+            return sorted(ids)
+
+    def series(self, ids=None):
+        """
+        Generate (id, kind, tags, value) for the given series ids, or for all
+        series if none are given.
+        """
+        with self._lock:
+            if ids is None:
+                ids = sorted(self._tags)
+
+            entries = [(n, self._tags[n], self._slots[n]) for n in ids
+                       if n in self._tags]
+
+        for n, tags, (kind, chunk, slot) in entries:
+            if kind == Registry.METRIC:
+                yield n, kind, tags, chunk.values[slot]
+            else:
+                yield n, kind, tags, chunk.states[slot] == 1
+
+    def snapshot(self):
+        """
+        Take a columnar snapshot of every series, copying every column of
+        every chunk at once.
+        """
+        ids = array.array('q')
+        kinds = array.array('b')
+        values = array.array('d')
+        states = array.array('b')
+        generations = array.array('Q')
+
+        with self._lock:
+            now = time.time()
+            generation = self._generation.value
+
+            for chunk in self._chunks:
+                ids.frombytes(memoryview(chunk.ids).cast('B'))
+                kinds.frombytes(memoryview(chunk.kinds).cast('B'))
+                values.frombytes(memoryview(chunk.values).cast('B'))
+                states.frombytes(memoryview(chunk.states).cast('B'))
+                generations.frombytes(
+                    memoryview(chunk.generations).cast('B'))
+
+        return Registry.Snapshot(now, generation, ids, kinds, values, states,
+                                 generations)
+
+    def views(self):
+        """
+        Get read-only views of the shared memory of every chunk, as
+        (ids, kinds, values, states), without copying it.
+
+        The views of a chunk are only valid while the registry is alive, and
+        reflect updates as they happen.
+        """
+        with self._lock:
+            return [(memoryview(c.ids).cast('B').cast('q').toreadonly(),
+                     memoryview(c.kinds).cast('B').cast('b').toreadonly(),
+                     memoryview(c.values).cast('B').cast('d').toreadonly(),
+                     memoryview(c.states).cast('B').cast('b').toreadonly())
+                    for c in self._chunks]
+
+    @property
+    def generation(self):
+        return self._generation.value
+
+    def advance(self):
+        """
+        Start a new generation, called before every collection.
+        """
+        self._generation.value += 1
+
+    def stale(self):
+        """
+        Get the set of series which have not been updated in the current
+        generation.
+        """
+        current = self._generation.value
+
+        with self._lock:
+            return set(n for (n, (_, chunk, slot)) in self._slots.items()
+                       if chunk.generations[slot] != current)
+
+    def history(self, n):
+        """
+        Get the history of the given series, or None if it has none.
+        """
+        return self._histories.get(n)
+
+    def _new_history(self, tags):
+        for patterns, size in self._history:
+            if match_tags(patterns, tags):
+                if size <= 0:
+                    return None
+
+                return History(size)
+
+        return None
+
+    def _add_tags(self, n, tags):
+        self._tags[n] = tags
+        self.layout = next_layout()
+
+        for item in tags.items():
+            self._index.setdefault(item, set()).add(n)
 
     @property
     def values(self):
-        return ((self._tags[n], v.value) for (n, v) in self._vals.items())
+        with self._lock:
+            return [(self._tags[n], chunk.values[slot])
+                    for (n, (kind, chunk, slot)) in self._slots.items()
+                    if kind == Registry.METRIC]
 
     @property
     def states(self):
-        return ((self._tags[n], v.value == 1) for (n, v) in
-                self._states.items())
+        with self._lock:
+            return [(self._tags[n], chunk.states[slot] == 1)
+                    for (n, (kind, chunk, slot)) in self._slots.items()
+                    if kind == Registry.STATE]
 
     def update(self, n, value):
-        self._vals[n].value = value
+        _, chunk, slot = self._slots[n]
+        chunk.values[slot] = value
@@ -0,0 +1,73 @@
+"""
+Rules which rewrite or drop series by their tags, as they are registered.
+
+Rules are applied in order to the tags of every series, before any shared
+memory is allocated for it. A series which is dropped is never allocated, and
+the collector gets a metric which discards every update instead.
+
+A rule matches a series if the value of every tag in its match is matched in
+full by the corresponding regular expression, a series without the tag never
+matches. The actions are:
+
+    keep:   drop the series unless it matches.
+    drop:   drop the series if it matches.
+    rename: rename the tag named by tag to to, if the series matches.
+    set:    set the tag named by tag to value, if the series matches.
+"""
+import re
+
+ACTIONS = set(['keep', 'drop', 'rename', 'set'])
+
+
+class Rule(object):
+    def __init__(self, action, match=None, tag=None, to=None, value=None):
+        if action not in ACTIONS:
+            raise ValueError('not a valid action: {0!r}'.format(action))
+
+        self.action = action
+        self.match = [(k, re.compile(str(pattern)))
+                      for k, pattern in (match or {}).items()]
+        self.tag = tag
+        self.to = to
+        self.value = value
+
+    def matches(self, tags):
+        for k, pattern in self.match:
+            v = tags.get(k)
+
+            if v is None or pattern.fullmatch(str(v)) is None:
+                return False
+
+        return True
+
+    def __repr__(self):
+        return '<rule {0} {1!r}>'.format(
+            self.action, dict((k, p.pattern) for k, p in self.match))
+
+
+def relabel(rules, tags):
+    """
+    Apply rules in order to tags, returning the new tags, or None if the
+    series is dropped.
+
+    tags is never modified.
+    """
+    for r in rules:
+        if not r.matches(tags):
+            if r.action == 'keep':
+                return None
+
+            continue
+
+        if r.action == 'drop':
+            return None
+
+        if r.action == 'rename':
+            if r.tag in tags:
+                tags = dict(tags)
+                tags[r.to] = tags.pop(r.tag)
+        elif r.action == 'set':
+            tags = dict(tags)
+            tags[r.tag] = r.value
+
+    return tags
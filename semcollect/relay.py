@@ -0,0 +1,594 @@
+"""
+Relaying of series between agents.
+
+A downstream agent with a relay output pushes every batch to an upstream
+agent, which listens for them with a relay server. The upstream agent merges
+the series of all downstream agents with its own, passes them through its
+stages, like aggregation, and on to its own outputs, which might be a relay
+output to an agent further up.
+
+Every connection is a stream of frames, each a type (B) and length (I)
+followed by the payload, all in network byte order.
+
+    hello:  magic (4s), version (B)
+    define: count (I), followed by entries of id (I), kind (B), number of
+            tags (H) and the tags (see semcollect.encoding).
+    values: time (d), count (I), followed by entries of id (I), value (d).
+
+A series is defined once per connection, and is then only referred to by its
+id. The relay interns series by their tags, so that a series keeps its id no
+matter which connection it arrives on.
+
+Addresses are either a path to a unix domain socket, or host:port, where an
+IPv6 host is written in brackets, like [::1]:7011.
+"""
+import os
+import time
+import errno
+import socket
+import struct
+import logging
+import threading
+
+from .registry import Registry, next_layout
+from .encoding import MAGIC, EncodingException, encode_tags, decode_tags
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+FRAME = struct.Struct('!BI')
+HELLO = struct.Struct('!4sB')
+COUNT = struct.Struct('!I')
+DEFINE = struct.Struct('!IBH')
+VALUES = struct.Struct('!dI')
+VALUE = struct.Struct('!Id')
+
+FRAME_HELLO = 1
+FRAME_DEFINE = 2
+FRAME_VALUES = 3
+
+# largest frame accepted from a downstream agent.
+MAX_FRAME = 16 * 1024 * 1024
+# bytes of encoded batches a relay output buffers while the upstream agent
+# is not keeping up.
+MAX_BUFFER = 4 * 1024 * 1024
+# ids of relayed series start here, to keep them apart from the ids of the
+# local registry.
+RELAY_ID_BASE = 2 ** 30
+
+
+class RelayException(Exception):
+    pass
+
+
+def parse_address(address):
+    """
+    Parse an address into a (family, address) tuple, where the family of a
+    host and port is AF_UNSPEC until it has been resolved, see
+    #resolve_address.
+    """
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+
+    host, sep, port = address.rpartition(':')
+
+    if not sep or not port.isdigit():
+        raise RelayException('invalid address: {0}'.format(address))
+
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+
+    return socket.AF_UNSPEC, (host or 'localhost', int(port))
+
+
+def resolve_address(address, passive=False):
+    """
+    Resolve an address into a (family, address) tuple suitable for socket.
+
+    Resolving a host name might block.
+    """
+    family, addr = parse_address(address)
+
+    if family == socket.AF_UNIX:
+        return family, addr
+
+    host, port = addr
+    flags = socket.AI_PASSIVE if passive else 0
+
+    try:
+        infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                   socket.SOCK_STREAM, 0, flags)
+    except socket.gaierror as e:
+        raise RelayException('{0}: {1}'.format(address, e))
+
+    family, _, _, _, sockaddr = infos[0]
+    return family, sockaddr
+
+
+def encode_frame(t, parts):
+    payload = b''.join(parts)
+    return FRAME.pack(t, len(payload)) + payload
+
+
+class Relay(object):
+    """
+    The merged series of all downstream agents.
+    """
+    class Stream(object):
+        """
+        Decodes the frames of a single connection.
+        """
+        def __init__(self, relay):
+            self._relay = relay
+            self._buffer = bytearray()
+            self._hello = False
+            # ids of the connection to interned ids.
+            self._ids = dict()
+
+        def feed(self, data):
+            self._buffer += data
+
+            while len(self._buffer) >= FRAME.size:
+                t, length = FRAME.unpack_from(self._buffer, 0)
+
+                if length > MAX_FRAME:
+                    raise RelayException('frame too large')
+
+                end = FRAME.size + length
+
+                if len(self._buffer) < end:
+                    return
+
+                payload = bytes(self._buffer[FRAME.size:end])
+                del self._buffer[:end]
+
+                try:
+                    self._frame(t, payload)
+                except struct.error:
+                    raise RelayException('truncated frame')
+                except EncodingException as e:
+                    raise RelayException('invalid frame: {0}'.format(e))
+                except UnicodeDecodeError:
+                    raise RelayException('invalid frame: bad tag encoding')
+
+        def _frame(self, t, payload):
+            if t == FRAME_HELLO:
+                magic, version = HELLO.unpack_from(payload, 0)
+
+                if magic != MAGIC or version != VERSION:
+                    raise RelayException('unsupported protocol')
+
+                self._hello = True
+                return
+
+            if not self._hello:
+                raise RelayException('expected hello')
+
+            if t == FRAME_DEFINE:
+                count, = COUNT.unpack_from(payload, 0)
+                o = COUNT.size
+
+                for _ in range(count):
+                    n, kind, ntags = DEFINE.unpack_from(payload, o)
+                    tags, o = decode_tags(payload, o + DEFINE.size, ntags)
+                    self._ids[n] = self._relay.intern(kind, tags)
+
+                return
+
+            if t == FRAME_VALUES:
+                now, count = VALUES.unpack_from(payload, 0)
+
+                for n, value in VALUE.iter_unpack(
+                        payload[VALUES.size:VALUES.size + count * VALUE.size]):
+                    i = self._ids.get(n)
+
+                    if i is not None:
+                        self._relay.update(i, value)
+
+                return
+
+            raise RelayException('unknown frame type: {0}'.format(t))
+
+    def __init__(self, expire=30.0):
+        self._expire = expire
+        self._interned = dict()
+        # definitions of every interned series as (kind, tags), which are kept
+        # so that an expired series can come back without being defined again.
+        self._defs = dict()
+        # value and last update of every series which is currently relayed.
+        self._values = dict()
+        # series updated since the last snapshot.
+        self._updated = set()
+        self._next = RELAY_ID_BASE
+        self.layout = next_layout()
+
+    def stream(self):
+        return Relay.Stream(self)
+
+    def intern(self, kind, tags):
+        key = (kind, frozenset(tags.items()))
+        n = self._interned.get(key)
+
+        if n is None:
+            n = self._next
+            self._next += 1
+            self._interned[key] = n
+            self._defs[n] = (kind, tags)
+
+        return n
+
+    def update(self, n, value):
+        if n not in self._values:
+            self.layout = next_layout()
+
+        self._values[n] = (value, time.time())
+        self._updated.add(n)
+
+    def snapshot(self, now):
+        """
+        Get the series of all downstream agents as (id, kind, tags, value),
+        and the set of them which have not been updated since the last
+        snapshot.
+
+        Series which have not been updated for a while are expired.
+        """
+        expired = [n for n, (_, t) in self._values.items()
+                   if now - t > self._expire]
+
+        if len(expired) > 0:
+            for n in expired:
+                del self._values[n]
+
+            self.layout = next_layout()
+
+        series = list()
+
+        for n in sorted(self._values):
+            kind, tags = self._defs[n]
+            value, _ = self._values[n]
+
+            if kind == Registry.STATE:
+                value = value == 1.0
+
+            series.append((n, kind, tags, value))
+
+        stale = set(self._values) - self._updated
+        self._updated = set()
+        return series, stale
+
+
+class RelayServer(object):
+    """
+    Accepts connections from downstream agents, feeding them into a relay.
+    """
+    class Client(object):
+        def __init__(self, sock, stream):
+            self.sock = sock
+            self.stream = stream
+
+        def fileno(self):
+            return self.sock.fileno()
+
+    def __init__(self, address, relay):
+        self.address = address
+        self._relay = relay
+        self._sock = None
+        self._clients = dict()
+
+    def start(self):
+        family, address = resolve_address(self.address, passive=True)
+
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        sock.setblocking(False)
+        sock.bind(address)
+        sock.listen(64)
+        self._sock = sock
+
+        log.info('relay: listening on %s', self.address)
+
+    def stop(self):
+        for c in list(self._clients.values()):
+            self._close(c)
+
+        if self._sock is not None:
+            family = self._sock.family
+            self._sock.close()
+            self._sock = None
+
+            if family == socket.AF_UNIX and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def rlist(self):
+        return [self._sock] + list(self._clients.values())
+
+    def wlist(self):
+        return []
+
+    def service(self, r, w):
+        for s in r:
+            if s is self._sock:
+                self._accept()
+            else:
+                self._read(s)
+
+    def _accept(self):
+        try:
+            sock, _ = self._sock.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            raise
+
+        sock.setblocking(False)
+        c = RelayServer.Client(sock, self._relay.stream())
+        self._clients[sock.fileno()] = c
+
+    def _read(self, c):
+        try:
+            data = c.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+
+            self._close(c)
+            return
+
+        if len(data) == 0:
+            self._close(c)
+            return
+
+        try:
+            c.stream.feed(data)
+        except RelayException as e:
+            log.warn('relay: dropping connection: %s', e)
+            self._close(c)
+
+    def _close(self, c):
+        self._clients.pop(c.fileno(), None)
+        c.sock.close()
+
+    def __str__(self):
+        return '<relay {0}>'.format(self.address)
+
+
+class RelayOutput(object):
+    """
+    Pushes every batch to an upstream agent.
+
+    The socket never blocks, encoded batches are put in a send buffer which
+    is written as the socket becomes writable, from the poll loop of the
+    agent. Batches are dropped while the buffer is full, or while not
+    connected.
+
+    Connects on the first batch, and reconnects on the next batch after the
+    connection has been lost.
+    """
+    def __init__(self, config):
+        address = config.get('address')
+
+        if address is None:
+            raise Exception('relay output: address is required')
+
+        self._address = address
+        self._family, addr = parse_address(address)
+        # (family, address) to connect to, once resolved.
+        self._resolved = None
+        self._resolver = None
+
+        if self._family == socket.AF_UNIX:
+            self._resolved = (self._family, addr)
+        else:
+            self._resolve()
+
+        self._timeout = float(config.get('timeout', 1.0))
+        self._max_buffer = int(config.get('buffer', MAX_BUFFER))
+        self._sock = None
+        # time the connection was started, while it is in progress.
+        self._connecting = None
+        # encoded frames which have not been sent yet.
+        self._buffer = bytearray()
+        # tags of every series defined on the current connection.
+        self._defined = dict()
+        # a batch was not sent, so stale values have to be sent again.
+        self._resend = True
+
+    def __call__(self, batch):
+        if self._sock is None and not self._connect():
+            return
+
+        self._flush()
+
+        if self._sock is None:
+            return
+
+        parts = list()
+        defines = list()
+        defined = dict()
+
+        for n, kind, tags, value in batch.series:
+            d = self._defined.get(n)
+
+            if d is tags or d == tags:
+                continue
+
+            defines.append(DEFINE.pack(n, kind, len(tags)))
+            encode_tags(defines, tags)
+            defined[n] = tags
+
+        if len(defined) > 0:
+            defines.insert(0, COUNT.pack(len(defined)))
+            parts.append(encode_frame(FRAME_DEFINE, defines))
+
+        values = [None]
+        count = 0
+
+        for n, kind, tags, value in batch.series:
+            # stale values have already been relayed.
+            if n in batch.stale and not self._resend:
+                continue
+
+            values.append(VALUE.pack(n, float(value)))
+            count += 1
+
+        values[0] = VALUES.pack(batch.time, count)
+        parts.append(encode_frame(FRAME_VALUES, values))
+
+        size = sum(len(p) for p in parts)
+
+        if len(self._buffer) + size > self._max_buffer:
+            log.warn('%s: send buffer is full, dropping batch', self)
+            self._resend = True
+            return
+
+        for p in parts:
+            self._buffer += p
+
+        self._defined.update(defined)
+        self._resend = False
+        self._flush()
+
+    def rlist(self):
+        return []
+
+    def wlist(self):
+        if self._sock is None:
+            return []
+
+        if self._connecting is not None or len(self._buffer) > 0:
+            return [self]
+
+        return []
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def service(self, r, w):
+        if self._sock is None:
+            return
+
+        if self in w:
+            self._flush()
+        elif self._connecting is not None:
+            self._check_connecting()
+
+    def _resolve(self):
+        """
+        Resolve the address on a thread of its own, since resolving a host
+        name might block. The address is resolved again after every failed
+        connection, in case it has changed.
+        """
+        if self._family == socket.AF_UNIX:
+            return
+
+        if self._resolver is not None and self._resolver.is_alive():
+            return
+
+        def resolve():
+            try:
+                self._resolved = resolve_address(self._address)
+            except RelayException as e:
+                log.warn('%s: failed to resolve: %s', self, e)
+
+        self._resolver = threading.Thread(target=resolve)
+        self._resolver.daemon = True
+        self._resolver.start()
+
+    def _connect(self):
+        resolved = self._resolved
+
+        if resolved is None:
+            log.debug('%s: not resolved yet', self)
+            self._resolve()
+            return False
+
+        family, addr = resolved
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+
+        if err not in (0, errno.EINPROGRESS):
+            log.warn('%s: failed to connect: %s', self, os.strerror(err))
+            sock.close()
+            self._resolve()
+            return False
+
+        self._sock = sock
+        self._connecting = time.time() if err != 0 else None
+        self._defined = dict()
+        self._resend = True
+        self._buffer = bytearray(encode_frame(
+            FRAME_HELLO, [HELLO.pack(MAGIC, VERSION)]))
+
+        if self._connecting is None:
+            log.info('%s: connected', self)
+
+        return True
+
+    def _check_connecting(self):
+        """
+        Give up on a connection which has been in progress for too long.
+        """
+        if time.time() - self._connecting > self._timeout:
+            log.warn('%s: failed to connect: timed out', self)
+            self._disconnect()
+            self._resolve()
+
+    def _flush(self):
+        """
+        Send as much of the buffer as the socket accepts without blocking.
+        """
+        if self._connecting is not None:
+            err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+            if err != 0:
+                log.warn('%s: failed to connect: %s', self, os.strerror(err))
+                self._disconnect()
+                self._resolve()
+                return
+
+            try:
+                self._sock.getpeername()
+            except socket.error:
+                # still in progress.
+                self._check_connecting()
+                return
+
+            log.info('%s: connected', self)
+            self._connecting = None
+
+        while len(self._buffer) > 0:
+            try:
+                n = self._sock.send(self._buffer)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+
+                log.warn('%s: send failed: %s', self, e)
+                self._disconnect()
+                return
+
+            del self._buffer[:n]
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+        self._connecting = None
+        self._buffer = bytearray()
+        self._defined = dict()
+
+    def stop(self):
+        self._disconnect()
+
+    def __str__(self):
+        return '<output relay {0}>'.format(self._address)
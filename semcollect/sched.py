@@ -0,0 +1,79 @@
+"""
+Scheduling priority of collector processes.
+
+A priority class sets the nice value, the I/O priority and the CPUs that a
+collector process may run on. It is applied by the collector process itself,
+right after it has been started.
+"""
+import os
+import ctypes
+import logging
+import platform
+
+log = logging.getLogger(__name__)
+
+# ioprio_set(2) is not exposed by the standard library.
+IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+
+def ioprio_set(ioprio_class, level=0):
+    """
+    Set the I/O priority of the calling process.
+    """
+    nr = IOPRIO_SET.get(platform.machine())
+
+    if nr is None:
+        raise Exception('ioprio_set: not supported on {0}'.format(
+            platform.machine()))
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    ioprio = (IOPRIO_CLASSES[ioprio_class] << IOPRIO_CLASS_SHIFT) | level
+
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, 'ioprio_set: {0}'.format(os.strerror(e)))
+
+
+def apply_priority_class(name, priority_class):
+    """
+    Apply the given priority class to the calling process.
+
+    Every setting is applied independently, a setting which fails is logged
+    and does not prevent the collector from running.
+    """
+    pc = priority_class
+
+    if pc.nice is not None:
+        try:
+            os.nice(pc.nice)
+        except OSError as e:
+            log.warn('%s: failed to set nice: %s', name, e)
+
+    if pc.ioprio_class is not None:
+        try:
+            ioprio_set(pc.ioprio_class, pc.ioprio_level)
+        except Exception as e:
+            log.warn('%s: failed to set ioprio: %s', name, e)
+
+    if pc.cpus is not None:
+        try:
+            os.sched_setaffinity(0, pc.cpus)
+        except (OSError, AttributeError) as e:
+            log.warn('%s: failed to set affinity: %s', name, e)